@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+""" Compare the built-in connect scanner with the masscan discovery path.
+
+A farm of listening sockets is opened on localhost and both port scanners
+sweep all 65535 TCP ports. The wall time and whether every listener was found
+are reported for each. The masscan run needs masscan installed and sudo
+access; it is skipped otherwise.
+
+    python benchmarks/portscan.py --listeners 100 --rate 1000
+"""
+import subprocess
+import argparse
+import tempfile
+import socket
+import shutil
+import time
+import os
+
+from htb import portscan
+
+
+def listener_farm(count: int):
+    """ Open `count` listening sockets on random localhost ports """
+
+    sockets = []
+    while len(sockets) < count:
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(128)
+        sockets.append(sock)
+
+    return sockets, {s.getsockname()[1] for s in sockets}
+
+
+def bench_connect(expected, args):
+    start = time.monotonic()
+    found = set(
+        portscan.tcp_scan(
+            "127.0.0.1", concurrency=args.concurrency, timeout=args.timeout
+        )
+    )
+    return time.monotonic() - start, expected <= found
+
+
+def bench_masscan(expected, args):
+    if shutil.which("masscan") is None:
+        return None, "masscan not installed"
+
+    with tempfile.TemporaryDirectory() as tmp:
+        output = os.path.join(tmp, "masscan.grep")
+        start = time.monotonic()
+        code = subprocess.call(
+            [
+                "sudo",
+                "masscan",
+                "127.0.0.1",
+                "-p",
+                "1-65535",
+                "--max-rate",
+                str(args.rate),
+                "-oG",
+                output,
+                "-e",
+                args.interface,
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+        )
+        elapsed = time.monotonic() - start
+
+        if code != 0:
+            return None, f"masscan exited with {code}"
+
+        with open(output, "r") as fh:
+            found = {
+                int(line.split(" ")[-1].split("/")[0])
+                for line in fh
+                if line.strip() and line[0] != "#" and "open" in line
+            }
+
+    return elapsed, expected <= found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--listeners", "-l", type=int, default=100)
+    parser.add_argument("--concurrency", "-c", type=int, default=1000)
+    parser.add_argument("--timeout", "-t", type=float, default=1.0)
+    parser.add_argument("--rate", "-r", type=int, default=1000)
+    parser.add_argument("--interface", "-e", default="lo")
+    args = parser.parse_args()
+
+    sockets, expected = listener_farm(args.listeners)
+
+    try:
+        for name, bench in [("connect", bench_connect), ("masscan", bench_masscan)]:
+            elapsed, result = bench(expected, args)
+            if elapsed is None:
+                print(f"{name:<10} skipped ({result})")
+            else:
+                print(f"{name:<10} {elapsed:8.2f}s  all listeners found: {result}")
+    finally:
+        for sock in sockets:
+            sock.close()
+
+
+if __name__ == "__main__":
+    main()
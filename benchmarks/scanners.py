@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+""" Benchmark the scanner pipeline against fake tool binaries.
+
+Fake `gobuster`, `nikto`, `enum4linux`, `nmap`, `masscan` and `sudo`
+executables are written to a temporary directory which is put first in PATH.
+They produce output in the format of the real tools (including gobuster's
+`\\r` progress lines) with a configurable volume and rate, so the suite runs
+offline on any Linux machine. Reported numbers:
+
+    throughput   lines and bytes per second read by each scanner, and the
+                 CPU time spent in this process per 100k lines
+    cancel       time from setting `tracker.stop` until the job finished
+    scaling      wall time, jobs per second and CPU time of this process for
+                 1, 10 and 100 concurrent jobs on a shared scheduler
+    enumerate    time until the first service and until enumeration finished
+                 with the fake masscan and nmap
+
+    python benchmarks/scanners.py --lines 200000 --jobs 1,10,100
+"""
+from typing import List
+import configparser
+import argparse
+import tempfile
+import textwrap
+import threading
+import queue
+import types
+import time
+import stat
+import sys
+import os
+
+from htb.scanner import Service, Tracker, AVAILABLE_SCANNERS
+from htb.findings import FindingStore
+from htb.scheduler import Scheduler
+
+# Shared by every fake tool: emit lines at HTB_FAKE_RATE lines per second
+FAKE_COMMON = """
+import sys, os, time
+
+LINES = int(os.environ.get("HTB_FAKE_LINES", "10000"))
+RATE = float(os.environ.get("HTB_FAKE_RATE", "0"))
+START = time.monotonic()
+
+def arg(flag, default=None):
+    return sys.argv[sys.argv.index(flag) + 1] if flag in sys.argv else default
+
+def pace(n):
+    if RATE > 0 and n % 100 == 0:
+        delay = START + n / RATE - time.monotonic()
+        if delay > 0:
+            sys.stdout.flush()
+            time.sleep(delay)
+"""
+
+FAKE_TOOLS = {
+    "gobuster": """
+        words = sys.stdin if arg("-w") == "-" else open(arg("-w"))
+        with open(arg("-o"), "w") as output:
+            n = 0
+            for n, word in enumerate(words, 1):
+                pace(n)
+                if n % 10 == 0:
+                    line = f"/{word.strip()} (Status: 200) [Size: {n}]"
+                    output.write(line + "\\n")
+                    print(line)
+                if n % 100 == 0:
+                    sys.stdout.write(f"\\rProgress: {n} / {LINES} ({n*100/LINES:.2f}%)")
+        print(f"\\rProgress: {n} / {LINES} (100.00%)")
+    """,
+    "nikto": """
+        output = open(arg("-output", os.devnull), "w")
+        for n in range(1, LINES + 1):
+            pace(n)
+            line = f"+ OSVDB-{n}: /path{n}/: The anti-clickjacking header is not present."
+            output.write(line + "\\n")
+            print(line)
+    """,
+    "enum4linux": """
+        for n in range(1, LINES + 1):
+            pace(n)
+            if n % 100 == 1:
+                print(f" ===========================\\n|    Users on {sys.argv[-1]}    |")
+            print(f"index: 0x{n:x} RID: 0x{n:x} acb: 0x00000010 Account: user{n}")
+            print(f"user:[user{n}] rid:[0x{n:x}]")
+    """,
+    "masscan": """
+        with open(arg("-oG"), "w") as output:
+            output.write("# Masscan\\n")
+            for n in range(1, min(LINES, 65535) + 1):
+                pace(n)
+                if n % 1000 == 0:
+                    # Results only go to stdout as well when asked for
+                    if "--interactive" in sys.argv:
+                        print(f"Discovered open port {n}/tcp on {sys.argv[1]}", flush=True)
+                    output.write(f"Host: {sys.argv[1]} ()\\tPorts: {n}/open/tcp////\\n")
+    """,
+    "nmap": """
+        ports = arg("-p").split(",")
+        prefix = arg("-oA")
+        time.sleep(0.05 * len(ports))
+        entries = "".join(f"{p}/open/tcp//http//fake httpd 1.0/, " for p in ports)
+        with open(prefix + ".nmap", "w") as fh:
+            fh.write("".join(f"{p}/tcp open http\\n" for p in ports))
+        with open(prefix + ".gnmap", "w") as fh:
+            fh.write(f"# Nmap\\nHost: 127.0.0.1 ()\\tPorts: {entries[:-2]}\\n# Nmap done\\n")
+        with open(prefix + ".xml", "w") as fh:
+            fh.write("<nmaprun><host><address addr='127.0.0.1'/><ports>")
+            for p in ports:
+                fh.write(f"<port protocol='tcp' portid='{p}'><state state='open'/>"
+                         "<service name='http' product='fake httpd' version='1.0'/></port>")
+            fh.write("</ports></host></nmaprun>")
+    """,
+    "sudo": """
+        os.execvp(sys.argv[1], sys.argv[1:])
+    """,
+}
+
+
+def install_fake_tools(directory: str) -> None:
+    """ Write the fake tools to `directory` and put it first in PATH """
+
+    for name, body in FAKE_TOOLS.items():
+        path = os.path.join(directory, name)
+        with open(path, "w") as fh:
+            fh.write(f"#!{sys.executable}\n")
+            fh.write(FAKE_COMMON)
+            fh.write(textwrap.dedent(body))
+        os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR)
+
+    os.environ["PATH"] = directory + os.pathsep + os.environ["PATH"]
+
+
+def fake_machine(analysis_path: str, config: configparser.ConfigParser):
+    """ The parts of a Machine used by scanners """
+
+    os.makedirs(os.path.join(analysis_path, "scans"), exist_ok=True)
+    return types.SimpleNamespace(
+        name="bench",
+        ip="127.0.0.1",
+        hostname="127.0.0.1",
+        analysis_path=analysis_path,
+        connection=types.SimpleNamespace(config=config),
+        findings=FindingStore(),
+        runlog=None,
+        index=lambda force=False, finished=None: False,
+    )
+
+
+def service(port: int, name: str) -> Service:
+    s = Service.from_port("127.0.0.1", port)
+    s.name = name
+    return s
+
+
+def start_job(scanner, machine, svc: Service, events: queue.Queue, scheduler=None):
+    """ Start a background scan and release it like the `jobs` command does """
+
+    tracker = Tracker(
+        silent=True,
+        machine=machine,
+        service=svc,
+        scanner=scanner,
+        status="",
+        events=events,
+        thread=None,
+        stop=False,
+        data={},
+        lock=threading.Lock(),
+        scheduler=scheduler,
+    )
+    tracker.thread = scanner.background(
+        tracker, machine.analysis_path, machine.hostname, machine, svc
+    )
+    return tracker
+
+
+def bench_throughput(machine, args) -> List[List[str]]:
+    rows = []
+    targets = [
+        ("gobuster", service(80, "http")),
+        ("nikto", service(80, "http")),
+        ("enum4linux", service(445, "microsoft-ds")),
+    ]
+
+    for name, svc in targets:
+        events: queue.Queue = queue.Queue()
+        cpu = time.process_time()
+        start = time.monotonic()
+        tracker = start_job(AVAILABLE_SCANNERS[name], machine, svc, events)
+        events.get()
+        tracker.thread.join()
+        elapsed = time.monotonic() - start
+        cpu = time.process_time() - cpu
+
+        rows.append(
+            [
+                name,
+                f"{tracker.lines}",
+                f"{elapsed:.2f}s",
+                f"{tracker.lines/elapsed:,.0f}",
+                f"{tracker.bytes/elapsed/(1<<20):.1f}",
+                f"{cpu*100000/max(tracker.lines, 1):.3f}s",
+            ]
+        )
+
+    return rows
+
+
+def bench_cancel(machine, args) -> List[List[str]]:
+    rows = []
+    os.environ["HTB_FAKE_RATE"] = "100"
+
+    try:
+        for name, svc in [
+            ("gobuster", service(80, "http")),
+            ("nikto", service(80, "http")),
+            ("enum4linux", service(445, "microsoft-ds")),
+        ]:
+            events: queue.Queue = queue.Queue()
+            tracker = start_job(AVAILABLE_SCANNERS[name], machine, svc, events)
+            time.sleep(1)
+            start = time.monotonic()
+            tracker.stop = True
+            events.get()
+            rows.append([name, f"{(time.monotonic()-start)*1000:.0f}ms"])
+    finally:
+        os.environ["HTB_FAKE_RATE"] = str(args.rate)
+
+    return rows
+
+
+def bench_scaling(machine, args) -> List[List[str]]:
+    rows = []
+    lines = max(1, args.lines // 100)
+    os.environ["HTB_FAKE_LINES"] = str(lines)
+
+    try:
+        for jobs in args.jobs:
+            scheduler = Scheduler(limit=jobs, per_host=jobs)
+            events: queue.Queue = queue.Queue()
+            cpu = time.process_time()
+            start = time.monotonic()
+            trackers = [
+                start_job(
+                    AVAILABLE_SCANNERS["nikto"],
+                    machine,
+                    service(8000 + n, "http"),
+                    events,
+                    scheduler,
+                )
+                for n in range(jobs)
+            ]
+            for _ in trackers:
+                events.get()
+            elapsed = time.monotonic() - start
+            cpu = time.process_time() - cpu
+
+            rows.append(
+                [
+                    str(jobs),
+                    f"{elapsed:.2f}s",
+                    f"{jobs/elapsed:.1f}",
+                    f"{sum([t.lines for t in trackers])/elapsed:,.0f}",
+                    f"{cpu:.2f}s",
+                ]
+            )
+    finally:
+        os.environ["HTB_FAKE_LINES"] = str(args.lines)
+
+    return rows
+
+
+def bench_enumerate(machine, args) -> List[List[str]]:
+    from htb.machine import Machine
+
+    config = machine.connection.config
+
+    class Connection(object):
+        def __init__(self):
+            self.config = config
+
+        def _api(self, endpoint, **kwargs):
+            return [{"id": 1}] if endpoint == "/machines/spawned" else []
+
+    m = Machine(
+        Connection(),
+        {
+            "id": 1,
+            "name": "bench",
+            "os": "Linux",
+            "ip": "127.0.0.1",
+            "avatar_thumb": "",
+            "points": 0,
+            "release": "",
+            "retired_date": "",
+            "maker": {},
+            "user_owns": 0,
+            "root_owns": 0,
+        },
+    )
+    m.analysis_path = machine.analysis_path
+
+    first = []
+    start = time.monotonic()
+
+    def report(message: str):
+        if not first and message.startswith("discovered"):
+            first.append(time.monotonic() - start)
+
+    m.enumerate(force=True, report=report)
+    elapsed = time.monotonic() - start
+
+    return [
+        [str(len(m.services)), f"{first[0]:.2f}s" if first else "-", f"{elapsed:.2f}s",]
+    ]
+
+
+BENCHMARKS = {
+    "throughput": (
+        bench_throughput,
+        ["Scanner", ">Lines", ">Wall", ">Lines/s", ">MiB/s", ">CPU/100k lines"],
+    ),
+    "cancel": (bench_cancel, ["Scanner", ">Latency"]),
+    "scaling": (bench_scaling, [">Jobs", ">Wall", ">Jobs/s", ">Lines/s", ">CPU"]),
+    "enumerate": (bench_enumerate, [">Services", ">First", ">Total"]),
+}
+
+
+def print_table(title: str, header: List[str], rows: List[List[str]]) -> None:
+    """ Print rows under a header. Columns whose header starts with ">" are
+    right aligned. """
+
+    right = [h.startswith(">") for h in header]
+    rows = [[h.lstrip(">") for h in header]] + rows
+    widths = [max([len(r[i]) for r in rows]) for i in range(len(header))]
+
+    print(title)
+    for row in rows:
+        cells = [
+            cell.rjust(width) if r else cell.ljust(width)
+            for cell, width, r in zip(row, widths, right)
+        ]
+        print("  " + "  ".join(cells).rstrip())
+    print()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument(
+        "--lines", "-l", type=int, default=200000, help="Output lines per fake tool"
+    )
+    parser.add_argument(
+        "--rate",
+        "-r",
+        type=float,
+        default=0,
+        help="Output lines per second (0: unlimited)",
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        type=lambda v: [int(j) for j in v.split(",")],
+        default=[1, 10, 100],
+        help="Concurrent job counts for the scaling benchmark",
+    )
+    parser.add_argument(
+        "--only", "-o", choices=list(BENCHMARKS), action="append", default=None
+    )
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.mkdir(os.path.join(tmp, "bin"))
+        install_fake_tools(os.path.join(tmp, "bin"))
+        os.environ["HTB_FAKE_LINES"] = str(args.lines)
+        os.environ["HTB_FAKE_RATE"] = str(args.rate)
+
+        wordlist = os.path.join(tmp, "words.txt")
+        with open(wordlist, "w") as fh:
+            fh.write("".join([f"word{n}\n" for n in range(args.lines)]))
+
+        config = configparser.ConfigParser()
+        config.read_dict(
+            {
+                # The fake tools make no requests, so there is nothing to calibrate
+                "gobuster": {"wordlist": wordlist, "shards": "1", "calibrate": "no"},
+                "nikto": {"calibrate": "no"},
+                "enum": {"nmap_chunk": "8", "interface": "lo", "udp": "no"},
+            }
+        )
+        machine = fake_machine(os.path.join(tmp, "bench"), config)
+
+        for name in args.only or list(BENCHMARKS):
+            bench, header = BENCHMARKS[name]
+            print_table(name, header, bench(machine, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,5 @@
 #!/usr/bin/env python3
-from typing import Any, List, Dict, Union
+from typing import Any, List, Dict, Union, Optional
 import cmd2
 from cmd2 import Cmd
 from cmd2.argparse_custom import Cmd2ArgumentParser
@@ -12,18 +12,29 @@ import queue
 import argparse
 import os.path
 import tempfile
+import sqlite3
 import signal
 import shlex
 import time
 import dbus
 import sys
 import os
+import re
 
 from htb import util
+from htb import runlog
+from htb import portscan
 from htb import Connection, Machine, VPN
 from htb.exceptions import *
 from htb.scanner.scanner import Tracker, Scanner, Service
+from htb.findings import Finding
 from htb.scanner import AVAILABLE_SCANNERS
+from htb.scanner.enumeration import EnumerationScanner
+from htb.scheduler import Scheduler
+from htb.jobs import JobTable
+from htb.index import AnalysisIndex, MATCH_START, MATCH_END
+from htb.watch import AnalysisWatcher
+from htb.daemon import DaemonClient
 import htb.scanner
 
 
@@ -61,6 +72,9 @@ class HackTheBox(Cmd):
         self.config_path: str = path_resource
         self.config = parser
 
+        # Register command template scanners from the configuration
+        AVAILABLE_SCANNERS.configure(parser)
+
         # Extract relevant information
         email = parser["htb"].get("email", None)
         password = parser["htb"].get("password", None)
@@ -90,9 +104,11 @@ class HackTheBox(Cmd):
             f"{Fore.CYAN}htb{Fore.RESET} {Style.BRIGHT+Fore.GREEN}➜{Style.RESET_ALL} "
         )
 
-        # List of job trackers
-        self.jobs: List[Tracker] = []
-        self.job_events: queue.Queue = queue.Queue()
+        # Background job trackers, retired as they finish
+        self.jobs: JobTable = JobTable.from_config(self.config)
+
+        # Shared limits for background jobs
+        self.scheduler: Scheduler = Scheduler.from_config(self.config)
 
         # Enable self in python
         self.self_in_py = True
@@ -102,6 +118,18 @@ class HackTheBox(Cmd):
 
         self.cnxn.subscribe("repl", self._on_notification)
 
+        # Notice analysis files changed by other tools
+        self.watcher: Optional[AnalysisWatcher] = None
+        if self.config.getboolean("htb", "watch", fallback=True):
+            watcher = AnalysisWatcher(
+                self.cnxn, report=self._on_analysis_change, busy=self._scan_busy
+            )
+            try:
+                watcher.start()
+                self.watcher = watcher
+            except OSError as e:
+                self.pwarning(f"not watching {self.cnxn.analysis_path}: {e}")
+
     @classmethod
     def get(cls, *args, **kwargs) -> "HackTheBox":
         """ Get the singleton object for the HackTheBox REPL
@@ -130,6 +158,29 @@ class HackTheBox(Cmd):
 
         return True
 
+    def _on_analysis_change(self, message: str) -> None:
+        """ Report a change to the analysis directory made by someone else """
+
+        # Don't hold up the watcher while a command is running
+        if self.terminal_lock.acquire(blocking=False):
+            try:
+                self.async_alert(message)
+            finally:
+                self.terminal_lock.release()
+        else:
+            self.pwarning(message)
+
+    def _scan_busy(self, machine: Machine, path: str) -> bool:
+        """ Whether one of our jobs is still writing a scan output file """
+
+        name = os.path.basename(path)
+        return any(
+            [
+                j.machine is machine and name.startswith(f"{j.scanner.name}-")
+                for j in self.jobs.running()
+            ]
+        )
+
     def twofactor_prompt(self) -> str:
         self.pwarning("One Time Password: ", end="")
         sys.stderr.flush()
@@ -175,47 +226,123 @@ class HackTheBox(Cmd):
     def do_jobs(self, args: argparse.Namespace) -> bool:
         """ Manage running background scanner jobs """
 
-        actions = {"list": self._jobs_list, "kill": self._jobs_kill}
+        actions = {
+            "list": self._jobs_list,
+            "kill": self._jobs_kill,
+            "tail": self._jobs_tail,
+            "stats": self._jobs_stats,
+        }
         actions[args.action](args)
         return False
 
     def _jobs_list(self, args: argparse.Namespace) -> None:
         """ List the background scanner jobs """
 
-        # Grab any pending events
-        try:
-            while True:
-                t = self.job_events.get_nowait()
-                t.thread.join()
-                t.thread = None
-                # t.status = "completed"
-        except queue.Empty:
-            pass
-
-        table = [["", "Host", "Service", "Scanner", "Status"]]
-        for ident, job in enumerate(self.jobs):
+        # Jobs owned by the scan daemon, if one is running
+        daemon = self._daemon()
+        remote = []
+        if daemon is not None:
+            try:
+                remote = daemon.request("jobs")["jobs"]
+            except DaemonError as e:
+                self.pwarning(f"scan daemon: {e}")
+
+        # Pick up findings saved by finished daemon jobs
+        finished = set([j["machine"] for j in remote if not j["running"]])
+        for m in self.cnxn.machines:
+            if m.name in finished:
+                m.refresh()
+
+        table = [["", "Host", "Service", "Scanner", ">CPU", ">RSS", "Status"]]
+        for ident, job in self.jobs.items():
             style = Style.DIM if job.thread is None else ""
+
+            # Resource usage of the job's live processes
+            pids = [p.pid for p in job.data.get("popens", []) if p.returncode is None]
+            if job.thread is not None and len(pids):
+                cpu, rss = util.process_usage(pids)
+                cpu, rss = f"{cpu:.1f}s", util.human_size(rss)
+            else:
+                cpu, rss = "", ""
+
+            if job.service.protocol == "all":
+                service = job.service.name
+            else:
+                service = (
+                    f"{job.service.port}/{job.service.protocol} ({job.service.name})"
+                )
+
             table.append(
                 [
                     ">" + style + str(ident),
                     job.machine.name,
-                    f"{job.service.port}/{job.service.protocol} ({job.service.name})",
+                    service,
                     job.scanner.name,
+                    cpu,
+                    rss,
                     job.status,
                 ]
             )
 
-        self.ppaged("\n".join(util.build_table(table)))
+        for job in remote:
+            style = "" if job["running"] else Style.DIM
+
+            if job["protocol"] == "all":
+                service = job["service"]
+            else:
+                service = f"{job['port']}/{job['protocol']} ({job['service']})"
+
+            table.append(
+                [
+                    ">" + style + f"@{job['id']}",
+                    job["machine"],
+                    service,
+                    job["scanner"],
+                    "" if job["cpu"] is None else f"{job['cpu']:.1f}s",
+                    "" if job["rss"] is None else util.human_size(job["rss"]),
+                    job["status"],
+                ]
+            )
+
+        output = util.build_table(table)
+
+        # Aggregate progress over every host with jobs
+        jobs = [
+            (j.machine.name, j.thread is not None, j.status)
+            for _, j in self.jobs.items()
+        ] + [(j["machine"], j["running"], j["status"]) for j in remote]
+        if len(jobs):
+            done = len([j for j in jobs if not j[1]])
+            queued = len([j for j in jobs if j[1] and j[2] == "queued"])
+            hosts = len(set([j[0] for j in jobs if j[1]]))
+            output.append("")
+            output.append(
+                f"{len(jobs)-done-queued} running, {queued} queued, {done} finished"
+                f" ({hosts} active host(s))"
+            )
+
+        self.ppaged("\n".join(output))
 
     def _jobs_kill(self, args: argparse.Namespace) -> None:
         """ Stop a running background scanner job """
 
-        # Ensure the job exists
-        if args.job_id < 0 or args.job_id >= len(self.jobs):
-            self.perror(f"{args.job_id}: no such job")
+        # Jobs owned by the scan daemon are stopped through it
+        if args.job_id.startswith("@"):
+            daemon = self._daemon()
+            if daemon is None:
+                self.perror("scan daemon is not running")
+                return
+            try:
+                daemon.request("kill", job=int(args.job_id[1:]))
+            except (DaemonError, ValueError) as e:
+                self.perror(f"{args.job_id}: {e}")
+                return
+            self.poutput(f"killing job {args.job_id}")
             return
 
-        job = self.jobs[args.job_id]
+        job = self._local_job(args.job_id)
+        if job is None:
+            return
         if job.thread is None:
             self.pwarning(f"{args.job_id}: already completed")
             return
@@ -224,6 +351,333 @@ class HackTheBox(Cmd):
         self.poutput(f"killing job {args.job_id}")
         job.stop = True
 
+    def _jobs_tail(self, args: argparse.Namespace) -> None:
+        """ Show recent output of a job and follow it until interrupted """
+
+        # Jobs owned by the scan daemon stream their output over its socket
+        if args.job_id.startswith("@"):
+            daemon = self._daemon()
+            if daemon is None:
+                self.perror("scan daemon is not running")
+                return
+            try:
+                for reply in daemon.stream(
+                    "tail",
+                    job=int(args.job_id[1:]),
+                    lines=args.lines,
+                    follow=args.follow,
+                ):
+                    if "line" in reply:
+                        self.poutput(reply["line"], apply_style=False)
+            except (DaemonError, ValueError) as e:
+                self.perror(f"{args.job_id}: {e}")
+            except KeyboardInterrupt:
+                pass
+            return
+
+        job = self._local_job(args.job_id)
+        if job is None:
+            return
+
+        backlog, events = job.subscribe()
+
+        try:
+            for line in backlog[-args.lines :]:
+                self.poutput(line, apply_style=False)
+
+            while args.follow:
+                try:
+                    line = events.get(timeout=0.5)
+                except queue.Empty:
+                    # Stop following once the job is done and drained
+                    if job.thread is None or not job.thread.is_alive():
+                        break
+                    continue
+                self.poutput(line, apply_style=False)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            job.unsubscribe(events)
+
+    def _local_job(self, job_id: str) -> Optional[Tracker]:
+        """ Find a job owned by this shell """
+
+        try:
+            ident = int(job_id)
+        except ValueError:
+            ident = -1
+
+        job = self.jobs.get(ident)
+        if job is None:
+            self.perror(f"{job_id}: no such job")
+
+        return job
+
+    def _daemon(self) -> Optional[DaemonClient]:
+        """ Client for the scan daemon if one is listening """
+
+        daemon = DaemonClient.from_config(self.config)
+        if not daemon.available():
+            return None
+        return daemon
+
+    def _daemon_job(
+        self, daemon: DaemonClient, m: Machine, request: str, **kwargs
+    ) -> None:
+        """ Hand a job over to the scan daemon """
+
+        try:
+            reply = daemon.request(request, machine=m.name, **kwargs)
+        except DaemonError as e:
+            self.perror(f"{m.name}: {e}")
+            return
+
+        if reply["duplicate"]:
+            self.pwarning(f"{m.name}: already running as job @{reply['job']}")
+        else:
+            self.poutput(f"{m.name}: queued as job @{reply['job']}")
+
+    def _jobs_stats(self, args: argparse.Namespace) -> None:
+        """ Summarize the run logs of analyzed machines by scanner """
+
+        if args.machine is not None:
+            machines = [args.machine]
+        else:
+            machines = [m for m in self.cnxn.machines if m.analysis_path is not None]
+
+        records = []
+        for m in machines:
+            if m.runlog is not None:
+                records.extend(m.runlog)
+
+        if len(records) == 0:
+            self.pwarning("no recorded scanner runs")
+            return
+
+        table = [
+            [
+                "Scanner",
+                ">Runs",
+                ">Failed",
+                ">Cancelled",
+                ">Avg Wall",
+                ">Avg CPU",
+                ">Max RSS",
+                ">Lines",
+                ">Output",
+            ]
+        ]
+        for name, s in sorted(runlog.summarize(records).items()):
+            table.append(
+                [
+                    name,
+                    str(s["runs"]),
+                    str(s["failed"]),
+                    str(s["cancelled"]),
+                    f"{s['wall']/s['runs']:.1f}s",
+                    f"{s['cpu']/s['runs']:.1f}s",
+                    util.human_size(s["max_rss"]),
+                    str(s["lines"]),
+                    util.human_size(s["bytes"]),
+                ]
+            )
+
+        self.ppaged("\n".join(util.build_table(table)))
+
+    query_parser = Cmd2ArgumentParser(
+        description="Search the analysis index of every machine"
+    )
+
+    @cmd2.with_argparser(query_parser)
+    @cmd2.with_category("Management")
+    def do_query(self, args: argparse.Namespace) -> bool:
+        """ Search the analysis index of every machine """
+
+        index = AnalysisIndex.from_config(self.config)
+        if index is None:
+            self.perror("analysis index is not enabled (see the `index` section)")
+            return False
+
+        actions = {
+            "services": self._query_services,
+            "findings": self._query_findings,
+            "scripts": self._query_scripts,
+            "knowns": self._query_knowns,
+            "sql": self._query_sql,
+            "rebuild": self._query_rebuild,
+        }
+
+        try:
+            actions[args.action](index, args)
+        except sqlite3.Error as e:
+            self.perror(f"query failed: {e}")
+
+        return False
+
+    def _query_table(self, header: List[str], rows: List[List[str]]) -> None:
+        """ Show query results, or a warning if there were none """
+
+        if len(rows) == 0:
+            self.pwarning("no matches")
+            return
+
+        output = util.build_table([header] + rows)
+        output.append("")
+        output.append(f"{len(rows)} match(es)")
+
+        self.ppaged("\n".join(output))
+
+    def _query_services(self, index: AnalysisIndex, args: argparse.Namespace) -> None:
+        """ Find services of every machine """
+
+        port, protocol = None, None
+        if args.service is not None:
+            port, _, protocol = args.service.partition("/")
+            port, protocol = int(port), protocol or None
+
+        rows = index.services(
+            name=args.name, port=port, protocol=protocol, product=args.product
+        )
+        self._query_table(
+            ["Machine", "Service", "Name", "State", "Version"],
+            [
+                [
+                    r["machine"],
+                    f"{r['port']}/{r['protocol']}",
+                    r["name"],
+                    r["state"],
+                    " ".join([p for p in [r["product"], r["version"]] if p]),
+                ]
+                for r in rows
+            ],
+        )
+
+    def _query_findings(self, index: AnalysisIndex, args: argparse.Namespace) -> None:
+        """ Find findings of every machine """
+
+        rows = index.findings(
+            kind=args.kind, scanner=args.scanner, value=args.value, port=args.port
+        )
+        self._query_table(
+            ["Machine", "Service", "Scanner", "Kind", "Finding"],
+            [
+                [
+                    r["machine"],
+                    f"{r['port']}/{r['protocol']}" if r["port"] else "",
+                    r["scanner"],
+                    r["kind"],
+                    r["description"],
+                ]
+                for r in rows
+            ],
+        )
+
+    def _query_scripts(self, index: AnalysisIndex, args: argparse.Namespace) -> None:
+        """ Find nmap script output of every machine """
+
+        rows = index.scripts(ident=args.script, output=args.output)
+        self._query_table(
+            ["Machine", "Service", "Script", "Output"],
+            [
+                [
+                    r["machine"],
+                    f"{r['port']}/{r['protocol']}" if r["port"] else "host",
+                    r["id"],
+                    " ".join(r["output"].split())[:80],
+                ]
+                for r in rows
+            ],
+        )
+
+    def _query_knowns(self, index: AnalysisIndex, args: argparse.Namespace) -> None:
+        """ Find known values of every machine """
+
+        rows = index.knowns(name=args.name)
+        self._query_table(
+            ["Machine", "Name", "Value"],
+            [[r["machine"], r["name"], str(r["value"])] for r in rows],
+        )
+
+    def _query_sql(self, index: AnalysisIndex, args: argparse.Namespace) -> None:
+        """ Run a read-only SQL query against the index """
+
+        columns, rows = index.execute(" ".join(args.sql))
+        self._query_table(columns, [[str(v) for v in r] for r in rows])
+
+    def _query_rebuild(self, index: AnalysisIndex, args: argparse.Namespace) -> None:
+        """ Index every analyzed machine from its analysis directory """
+
+        updated = 0
+        for m in self.cnxn.machines:
+            if m.analysis_path is None:
+                continue
+            try:
+                m.load(self.cnxn.analysis_path)
+            except NoAnalysisPath:
+                continue
+            updated += int(index.sync(m, force=True))
+
+        self.poutput(f"indexed {updated} machine(s)")
+
+    search_parser = Cmd2ArgumentParser(
+        description="Search the scan output of every analyzed machine"
+    )
+
+    @cmd2.with_argparser(search_parser)
+    @cmd2.with_category("Management")
+    def do_search(self, args: argparse.Namespace) -> bool:
+        """ Search the scan output of every analyzed machine """
+
+        index = AnalysisIndex.from_config(self.config)
+        if index is None:
+            self.perror("analysis index is not enabled (see the `index` section)")
+            return False
+
+        try:
+            # Pick up output written since the machines were last indexed
+            machines = (
+                [args.machine] if args.machine is not None else self.cnxn.machines
+            )
+            for m in machines:
+                if m.analysis_path is not None:
+                    index.index_scans(m)
+
+            hits = index.search(
+                " ".join(args.terms),
+                machine=None if args.machine is None else args.machine.name,
+                scanner=args.scanner,
+                limit=args.limit,
+                context=args.context,
+                raw=args.raw,
+            )
+        except sqlite3.Error as e:
+            self.perror(f"search failed: {e}")
+            return False
+
+        if len(hits) == 0:
+            self.pwarning("no matches")
+            return False
+
+        base = os.path.expanduser(self.cnxn.analysis_path)
+        output = []
+        for hit in hits:
+            service = f"{hit.port}/{hit.protocol}" if hit.port else ""
+            output.append(
+                f"{Style.BRIGHT}{hit.machine}{Style.RESET_ALL} {hit.scanner} {service} "
+                f"{Style.DIM}{os.path.relpath(hit.path, base)}:{hit.line}{Style.RESET_ALL}"
+            )
+            for number, text in hit.context:
+                text = text.replace(MATCH_START, Style.BRIGHT + Fore.RED).replace(
+                    MATCH_END, Style.RESET_ALL
+                )
+                marker = ">" if number == hit.line else " "
+                output.append(f"{marker}{number:>7}  {text}")
+            output.append("")
+
+        self.ppaged("\n".join(output))
+
+        return False
+
     # Argument parser for `machine` command
     machine_parser = Cmd2ArgumentParser(
         description="View and manage active and retired machines"
@@ -243,6 +697,7 @@ class HackTheBox(Cmd):
             "reset": self._machine_reset,
             "scan": self._machine_scan,
             "enum": self._machine_enum,
+            "findings": self._machine_findings,
         }
         actions[args.action](args)
         return False
@@ -519,10 +974,16 @@ class HackTheBox(Cmd):
         if len(m.services):
             output.append("")
 
-            table = [["Port", "Protocol", "Name", "Version"]]
+            table = [["Port", "Protocol", "State", "Name", "Version"]]
             for service in m.services:
                 table.append(
-                    [f"{service.port}", f"{service.protocol}", service.name, ""]
+                    [
+                        f"{service.port}",
+                        f"{service.protocol}",
+                        service.state,
+                        service.name,
+                        service.describe(),
+                    ]
                 )
 
             output.extend(util.build_table(table))
@@ -558,38 +1019,81 @@ class HackTheBox(Cmd):
         self.pwarning(f"starting {machine.name}")
         machine.spawned = True
 
-        # Ensure the device is up before we scan
-        self.pwarning(f"waiting for machine to respond to ping...")
+        # Probe known services, or common ports if we never enumerated it
+        ports = sorted(
+            set(
+                [
+                    s.port
+                    for s in machine.services
+                    if s.protocol == "tcp" and s.state != "closed"
+                ]
+            )
+        )
+        if len(ports) == 0:
+            ports = portscan.READY_PORTS
+
+        # Ensure services are up before we scan
+        self.pwarning(f"waiting for machine services to respond...")
         try:
-            # Wait for a positive ping response
-            while True:
-                if (
-                    subprocess.call(
-                        ["ping", "-c", "1", machine.ip],
-                        stdout=subprocess.DEVNULL,
-                        stderr=subprocess.DEVNULL,
-                    )
-                    == 0
-                ):
-                    self.psuccess(f"received ping response!")
-                    break
-                time.sleep(5)
+            portscan.wait_ready(
+                machine.ip,
+                ports,
+                report=self.psuccess,
+                settle=self.config.getfloat("enum", "ready_settle", fallback=10.0),
+            )
         except KeyboardInterrupt:
-            self.perror("no ping response received. cancelling enumeration.")
+            self.perror("no response received. cancelling enumeration.")
             return False
-        else:
-            # Give the machine some time to start services after networking comes up
-            self.poutput(f"waiting for services to start...")
-            time.sleep(10)
 
         # Ensure we grab the newest machine status
         self.cnxn.invalidate_cache()
 
         return True
 
+    def _select_machines(self, args: argparse.Namespace) -> Optional[List[Machine]]:
+        """ Resolve the machines selected by a batch capable command. Returns
+        None if no machines were selected. """
+
+        if args.all_spawned:
+            machines = self.cnxn.spawned
+        elif args.regex:
+            pattern = re.compile(args.regex, re.IGNORECASE)
+            machines = [m for m in self.cnxn.machines if pattern.search(m.name)]
+        elif len(args.machine):
+            machines = args.machine
+        elif self.cnxn.assigned is not None:
+            machines = [self.cnxn.assigned]
+        else:
+            self.perror("no currently assigned machine")
+            return None
+
+        if len(machines) == 0:
+            self.perror("no matching machines found")
+            return None
+
+        return machines
+
+    def _batch_job(self, tracker: Tracker) -> int:
+        """ Hand a scheduled tracker over to the `jobs` command and return its
+        job ID """
+
+        ident = self.jobs.add(tracker)
+        tracker.lock.release()
+
+        return ident
+
     def _machine_enum(self, args: argparse.Namespace) -> None:
         """ Perform initial service enumeration """
 
+        machines = self._select_machines(args)
+        if machines is None:
+            return
+        elif len(machines) > 1 or args.all_spawned or args.regex:
+            self._machine_enum_batch(machines, args)
+            return
+
+        args.machine = machines[0]
+
         if not args.machine.spawned:
             if self.cnxn.assigned is not None:
                 # We can't assign this machine, if we already have a machine assigned.
@@ -612,10 +1116,12 @@ class HackTheBox(Cmd):
                 self.perror("failed to add host to /etc/hosts")
                 return
 
-        if len(args.machine.services) == 0 or args.force:
+        if len(args.machine.services) == 0 or args.force or args.incremental:
             self.poutput("enumerating machine services")
             try:
-                args.machine.enumerate()
+                args.machine.enumerate(
+                    force=args.force, report=self.poutput, incremental=args.incremental,
+                )
             except MasscanFailed:
                 self.perror("masscan failed")
             except NmapFailed:
@@ -625,11 +1131,57 @@ class HackTheBox(Cmd):
                 f"{args.machine.name} already enumerated ({len(args.machine.services)} service(s) detected)"
             )
 
+    def _machine_enum_batch(self, machines: List[Machine], args: argparse.Namespace):
+        """ Enumerate many running machines as scheduled background jobs """
+
+        daemon = self._daemon()
+
+        for m in machines:
+            if not m.spawned:
+                self.pwarning(f"{m.name}: not running; skipping")
+                continue
+
+            if m.analysis_path is None:
+                try:
+                    m.init(self.cnxn.analysis_path)
+                except EtcHostsFailed:
+                    self.perror(f"{m.name}: failed to add host to /etc/hosts")
+                    continue
+
+            if len(m.services) and not args.force and not args.incremental:
+                self.poutput(
+                    f"{m.name} already enumerated ({len(m.services)} service(s) detected)"
+                )
+                continue
+
+            if daemon is not None:
+                self._daemon_job(
+                    daemon, m, "enum", force=args.force, incremental=args.incremental
+                )
+                continue
+
+            scanner = EnumerationScanner(force=args.force, incremental=args.incremental)
+            tracker = m.scan(
+                scanner,
+                EnumerationScanner.service(m),
+                silent=True,
+                scheduler=self.scheduler,
+            )
+            ident = self._batch_job(tracker)
+            self.poutput(f"{m.name}: enumeration queued as job {ident}")
+
     def _machine_scan(self, args: argparse.Namespace) -> None:
         """ Scan the open service for the given machine """
 
+        machines = self._select_machines(args)
+        if machines is None:
+            return
+        elif len(machines) > 1 or args.all_spawned or args.regex:
+            self._machine_scan_batch(machines, args)
+            return
+
         # args.machine shorthand
-        m = args.machine
+        m = args.machine = machines[0]
 
         if not m.spawned:
             if self.cnxn.assigned is not None:
@@ -640,13 +1192,6 @@ class HackTheBox(Cmd):
             elif not self.wait_for_machine(m):
                 return
 
-        if args.recommended:
-            scanners = [s for s in AVAILABLE_SCANNERS if s.recommended and s.match(m)]
-        elif args.scanner:
-            scanners = [s for s in AVAILABLE_SCANNERS if s.name == args.scanner]
-        else:
-            scanners = [s for s in AVAILABLE_SCANNERS if s.match(m)]
-
         if args.service:
             port = int(args.service.split("/")[0])
             protocol = args.service.split("/")[1]
@@ -660,48 +1205,117 @@ class HackTheBox(Cmd):
             self.perror("no matching services found")
             return
 
-        # Get scanners that match a service specified/present
+        # Find every applicable scanner for every service in a single pass
+        pairs = AVAILABLE_SCANNERS.index().pairs(services)
         if args.recommended:
-            scanners = [
-                s
-                for s in scanners
-                if s.recommended and any([s.match_service(svc) for svc in services])
-            ]
+            pairs = [(s, svc) for s, svc in pairs if s.recommended]
         elif args.scanner:
-            scanners = [
-                s
-                for s in scanners
-                if s.name == args.scanner
-                and any([s.match_service(svc) for svc in services])
-            ]
-        else:
-            scanners = [
-                s for s in scanners if any([s.match_service(svc) for svc in services])
-            ]
+            pairs = [(s, svc) for s, svc in pairs if s.name == args.scanner]
 
-        if len(scanners) == 0:
+        if len(pairs) == 0:
             self.perror(f"no matching scanners found")
             return
 
-        # Iterate over all scanners and services to run the correct scans
-        for service in services:
-            for scanner in scanners:
-                if not scanner.match_service(service):
-                    continue
+        # Background scans belong to the scan daemon when one is running
+        daemon = self._daemon() if args.background else None
 
-                self.poutput(
-                    f"beginning {scanner.name} scan on {service.port}/{service.protocol} ({service.name})"
+        # Run the matched scans in service order
+        for scanner, service in pairs:
+            self.poutput(
+                f"beginning {scanner.name} scan on {service.port}/{service.protocol} ({service.name})"
+            )
+            if daemon is not None:
+                self._daemon_job(
+                    daemon,
+                    m,
+                    "scan",
+                    scanner=scanner.name,
+                    port=service.port,
+                    protocol=service.protocol,
                 )
-                tracker = m.scan(scanner, service, silent=args.background)
-                if args.background:
-                    # Transfer control of the scan to the `jobs` command
-                    tracker.events = self.job_events
-                    tracker.lock.release()
-                    self.jobs.append(tracker)
-                else:
-                    # Monitor the scan progress in the forground, and give
-                    # options to cancel or background the scan
-                    self.monitor_scan(tracker)
+            elif args.background:
+                # Transfer control of the scan to the `jobs` command
+                tracker = m.scan(
+                    scanner, service, silent=True, scheduler=self.scheduler
+                )
+                self._batch_job(tracker)
+            else:
+                # Monitor the scan progress in the forground, and give
+                # options to cancel or background the scan
+                tracker = m.scan(scanner, service, silent=False)
+                self.monitor_scan(tracker)
+
+    def _machine_scan_batch(self, machines: List[Machine], args: argparse.Namespace):
+        """ Start the matching scans of many machines as scheduled jobs """
+
+        index = AVAILABLE_SCANNERS.index()
+        daemon = self._daemon()
+
+        for m in machines:
+            if not m.spawned:
+                self.pwarning(f"{m.name}: not running; skipping")
+                continue
+
+            if len(m.services) == 0:
+                self.pwarning(f"{m.name}: not enumerated; skipping")
+                continue
+
+            services = m.services
+            if args.service:
+                port, protocol = args.service.split("/")
+                services = [
+                    s
+                    for s in services
+                    if s.port == int(port) and s.protocol == protocol
+                ]
+
+            pairs = index.pairs(services)
+            if args.recommended:
+                pairs = [(s, svc) for s, svc in pairs if s.recommended]
+            elif args.scanner:
+                pairs = [(s, svc) for s, svc in pairs if s.name == args.scanner]
+
+            if daemon is not None:
+                for scanner, service in pairs:
+                    self._daemon_job(
+                        daemon,
+                        m,
+                        "scan",
+                        scanner=scanner.name,
+                        port=service.port,
+                        protocol=service.protocol,
+                    )
+                continue
+
+            for scanner, service in pairs:
+                tracker = m.scan(
+                    scanner, service, silent=True, scheduler=self.scheduler
+                )
+                self._batch_job(tracker)
+
+            self.poutput(f"{m.name}: {len(pairs)} scan(s) queued")
+
+    def _machine_findings(self, args: argparse.Namespace) -> None:
+        """ Show structured scanner findings for the given machine """
+
+        findings = args.machine.findings.query(kind=args.kind, scanner=args.scanner)
+
+        if len(findings) == 0:
+            self.poutput(f"{args.machine.name}: no matching findings")
+            return
+
+        table = [["Service", "Scanner", "Kind", "Finding"]]
+        for finding in findings:
+            table.append(
+                [
+                    f"{finding.port}/{finding.protocol}" if finding.port else "",
+                    finding.scanner,
+                    finding.KIND,
+                    finding.describe(),
+                ]
+            )
+
+        self.ppaged("\n".join(util.build_table(table)))
 
     def monitor_scan(self, tracker: Tracker) -> None:
         """ Monitor a foreground scan """
@@ -741,8 +1355,7 @@ class HackTheBox(Cmd):
                     f"backgrounding {tracker.scanner.name} for {tracker.service.port}/{tracker.service.protocol}"
                 )
                 tracker.silent = True
-                tracker.events = self.job_events
-                self.jobs.append(tracker)
+                self.jobs.add(tracker)
 
     # Argument parser for `machine` command
     lab_parser = Cmd2ArgumentParser(description="View and manage lab VPN connection")
@@ -1048,6 +1661,26 @@ def ArgparseMachineType(arg: str) -> Machine:
     return m
 
 
+def ArgparseCountType(arg: str) -> int:
+    """ A count of at least one
+
+    :param arg: The argument passed at the command line
+    :type arg: str
+    :return: The count or raises invalid argument error
+    :raises: argparse.ArgumentTypeError
+    """
+
+    try:
+        count = int(arg)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{arg}: not a number")
+
+    if count < 1:
+        raise argparse.ArgumentTypeError(f"{arg}: must be at least 1")
+
+    return count
+
+
 def main():
 
     if "HTBRC" in os.environ:
@@ -1068,7 +1701,9 @@ def main():
         description="Stop a running background scanner job",
         prog="jobs kill",
     )
-    jobs_kill_parser.add_argument("job_id", type=int, help="Kill the identified job")
+    jobs_kill_parser.add_argument(
+        "job_id", help="Kill the identified job (@N for scan daemon jobs)"
+    )
     jobs_kill_parser.set_defaults(action="kill")
 
     # "job list" parser
@@ -1080,6 +1715,159 @@ def main():
     )
     jobs_list_parser.set_defaults(action="list")
 
+    # "job tail" parser
+    jobs_tail_parser = jobs_subparsers.add_parser(
+        "tail",
+        aliases=["attach"],
+        description="Show recent output of a job and follow it until interrupted",
+        prog="jobs tail",
+    )
+    jobs_tail_parser.add_argument(
+        "job_id", help="Follow the identified job (@N for scan daemon jobs)"
+    )
+    jobs_tail_parser.add_argument(
+        "--lines",
+        "-n",
+        type=ArgparseCountType,
+        default=20,
+        help="Number of buffered lines to show first",
+    )
+    jobs_tail_parser.add_argument(
+        "--no-follow",
+        "-N",
+        action="store_false",
+        dest="follow",
+        help="Show buffered output and return immediately",
+    )
+    jobs_tail_parser.set_defaults(action="tail")
+
+    # "jobs stats" argument parser
+    jobs_stats_parser = jobs_subparsers.add_parser(
+        "stats",
+        description="Summarize recorded scanner runs by scanner",
+        prog="jobs stats",
+    )
+    jobs_stats_parser.add_argument(
+        "machine",
+        nargs="?",
+        help="Only summarize runs against this machine (default: all analyzed)",
+        default=None,
+        type=ArgparseMachineType,
+        choices_method=complete_machine,
+        descriptive_header=MACHINE_DESCRIPTION,
+    )
+    jobs_stats_parser.set_defaults(action="stats")
+
+    # "query" argument parser
+    query_subparsers = HackTheBox.query_parser.add_subparsers(
+        help="Actions", dest="_action", required=True
+    )
+
+    # "query services" parser
+    query_services_parser = query_subparsers.add_parser(
+        "services",
+        description="Find services of every analyzed machine",
+        prog="query services",
+    )
+    query_services_parser.add_argument(
+        "--name", "-n", help="Service name (e.g. microsoft-ds, or a glob)"
+    )
+    query_services_parser.add_argument(
+        "--service", "-s", help="Port and optional protocol (e.g. 445/tcp)"
+    )
+    query_services_parser.add_argument(
+        "--product", "-p", help="Product name (e.g. 'Apache*')"
+    )
+    query_services_parser.set_defaults(action="services")
+
+    # "query findings" parser
+    query_findings_parser = query_subparsers.add_parser(
+        "findings",
+        description="Find scanner findings of every analyzed machine",
+        prog="query findings",
+    )
+    query_findings_parser.add_argument(
+        "value",
+        nargs="?",
+        help="Path, name or other identifying value of the finding (or a glob)",
+    )
+    query_findings_parser.add_argument(
+        "--kind", "-k", help="Kind of finding (e.g. webpath, smbshare, known)"
+    )
+    query_findings_parser.add_argument(
+        "--scanner", "-s", help="Scanner which reported the finding"
+    )
+    query_findings_parser.add_argument(
+        "--port", "-p", type=int, help="Port the finding was reported for"
+    )
+    query_findings_parser.set_defaults(action="findings")
+
+    # "query scripts" parser
+    query_scripts_parser = query_subparsers.add_parser(
+        "scripts",
+        description="Find nmap script output of every analyzed machine",
+        prog="query scripts",
+    )
+    query_scripts_parser.add_argument(
+        "script", nargs="?", help="Script name (e.g. smb2-security-mode)"
+    )
+    query_scripts_parser.add_argument(
+        "--output", "-o", help="Glob matched against the whole output"
+    )
+    query_scripts_parser.set_defaults(action="scripts")
+
+    # "query knowns" parser
+    query_knowns_parser = query_subparsers.add_parser(
+        "knowns",
+        description="List known values of every analyzed machine",
+        prog="query knowns",
+    )
+    query_knowns_parser.add_argument("name", nargs="?", help="Name (or a glob)")
+    query_knowns_parser.set_defaults(action="knowns")
+
+    # "query sql" parser
+    query_sql_parser = query_subparsers.add_parser(
+        "sql",
+        description="Run a read-only SQL query against the analysis index",
+        prog="query sql",
+    )
+    query_sql_parser.add_argument("sql", nargs="+", help="SQL query")
+    query_sql_parser.set_defaults(action="sql")
+
+    # "query rebuild" parser
+    query_rebuild_parser = query_subparsers.add_parser(
+        "rebuild",
+        description="Index every analyzed machine from its analysis directory",
+        prog="query rebuild",
+    )
+    query_rebuild_parser.set_defaults(action="rebuild")
+
+    # "search" argument parser
+    HackTheBox.search_parser.add_argument("terms", nargs="+", help="Text to search for")
+    HackTheBox.search_parser.add_argument(
+        "--machine",
+        "-m",
+        type=ArgparseMachineType,
+        choices_method=complete_machine,
+        descriptive_header=MACHINE_DESCRIPTION,
+        help="Only search the output of this machine",
+    )
+    HackTheBox.search_parser.add_argument(
+        "--scanner", "-s", help="Only search the output of this scanner"
+    )
+    HackTheBox.search_parser.add_argument(
+        "--limit", "-n", type=int, default=20, help="Number of hits to show"
+    )
+    HackTheBox.search_parser.add_argument(
+        "--context", "-C", type=int, default=1, help="Lines of context to show"
+    )
+    HackTheBox.search_parser.add_argument(
+        "--raw",
+        "-r",
+        action="store_true",
+        help="Use FTS5 query syntax (e.g. 'admin OR login') instead of a phrase",
+    )
+
     # "machine" argument parser
     HackTheBox.machine_parser.set_defaults(
         action="list", state="all", owned="all", todo=None
@@ -1250,11 +2038,28 @@ def main():
     machine_enum_parser.add_argument(
         "--force", "-f", action="store_true", help="Force re-enumeration", default=False
     )
+    machine_enum_parser.add_argument(
+        "--incremental",
+        "-i",
+        action="store_true",
+        help="Only fingerprint new ports and mark missing ports closed",
+        default=False,
+    )
+    machine_enum_parser.add_argument(
+        "--all-spawned",
+        "-A",
+        action="store_true",
+        help="Select every running machine",
+        default=False,
+    )
+    machine_enum_parser.add_argument(
+        "--regex", "-x", help="Select every machine whose name matches this regex",
+    )
     machine_enum_parser.add_argument(
         "machine",
-        nargs="?",
-        help="A name regex, IP address or machine ID to start (default: assigned)",
-        default=HackTheBox.ASSIGNED,
+        nargs="*",
+        help="Name regexes, IP addresses or machine IDs (default: assigned)",
+        default=[],
         type=ArgparseMachineType,
         choices_method=complete_machine,
         descriptive_header=MACHINE_DESCRIPTION,
@@ -1286,15 +2091,52 @@ def main():
         default=False,
     )
     machine_scan_parser.add_argument(
+        "--all-spawned",
+        "-A",
+        action="store_true",
+        help="Select every running machine",
+        default=False,
+    )
+    machine_scan_parser.add_argument(
+        "--regex", "-x", help="Select every machine whose name matches this regex",
+    )
+    machine_scan_parser.add_argument(
+        "machine",
+        nargs="*",
+        help="Name regexes, IP addresses or machine IDs (default: assigned)",
+        default=[],
+        type=ArgparseMachineType,
+        choices_method=complete_machine,
+        descriptive_header=MACHINE_DESCRIPTION,
+    )
+    machine_scan_parser.set_defaults(action="scan")
+
+    # "machine findings" argument parser
+    machine_findings_parser = machine_subparsers.add_parser(
+        "findings",
+        aliases=["results"],
+        help="Show structured results collected by scanners",
+        prog="machine findings",
+    )
+    machine_findings_parser.add_argument(
+        "--kind",
+        "-k",
+        choices=[k for k in Finding.KINDS],
+        help="Only show findings of this kind",
+    )
+    machine_findings_parser.add_argument(
+        "--scanner", "-s", help="Only show findings from this scanner"
+    )
+    machine_findings_parser.add_argument(
         "machine",
         nargs="?",
-        help="A name regex, IP address or machine ID to start (default: assigned)",
+        help="A name regex, IP address or machine ID (default: assigned)",
         default=HackTheBox.ASSIGNED,
         type=ArgparseMachineType,
         choices_method=complete_machine,
         descriptive_header=MACHINE_DESCRIPTION,
     )
-    machine_scan_parser.set_defaults(action="scan")
+    machine_findings_parser.set_defaults(action="findings")
 
     # "lab" argument parser setup
     HackTheBox.lab_parser.set_defaults(action="status")
@@ -1377,7 +2219,7 @@ def main():
             sys.exit(1)
         except RequestFailed as r:
             cmd.perror(f"request failed: {r}")
-        if len([j for j in cmd.jobs if j.thread is not None]):
+        if len(cmd.jobs.running()):
             cmd.pwarning("background jobs active. staring interpreter...")
             result = cmd.cmdloop()
         else:
@@ -1386,25 +2228,22 @@ def main():
         result = cmd.cmdloop()
 
     try:
-        if len([j for j in cmd.jobs if j.thread is not None]):
+        if len(cmd.jobs.running()):
             cmd.poutput("waiting for background jobs to complete")
-        while len([j for j in cmd.jobs if j.thread is not None]):
-            tracker = cmd.job_events.get()
-            tracker.status = "completed"
-            tracker.thread = None
+        # Wake up periodically so an interrupt is noticed
+        while not cmd.jobs.wait(timeout=0.5):
+            pass
     except KeyboardInterrupt:
         cmd.pwarning("cancelling background jobs")
-        for j in cmd.jobs:
+        for j in cmd.jobs.running():
             j.stop = True
 
         try:
-            while len([j for j in cmd.jobs if j.thread is not None]):
-                tracker = cmd.job_events.get()
-                tracker.status = "completed"
-                tracker.thread = None
+            while not cmd.jobs.wait(timeout=0.5):
+                pass
         except KeyboardInterrupt:
             cmd.pwarning("forcing background job exit!")
-            for j in [j for j in cmd.jobs if j.thread is not None]:
+            for j in cmd.jobs.running():
                 j.thread.daemon = True
 
     cmd.config["htb"]["session"] = cmd.cnxn.session.cookies.get(
@@ -1413,7 +2252,12 @@ def main():
     with open(os.path.expanduser(config), "w") as f:
         cmd.config.write(f)
 
+    if cmd.watcher is not None:
+        cmd.watcher.stop()
+
     for m in cmd.cnxn.machines:
+        # Keep findings saved by the scan daemon in the meantime
+        m.refresh()
         m.dump()
 
 
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+from typing import Any, Dict, Optional, Generator, Tuple
+from configparser import ConfigParser
+import socketserver
+import threading
+import socket
+import signal
+import queue
+import json
+import sys
+import os
+import re
+
+from htb import util
+from htb.connection import Connection
+from htb.machine import Machine
+from htb.scanner import Tracker, Service, AVAILABLE_SCANNERS
+from htb.scanner.enumeration import EnumerationScanner
+from htb.scheduler import Scheduler
+from htb.jobs import JobTable
+from htb.exceptions import *
+
+
+def socket_path(config: ConfigParser) -> str:
+    """ Location of the daemon socket. This is the `socket` option of the
+    `daemon` section, or `.htbd.sock` in the analysis directory so that every
+    shell sharing an analysis directory shares one daemon. """
+
+    path = config.get("daemon", "socket", fallback=None)
+    if path is None:
+        path = os.path.join(
+            config.get("htb", "analysis_path", fallback="~/htb"), ".htbd.sock"
+        )
+
+    return os.path.expanduser(path)
+
+
+class ScanDaemon(object):
+    """ Runs background scans on behalf of any number of REPL instances. The
+    daemon owns the scheduler and every scanner process, so jobs keep running
+    when a REPL exits. Clients send one JSON object per line over a UNIX socket
+    and receive one JSON object per line in reply:
+
+        {"command": "scan", "machine": "mango", "port": 80, "protocol": "tcp",
+         "scanner": "gobuster"}
+        {"job": 0, "duplicate": false}
+
+    Errors are reported as {"error": "message"}. A scan or enumeration which
+    is already queued or running is not started again, the existing job is
+    returned instead. """
+
+    def __init__(self, connection: Connection, path: str, scheduler: Scheduler):
+        self.cnxn: Connection = connection
+        self.path: str = path
+        self.scheduler: Scheduler = scheduler
+        self.jobs: JobTable = JobTable.from_config(
+            connection.config, finished=self._finished
+        )
+        self.lock = threading.Lock()
+        self.server: Optional[socketserver.UnixStreamServer] = None
+
+    def serve(self) -> None:
+        """ Listen for clients until `shutdown` is called """
+
+        # Remove a socket left behind by a daemon which died
+        if os.path.exists(self.path):
+            if DaemonClient(self.path).available():
+                raise DaemonError(f"{self.path}: daemon already running")
+            os.unlink(self.path)
+
+        daemon = self
+
+        class Handler(socketserver.StreamRequestHandler):
+            def reply(self, reply: Dict[str, Any]) -> None:
+                self.wfile.write(json.dumps(reply).encode("utf-8") + b"\n")
+                self.wfile.flush()
+
+            def handle(self):
+                for line in self.rfile:
+                    try:
+                        request = json.loads(line)
+                        for reply in daemon.handle(request):
+                            self.reply(reply)
+                        continue
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    except (ValueError, TypeError, KeyError) as e:
+                        error = f"bad request: {e}"
+                    except Exception as e:
+                        # e.g. NotApplicable from a scan or OSError while loading
+                        # a machine. The client is told instead of left waiting.
+                        error = str(e) or type(e).__name__
+
+                    try:
+                        self.reply({"error": error})
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+
+        self.server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        self.server.daemon_threads = True
+
+        # Everyone in our group may use the daemon
+        os.chmod(self.path, 0o660)
+
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+    def shutdown(self) -> None:
+        """ Stop listening for clients. Jobs are left running. """
+
+        if self.server is not None:
+            self.server.shutdown()
+
+    def stop(self) -> None:
+        """ Cancel every job and wait for them to exit """
+
+        for job in self.jobs.running():
+            job.stop = True
+
+        self.jobs.wait()
+
+    def _finished(self, tracker: Tracker) -> None:
+        """ Save what a finished job found """
+
+        m = tracker.machine
+
+        # Another process may have saved findings since we loaded them. Saved
+        # services only replace ours unless other scans are using them.
+        busy = any([j.machine is m for j in self.jobs.running()])
+        m.refresh(services=not busy)
+        m.dump()
+
+    def machine(self, name: str) -> Machine:
+        """ Look up an initialized machine by name """
+
+        try:
+            m = self.cnxn[f"^{re.escape(name)}$"]
+        except KeyError:
+            raise DaemonError(f"{name}: no such machine")
+
+        # Pick up services enumerated elsewhere unless scans are using them
+        busy = any([j.machine is m for j in self.jobs.running()])
+
+        if not busy:
+            try:
+                m.load(self.cnxn.analysis_path)
+            except NoAnalysisPath:
+                raise DaemonError(f"{name}: not initialized")
+
+        return m
+
+    def start(self, machine: Machine, scanner, service: Service) -> Tuple[int, bool]:
+        """ Start a scheduled job unless the same job is already queued or
+        running. Returns the job ID and whether it was a duplicate. """
+
+        key = (machine.name, scanner.name, service.port, service.protocol)
+
+        with self.lock:
+            for ident, job in self.jobs.items():
+                if job.thread is not None and key == (
+                    job.machine.name,
+                    job.scanner.name,
+                    job.service.port,
+                    job.service.protocol,
+                ):
+                    return ident, True
+
+            tracker = machine.scan(
+                scanner, service, silent=True, scheduler=self.scheduler
+            )
+            ident = self.jobs.add(tracker)
+            tracker.lock.release()
+
+            return ident, False
+
+    def job(self, ident: int) -> Tracker:
+        job = self.jobs.get(ident)
+        if job is None:
+            raise DaemonError(f"{ident}: no such job")
+        return job
+
+    def describe(self, ident: int, job: Tracker) -> Dict[str, Any]:
+        """ Summary of a job sent to clients """
+
+        running = job.thread is not None
+        pids = [p.pid for p in job.data.get("popens", []) if p.returncode is None]
+        if running and len(pids):
+            cpu, rss = util.process_usage(pids)
+        else:
+            cpu, rss = None, None
+
+        return {
+            "id": ident,
+            "machine": job.machine.name,
+            "port": job.service.port,
+            "protocol": job.service.protocol,
+            "service": job.service.name,
+            "scanner": job.scanner.name,
+            "status": job.status,
+            "running": running,
+            "cpu": cpu,
+            "rss": rss,
+        }
+
+    def handle(self, request: Dict[str, Any]) -> Generator[Dict[str, Any], None, None]:
+        """ Process a client request and generate the replies """
+
+        command = request["command"]
+
+        try:
+            if command == "ping":
+                yield {"pid": os.getpid(), "jobs": len(self.jobs)}
+            elif command == "jobs":
+                jobs = self.jobs.items()
+                yield {"jobs": [self.describe(ident, job) for ident, job in jobs]}
+            elif command == "scan":
+                m = self.machine(request["machine"])
+                scanner = AVAILABLE_SCANNERS.get(request["scanner"])
+                if scanner is None:
+                    raise DaemonError(f"{request['scanner']}: no such scanner")
+                services = [
+                    s
+                    for s in m.services
+                    if s.port == request["port"] and s.protocol == request["protocol"]
+                ]
+                if len(services) == 0 or not scanner.match_service(services[0]):
+                    raise DaemonError(
+                        f"{request['port']}/{request['protocol']}: no matching service"
+                    )
+                ident, duplicate = self.start(m, scanner, services[0])
+                yield {"job": ident, "duplicate": duplicate}
+            elif command == "enum":
+                m = self.machine(request["machine"])
+                scanner = EnumerationScanner(
+                    force=request.get("force", False),
+                    incremental=request.get("incremental", False),
+                )
+                ident, duplicate = self.start(m, scanner, EnumerationScanner.service(m))
+                yield {"job": ident, "duplicate": duplicate}
+            elif command == "kill":
+                job = self.job(request["job"])
+                if job.thread is None:
+                    raise DaemonError(f"{request['job']}: already completed")
+                job.stop = True
+                yield {"job": request["job"]}
+            elif command == "tail":
+                yield from self.tail(
+                    self.job(request["job"]),
+                    request.get("lines", 10),
+                    request.get("follow", False),
+                )
+            else:
+                raise DaemonError(f"{command}: unknown command")
+        except DaemonError as e:
+            yield {"error": str(e)}
+
+    def tail(
+        self, job: Tracker, lines: int, follow: bool
+    ) -> Generator[Dict[str, Any], None, None]:
+        """ Send recent output of a job, then follow it until it finishes """
+
+        backlog, events = job.subscribe()
+
+        try:
+            for line in backlog[-lines:] if lines > 0 else []:
+                yield {"line": line}
+
+            while follow:
+                try:
+                    line = events.get(timeout=0.5)
+                except queue.Empty:
+                    if job.thread is None or not job.thread.is_alive():
+                        break
+                    continue
+                yield {"line": line}
+        finally:
+            job.unsubscribe(events)
+
+        yield {"done": True}
+
+
+class DaemonClient(object):
+    """ Talks to a scan daemon over its UNIX socket """
+
+    def __init__(self, path: str, timeout: float = 5.0):
+        self.path: str = path
+        self.timeout: float = timeout
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "DaemonClient":
+        return DaemonClient(socket_path(config))
+
+    def _connect(self) -> socket.socket:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise DaemonError(f"{self.path}: {e.strerror or e}")
+        return sock
+
+    def available(self) -> bool:
+        """ Whether a daemon is listening on the socket """
+
+        if not os.path.exists(self.path):
+            return False
+
+        try:
+            self.request("ping")
+        except DaemonError:
+            return False
+
+        return True
+
+    def stream(self, command: str, **kwargs) -> Generator[Dict[str, Any], None, None]:
+        """ Send a request and generate every reply until the connection
+        closes. Streaming replies are read without a timeout. """
+
+        sock = self._connect()
+
+        try:
+            request = dict(kwargs, command=command)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            sock.shutdown(socket.SHUT_WR)
+            sock.settimeout(None)
+
+            with sock.makefile("rb") as fh:
+                for line in fh:
+                    reply = json.loads(line)
+                    if "error" in reply:
+                        raise DaemonError(reply["error"])
+                    yield reply
+        except OSError as e:
+            raise DaemonError(f"{self.path}: {e.strerror or e}")
+        finally:
+            sock.close()
+
+    def request(self, command: str, **kwargs) -> Dict[str, Any]:
+        """ Send a request and return the single reply """
+
+        sock = self._connect()
+
+        try:
+            request = dict(kwargs, command=command)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as fh:
+                line = fh.readline()
+        except OSError as e:
+            raise DaemonError(f"{self.path}: {e.strerror or e}")
+        finally:
+            sock.close()
+
+        if not line:
+            raise DaemonError(f"{self.path}: no reply")
+
+        reply = json.loads(line)
+        if "error" in reply:
+            raise DaemonError(reply["error"])
+
+        return reply
+
+
+def main():
+    """ Run the scan daemon in the foreground. Interrupting it cancels every
+    running job. """
+
+    config_path = os.path.expanduser(os.environ.get("HTBRC", "~/.htbrc"))
+    if not os.path.isfile(config_path):
+        print(f"{config_path}: no such file or directory", file=sys.stderr)
+        sys.exit(1)
+
+    config = ConfigParser(interpolation=None)
+    config.read(config_path)
+
+    AVAILABLE_SCANNERS.configure(config)
+
+    cnxn = Connection(
+        api_token=config["htb"]["api_token"],
+        email=config["htb"].get("email", None),
+        password=config["htb"].get("password", None),
+        existing_session=config["htb"].get("session", None),
+        analysis_path=config["htb"].get("analysis_path", "~/htb"),
+        config=config,
+    )
+
+    daemon = ScanDaemon(cnxn, socket_path(config), Scheduler.from_config(config))
+
+    # Treat termination like an interrupt so jobs are cleaned up
+    def terminate(signo, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, terminate)
+
+    print(f"listening on {daemon.path}")
+
+    try:
+        daemon.serve()
+    except DaemonError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    except KeyboardInterrupt:
+        print("cancelling jobs")
+        daemon.stop()
+
+
+if __name__ == "__main__":
+    main()
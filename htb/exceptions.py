@@ -77,3 +77,15 @@ class NmapFailed(Exception):
     """ Nmap attempt failed """
 
     pass
+
+
+class Cancelled(Exception):
+    """ The operation was cancelled by the user """
+
+    pass
+
+
+class DaemonError(Exception):
+    """ The scan daemon could not be reached or rejected a request """
+
+    pass
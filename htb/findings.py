@@ -0,0 +1,251 @@
+#!/usr/bin/env python3
+from typing import Dict, Any, List, Tuple, Iterator, Optional, ClassVar, Union, Callable
+from dataclasses import dataclass, fields
+import threading
+
+
+@dataclass
+class Finding(object):
+    """ A single structured result produced by a scanner. Subclasses define a
+    unique `KIND` and the fields which describe the result. """
+
+    scanner: str
+    port: int
+    protocol: str
+
+    KIND: ClassVar[str] = "finding"
+    KINDS: ClassVar[Dict[str, type]] = {}
+
+    # Fields which uniquely identify a finding of this kind on a service
+    IDENTITY: ClassVar[Tuple[str, ...]] = ()
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        Finding.KINDS[cls.KIND] = cls
+
+    def key(self) -> Tuple:
+        """ Identity of this finding. Adding a finding with the same key to a
+        store replaces the previous one. """
+        return (self.KIND, self.scanner, self.port, self.protocol) + tuple(
+            getattr(self, f) for f in self.IDENTITY
+        )
+
+    def describe(self) -> str:
+        """ Short human readable description """
+        return ", ".join(
+            f"{f.name}={getattr(self, f.name)}"
+            for f in fields(self)
+            if f.name not in ("scanner", "port", "protocol")
+        )
+
+    def json(self) -> Dict[str, Any]:
+        """ Converts this object to a dictionary appropriate for JSON output """
+        # Fields hold plain values, so there is no need for a deep copy
+        return {
+            "kind": self.KIND,
+            **{f.name: getattr(self, f.name) for f in fields(self)},
+        }
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "Finding":
+        data = dict(data)
+        kind = Finding.KINDS[data.pop("kind")]
+        return kind(**data)
+
+
+@dataclass
+class WebPath(Finding):
+    """ A path discovered on a web server """
+
+    path: str
+    status: int
+    size: Optional[int] = None
+
+    KIND: ClassVar[str] = "webpath"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("path",)
+
+    def describe(self) -> str:
+        size = "" if self.size is None else f" [{self.size} bytes]"
+        return f"{self.path} ({self.status}){size}"
+
+
+@dataclass
+class NiktoFinding(Finding):
+    """ An issue reported by nikto """
+
+    osvdb: Optional[int]
+    path: Optional[str]
+    message: str
+
+    KIND: ClassVar[str] = "nikto"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("osvdb", "path", "message")
+
+    def describe(self) -> str:
+        osvdb = "" if self.osvdb is None else f"OSVDB-{self.osvdb} "
+        return f"{osvdb}{self.path or ''}: {self.message}"
+
+
+@dataclass
+class SmbUser(Finding):
+    """ A user enumerated over SMB/RPC """
+
+    name: str
+    rid: Optional[str] = None
+
+    KIND: ClassVar[str] = "smb-user"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("name",)
+
+
+@dataclass
+class SmbGroup(Finding):
+    """ A group enumerated over SMB/RPC """
+
+    name: str
+    rid: Optional[str] = None
+
+    KIND: ClassVar[str] = "smb-group"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("name",)
+
+
+@dataclass
+class SmbShare(Finding):
+    """ A share enumerated over SMB """
+
+    name: str
+    type: str = ""
+    comment: str = ""
+
+    KIND: ClassVar[str] = "smb-share"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("name",)
+
+
+@dataclass
+class Known(Finding):
+    """ A free-form named value recorded during analysis (e.g. credentials) """
+
+    name: str
+    value: Any = None
+
+    KIND: ClassVar[str] = "known"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("name",)
+
+
+@dataclass
+class HostScript(Finding):
+    """ Output of an nmap host script (e.g. smb2-security-mode), which reports
+    on the machine rather than on one of its ports """
+
+    id: str
+    output: str = ""
+
+    KIND: ClassVar[str] = "hostscript"
+    IDENTITY: ClassVar[Tuple[str, ...]] = ("id",)
+
+    def describe(self) -> str:
+        return f"{self.id}: {' '.join(self.output.split())}"
+
+
+class FindingStore(object):
+    """ Thread-safe collection of findings for a machine. Findings are indexed
+    by kind, scanner and service so they can be queried cheaply while scans are
+    still adding to the store. An `observer` is called with every finding which
+    changes the store, outside of the store lock. """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.observer: Optional[Callable[[Finding], None]] = None
+        self._findings: Dict[Tuple, Finding] = {}
+        self._by_kind: Dict[str, Dict[Tuple, Finding]] = {}
+        self._by_scanner: Dict[str, Dict[Tuple, Finding]] = {}
+        self._by_service: Dict[Tuple[int, str], Dict[Tuple, Finding]] = {}
+
+    def __len__(self) -> int:
+        return len(self._findings)
+
+    def __iter__(self) -> Iterator[Finding]:
+        with self.lock:
+            return iter(list(self._findings.values()))
+
+    def add(self, finding: Finding, notify: bool = True) -> bool:
+        """ Add or replace a finding. Returns true if the store changed. The
+        observer is not told about the change if `notify` is false. """
+
+        key = finding.key()
+
+        with self.lock:
+            if self._findings.get(key) == finding:
+                return False
+
+            self._findings[key] = finding
+            self._by_kind.setdefault(finding.KIND, {})[key] = finding
+            self._by_scanner.setdefault(finding.scanner, {})[key] = finding
+            self._by_service.setdefault((finding.port, finding.protocol), {})[
+                key
+            ] = finding
+
+        if notify and self.observer is not None:
+            self.observer(finding)
+
+        return True
+
+    def query(
+        self,
+        kind: Union[str, type] = None,
+        scanner: str = None,
+        port: int = None,
+        protocol: str = None,
+    ) -> List[Finding]:
+        """ Find all findings matching the given criteria """
+
+        if isinstance(kind, type):
+            kind = kind.KIND
+
+        with self.lock:
+            # Start from the most selective index available
+            candidates = [self._findings]
+            if kind is not None:
+                candidates.append(self._by_kind.get(kind, {}))
+            if scanner is not None:
+                candidates.append(self._by_scanner.get(scanner, {}))
+            if port is not None and protocol is not None:
+                candidates.append(self._by_service.get((port, protocol), {}))
+
+            return [
+                f
+                for f in min(candidates, key=len).values()
+                if (kind is None or f.KIND == kind)
+                and (scanner is None or f.scanner == scanner)
+                and (port is None or f.port == port)
+                and (protocol is None or f.protocol == protocol)
+            ]
+
+    def merge(self, other: "FindingStore", notify: bool = True) -> int:
+        """ Add the findings of another store which are not already known.
+        Findings present in both keep the value from this store. Returns the
+        number of findings added. """
+
+        added = []
+
+        with self.lock:
+            for finding in other:
+                if finding.key() not in self._findings:
+                    self.add(finding, False)
+                    added.append(finding)
+
+        if notify and self.observer is not None:
+            for finding in added:
+                self.observer(finding)
+
+        return len(added)
+
+    def json(self) -> List[Dict[str, Any]]:
+        """ Converts the store to a list appropriate for JSON output """
+        with self.lock:
+            return [f.json() for f in self._findings.values()]
+
+    @classmethod
+    def from_json(cls, data: List[Dict[str, Any]]) -> "FindingStore":
+        self = FindingStore()
+        for finding in data:
+            self.add(Finding.from_json(finding))
+        return self
@@ -0,0 +1,685 @@
+#!/usr/bin/env python3
+from typing import Any, Dict, List, Optional, Tuple
+from configparser import ConfigParser
+from dataclasses import dataclass
+import threading
+import hashlib
+import sqlite3
+import json
+import os
+import re
+
+from htb.findings import HostScript
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS machines (
+    name TEXT PRIMARY KEY,
+    ip TEXT,
+    os TEXT,
+    path TEXT,
+    stamp TEXT
+);
+CREATE TABLE IF NOT EXISTS services (
+    machine TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    state TEXT,
+    name TEXT,
+    product TEXT,
+    version TEXT,
+    extrainfo TEXT,
+    PRIMARY KEY (machine, port, protocol)
+);
+CREATE INDEX IF NOT EXISTS services_name ON services (name);
+CREATE INDEX IF NOT EXISTS services_port ON services (port, protocol);
+CREATE INDEX IF NOT EXISTS services_product ON services (product);
+CREATE TABLE IF NOT EXISTS scripts (
+    machine TEXT NOT NULL,
+    port INTEGER NOT NULL,
+    protocol TEXT NOT NULL,
+    id TEXT NOT NULL,
+    output TEXT
+);
+CREATE INDEX IF NOT EXISTS scripts_machine ON scripts (machine);
+CREATE INDEX IF NOT EXISTS scripts_id ON scripts (id);
+CREATE TABLE IF NOT EXISTS findings (
+    machine TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    scanner TEXT,
+    port INTEGER,
+    protocol TEXT,
+    value TEXT,
+    description TEXT,
+    data TEXT
+);
+CREATE INDEX IF NOT EXISTS findings_machine ON findings (machine);
+CREATE INDEX IF NOT EXISTS findings_kind ON findings (kind, value);
+CREATE INDEX IF NOT EXISTS findings_value ON findings (value);
+CREATE INDEX IF NOT EXISTS findings_scanner ON findings (scanner);
+CREATE TABLE IF NOT EXISTS runs (
+    machine TEXT NOT NULL,
+    scanner TEXT NOT NULL,
+    port INTEGER,
+    protocol TEXT,
+    start REAL,
+    end REAL,
+    cpu REAL,
+    max_rss INTEGER,
+    lines INTEGER,
+    bytes INTEGER,
+    status TEXT,
+    cancelled INTEGER,
+    failed INTEGER
+);
+CREATE INDEX IF NOT EXISTS runs_machine ON runs (machine);
+CREATE INDEX IF NOT EXISTS runs_scanner ON runs (scanner);
+CREATE TABLE IF NOT EXISTS scan_files (
+    path TEXT PRIMARY KEY,
+    machine TEXT NOT NULL,
+    scanner TEXT,
+    port INTEGER,
+    protocol TEXT,
+    size INTEGER,
+    mtime INTEGER,
+    offset INTEGER,
+    lines INTEGER,
+    head TEXT
+);
+CREATE INDEX IF NOT EXISTS scan_files_machine ON scan_files (machine);
+CREATE TABLE IF NOT EXISTS scan_chunks (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    line INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scan_chunks_path ON scan_chunks (path);
+CREATE VIRTUAL TABLE IF NOT EXISTS scan_text USING fts5 (text);
+CREATE VIEW IF NOT EXISTS knowns AS
+    SELECT machine, value AS name, json_extract(data, '$.value') AS value
+    FROM findings WHERE kind = 'known';
+"""
+
+# Tables holding rows of a single machine
+TABLES = ["services", "scripts", "findings", "runs"]
+
+# e.g. "gobuster-80-tcp.txt" or "open-tcp.nmap"
+SCAN_FILE = re.compile(r"^(?P<scanner>.+?)-(?P<port>\d+)-(?P<protocol>[a-z]+)\.")
+NMAP_FILE = re.compile(r"^open-(?P<protocol>[a-z]+)\.")
+
+# Scan output which is not worth searching
+SKIP_SUFFIXES = (".xml", ".log", ".tmp")
+
+# Markers around matched terms in search results
+MATCH_START = "\x02"
+MATCH_END = "\x03"
+
+
+@dataclass
+class SearchHit(object):
+    """ A line of scan output matching a search """
+
+    machine: str
+    scanner: str
+    port: Optional[int]
+    protocol: Optional[str]
+    path: str
+    line: int
+    # Surrounding (line number, text) pairs. Matched terms in the matching
+    # line are surrounded by MATCH_START and MATCH_END.
+    context: List[Tuple[int, str]]
+    rank: float
+
+
+def pattern(column: str, value: str) -> Tuple[str, str]:
+    """ SQL condition matching a column against a value. Values containing
+    glob characters are matched with GLOB, anything else must match exactly so
+    that the column's index is used. """
+
+    if any([c in value for c in "*?["]):
+        return f"{column} GLOB ?", value
+    return f"{column} = ?", value
+
+
+class AnalysisIndex(object):
+    """ Central SQLite database of the services, nmap script output, findings,
+    known values and scanner runs of every analyzed machine. Each machine's
+    rows are replaced whenever it is saved or loaded with changes, so the index
+    can be rebuilt from the analysis directories at any time. Enabled with the
+    `enabled` option of the `index` section, and stored in `index.db` in the
+    analysis directory unless `path` is set. """
+
+    # Lines of output stored in each row of the full-text index
+    CHUNK_LINES = 32
+    # Rows written per transaction while indexing a file
+    BATCH_CHUNKS = 1024
+    # Leading bytes of a file hashed to tell appended from rewritten files
+    HEAD_SIZE = 4096
+
+    # Open indexes shared by every machine, by path
+    INDEXES: Dict[str, "AnalysisIndex"] = {}
+    INDEXES_LOCK = threading.Lock()
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.lock = threading.RLock()
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.row_factory = sqlite3.Row
+
+        # Readers in other processes never block the writer
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA busy_timeout=5000")
+        with self.db:
+            self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> Optional["AnalysisIndex"]:
+        """ The configured index, or None if it is not enabled """
+
+        if not config.getboolean("index", "enabled", fallback=False):
+            return None
+
+        path = config.get("index", "path", fallback=None)
+        if path is None:
+            path = os.path.join(
+                config.get("htb", "analysis_path", fallback="~/htb"), "index.db"
+            )
+        path = os.path.abspath(os.path.expanduser(path))
+
+        with cls.INDEXES_LOCK:
+            if path not in cls.INDEXES:
+                cls.INDEXES[path] = AnalysisIndex(path)
+            return cls.INDEXES[path]
+
+    @staticmethod
+    def stamp(machine: "htb.machine.Machine") -> str:
+        """ Identifies the saved state of a machine. It changes whenever the
+        state file, its journal or the run log is written. """
+
+        parts = []
+        for name in ["machine.json", "machine.journal", "runs.jsonl"]:
+            try:
+                st = os.stat(os.path.join(machine.analysis_path, name))
+                parts.append(f"{st.st_mtime_ns}:{st.st_size}")
+            except FileNotFoundError:
+                parts.append("-")
+
+        return ",".join(parts)
+
+    def sync(self, machine: "htb.machine.Machine", force: bool = False) -> bool:
+        """ Replace the rows of a machine with its current state unless the
+        saved state did not change since the last sync. Returns whether the
+        index was updated. """
+
+        if machine.analysis_path is None:
+            return False
+
+        stamp = self.stamp(machine)
+
+        with self.lock:
+            row = self.db.execute(
+                "SELECT stamp FROM machines WHERE name = ?", (machine.name,)
+            ).fetchone()
+            if not force and row is not None and row["stamp"] == stamp:
+                return False
+
+            services = list(machine.services)
+            findings = list(machine.findings)
+            runs = list(machine.runlog) if machine.runlog is not None else []
+
+            with self.db:
+                for table in TABLES:
+                    self.db.execute(
+                        f"DELETE FROM {table} WHERE machine = ?", (machine.name,)
+                    )
+
+                self.db.execute(
+                    "INSERT OR REPLACE INTO machines VALUES (?, ?, ?, ?, ?)",
+                    (
+                        machine.name,
+                        machine.ip,
+                        machine.os,
+                        machine.analysis_path,
+                        stamp,
+                    ),
+                )
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO services VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            machine.name,
+                            s.port,
+                            s.protocol,
+                            s.state,
+                            s.name,
+                            s.product,
+                            s.version,
+                            s.extrainfo,
+                        )
+                        for s in services
+                    ],
+                )
+                self.db.executemany(
+                    "INSERT INTO scripts VALUES (?, ?, ?, ?, ?)",
+                    [
+                        (machine.name, s.port, s.protocol, ident, output)
+                        for s in services
+                        for ident, output in s.scripts.items()
+                    ]
+                    # Host scripts are stored with port 0, like other findings
+                    # about the machine itself
+                    + [
+                        (machine.name, f.port, f.protocol, f.id, f.output)
+                        for f in findings
+                        if isinstance(f, HostScript)
+                    ],
+                )
+                self.db.executemany(
+                    "INSERT INTO findings VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            machine.name,
+                            f.KIND,
+                            f.scanner,
+                            f.port,
+                            f.protocol,
+                            " ".join([str(getattr(f, n)) for n in f.IDENTITY]),
+                            f.describe(),
+                            json.dumps(f.json()),
+                        )
+                        for f in findings
+                    ],
+                )
+                self.db.executemany(
+                    "INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            machine.name,
+                            r.scanner,
+                            r.port,
+                            r.protocol,
+                            r.start,
+                            r.end,
+                            r.cpu,
+                            r.max_rss,
+                            r.lines,
+                            r.bytes,
+                            r.status,
+                            int(r.cancelled),
+                            int(r.failed and not r.cancelled),
+                        )
+                        for r in runs
+                    ],
+                )
+
+        return True
+
+    def remove(self, name: str) -> None:
+        """ Forget everything about a machine """
+
+        with self.lock:
+            paths = self.db.execute(
+                "SELECT path FROM scan_files WHERE machine = ?", (name,)
+            ).fetchall()
+            for row in paths:
+                self.forget_file(row["path"])
+
+            with self.db:
+                for table in TABLES + ["machines"]:
+                    column = "name" if table == "machines" else "machine"
+                    self.db.execute(f"DELETE FROM {table} WHERE {column} = ?", (name,))
+
+    def index_scans(
+        self, machine: "htb.machine.Machine", finished: Optional[str] = None
+    ) -> int:
+        """ Add new scan output of a machine to the full-text index. Files
+        which did not change since they were indexed are skipped, output
+        appended to a file is indexed on its own, and files which were
+        rewritten or removed are dropped first. Only complete lines are
+        indexed while a file may still be written; files named `finished` or
+        starting with `finished.` are done, so their last line is indexed
+        even without a trailing newline. Returns the number of files
+        indexed. """
+
+        if machine.analysis_path is None:
+            return 0
+
+        directory = os.path.join(machine.analysis_path, "scans")
+        try:
+            entries = [
+                e
+                for e in os.scandir(directory)
+                if e.is_file()
+                and not e.name.startswith(".")
+                and not e.name.endswith(SKIP_SUFFIXES)
+            ]
+        except FileNotFoundError:
+            entries = []
+
+        with self.lock:
+            known = {
+                row["path"]: row
+                for row in self.db.execute(
+                    "SELECT * FROM scan_files WHERE machine = ?", (machine.name,)
+                )
+            }
+
+        indexed = 0
+        for entry in entries:
+            st = entry.stat()
+            row = known.pop(entry.path, None)
+            complete = finished is not None and (
+                entry.name == finished or entry.name.startswith(finished + ".")
+            )
+
+            # Unchanged files are only revisited for a pending last line
+            if row is not None and (row["size"], row["mtime"]) == (
+                st.st_size,
+                st.st_mtime_ns,
+            ):
+                if row["offset"] >= st.st_size or not complete:
+                    continue
+
+            self.index_file(machine.name, entry.path, row, complete)
+            indexed += 1
+
+        # Files which are gone
+        for path in known:
+            self.forget_file(path)
+
+        return indexed
+
+    def index_file(
+        self,
+        machine: str,
+        path: str,
+        row: Optional[sqlite3.Row] = None,
+        complete: bool = False,
+    ) -> None:
+        """ Index the complete lines of a scan output file which were not
+        indexed before. `row` is the file's entry in `scan_files`, if any. If
+        the file is `complete`, a last line without a newline is indexed as
+        well. """
+
+        match = SCAN_FILE.match(os.path.basename(path))
+        nmap = NMAP_FILE.match(os.path.basename(path))
+        if match is not None:
+            scanner, port, protocol = (
+                match["scanner"],
+                int(match["port"]),
+                match["protocol"],
+            )
+        elif nmap is not None:
+            scanner, port, protocol = "nmap", None, nmap["protocol"]
+        else:
+            scanner, port, protocol = os.path.basename(path).split(".")[0], None, None
+
+        try:
+            fh = open(path, "rb")
+        except FileNotFoundError:
+            self.forget_file(path)
+            return
+
+        with fh:
+            st = os.fstat(fh.fileno())
+            offset, lines = 0, 0
+
+            # Continue after the indexed part if the file was only appended to
+            if row is not None and st.st_size >= row["offset"]:
+                head = fh.read(min(self.HEAD_SIZE, row["offset"]))
+                if hashlib.sha1(head).hexdigest() == row["head"]:
+                    offset, lines = row["offset"], row["lines"]
+            if offset == 0 and row is not None:
+                self.forget_file(path)
+
+            fh.seek(0)
+            head = fh.read(self.HEAD_SIZE)
+            binary = b"\0" in head
+
+            fh.seek(offset)
+            partial = b""
+            chunks: List[Tuple[int, str]] = []
+
+            while not binary:
+                data = fh.read(1 << 20)
+                if not data:
+                    break
+
+                # Only complete lines are indexed, the rest is read next time
+                text = partial + data
+                end = text.rfind(b"\n") + 1
+                partial = text[end:]
+                block = text[:end].decode("utf-8", errors="replace").splitlines()
+
+                for start in range(0, len(block), self.CHUNK_LINES):
+                    chunk = block[start : start + self.CHUNK_LINES]
+                    chunks.append((lines + 1, "\n".join(chunk)))
+                    lines += len(chunk)
+                offset += end
+
+                if len(chunks) >= self.BATCH_CHUNKS:
+                    self._add_chunks(path, chunks)
+                    chunks = []
+
+            # Nothing more will be written after the last line
+            if complete and partial and not binary:
+                chunks.append((lines + 1, partial.decode("utf-8", errors="replace")))
+                lines += 1
+                offset += len(partial)
+
+            if binary:
+                offset = st.st_size
+
+            self._add_chunks(path, chunks)
+
+            with self.lock, self.db:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO scan_files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        path,
+                        machine,
+                        scanner,
+                        port,
+                        protocol,
+                        st.st_size,
+                        st.st_mtime_ns,
+                        offset,
+                        lines,
+                        hashlib.sha1(head[: min(self.HEAD_SIZE, offset)]).hexdigest(),
+                    ),
+                )
+
+    def _add_chunks(self, path: str, chunks: List[Tuple[int, str]]) -> None:
+        """ Store (first line, text) chunks of a file in the full-text index """
+
+        with self.lock, self.db:
+            for line, text in chunks:
+                ident = self.db.execute(
+                    "INSERT INTO scan_chunks (path, line) VALUES (?, ?)", (path, line)
+                ).lastrowid
+                self.db.execute(
+                    "INSERT INTO scan_text (rowid, text) VALUES (?, ?)", (ident, text)
+                )
+
+    def forget_file(self, path: str) -> None:
+        """ Remove a scan output file from the full-text index """
+
+        with self.lock, self.db:
+            self.db.execute(
+                "DELETE FROM scan_text WHERE rowid IN "
+                "(SELECT id FROM scan_chunks WHERE path = ?)",
+                (path,),
+            )
+            self.db.execute("DELETE FROM scan_chunks WHERE path = ?", (path,))
+            self.db.execute("DELETE FROM scan_files WHERE path = ?", (path,))
+
+    def search(
+        self,
+        query: str,
+        machine: Optional[str] = None,
+        scanner: Optional[str] = None,
+        limit: int = 20,
+        context: int = 1,
+        raw: bool = False,
+    ) -> List[SearchHit]:
+        """ Search indexed scan output, best matches first. The query is
+        matched as a phrase unless `raw` is set, in which case it is passed to
+        FTS5 as is (e.g. `admin OR login`). Each hit holds `context` lines
+        before and after the matching line. """
+
+        if not raw:
+            query = '"' + query.replace('"', '""') + '"'
+
+        sql = (
+            "SELECT f.machine, f.scanner, f.port, f.protocol, c.path, c.line, "
+            "highlight(scan_text, 0, ?, ?) AS text, bm25(scan_text) AS rank "
+            "FROM scan_text "
+            "JOIN scan_chunks c ON c.id = scan_text.rowid "
+            "JOIN scan_files f ON f.path = c.path "
+            "WHERE scan_text MATCH ?"
+        )
+        params: List[Any] = [MATCH_START, MATCH_END, query]
+        if machine is not None:
+            sql += " AND f.machine = ?"
+            params.append(machine)
+        if scanner is not None:
+            sql += " AND f.scanner = ?"
+            params.append(scanner)
+        sql += " ORDER BY rank LIMIT ?"
+        params.append(limit)
+
+        with self.lock:
+            rows = self.db.execute(sql, params).fetchall()
+
+        hits = []
+        for row in rows:
+            lines = row["text"].split("\n")
+            for number, text in enumerate(lines):
+                if MATCH_START not in text:
+                    continue
+                window = range(
+                    max(0, number - context), min(len(lines), number + context + 1)
+                )
+                hits.append(
+                    SearchHit(
+                        machine=row["machine"],
+                        scanner=row["scanner"],
+                        port=row["port"],
+                        protocol=row["protocol"],
+                        path=row["path"],
+                        line=row["line"] + number,
+                        context=[
+                            (
+                                row["line"] + n,
+                                lines[n]
+                                if n == number
+                                else lines[n]
+                                .replace(MATCH_START, "")
+                                .replace(MATCH_END, ""),
+                            )
+                            for n in window
+                        ],
+                        rank=row["rank"],
+                    )
+                )
+                # One hit per chunk, its best line is the first match
+                break
+
+        return hits
+
+    def select(
+        self, query: str, conditions: List[Tuple[str, Any]], order: str
+    ) -> List[sqlite3.Row]:
+        """ Run a query with the given (condition, parameter) pairs """
+
+        if len(conditions):
+            query += " WHERE " + " AND ".join([c for c, _ in conditions])
+        query += f" ORDER BY {order}"
+
+        with self.lock:
+            return self.db.execute(query, [p for _, p in conditions]).fetchall()
+
+    def services(
+        self,
+        name: Optional[str] = None,
+        port: Optional[int] = None,
+        protocol: Optional[str] = None,
+        product: Optional[str] = None,
+    ) -> List[sqlite3.Row]:
+        """ Services of every machine matching the given criteria """
+
+        conditions = []
+        if name is not None:
+            conditions.append(pattern("name", name))
+        if port is not None:
+            conditions.append(("port = ?", port))
+        if protocol is not None:
+            conditions.append(("protocol = ?", protocol))
+        if product is not None:
+            conditions.append(pattern("product", product))
+
+        return self.select(
+            "SELECT * FROM services", conditions, "machine, protocol, port"
+        )
+
+    def findings(
+        self,
+        kind: Optional[str] = None,
+        scanner: Optional[str] = None,
+        value: Optional[str] = None,
+        port: Optional[int] = None,
+    ) -> List[sqlite3.Row]:
+        """ Findings of every machine matching the given criteria. `value` is
+        matched against the identifying fields of a finding, e.g. the path of a
+        web path or the name of a share. """
+
+        conditions = []
+        if kind is not None:
+            conditions.append(("kind = ?", kind))
+        if scanner is not None:
+            conditions.append(("scanner = ?", scanner))
+        if value is not None:
+            conditions.append(pattern("value", value))
+        if port is not None:
+            conditions.append(("port = ?", port))
+
+        return self.select(
+            "SELECT * FROM findings", conditions, "machine, kind, port, value"
+        )
+
+    def scripts(
+        self, ident: Optional[str] = None, output: Optional[str] = None
+    ) -> List[sqlite3.Row]:
+        """ nmap script output of every machine. Host scripts have port 0.
+        `output` is a glob matched against the whole output. """
+
+        conditions = []
+        if ident is not None:
+            conditions.append(pattern("id", ident))
+        if output is not None:
+            conditions.append(("output GLOB ?", output))
+
+        return self.select("SELECT * FROM scripts", conditions, "machine, port, id")
+
+    def knowns(self, name: Optional[str] = None) -> List[sqlite3.Row]:
+        """ Known values (credentials, hostnames, ...) of every machine """
+
+        conditions = []
+        if name is not None:
+            conditions.append(pattern("name", name))
+
+        return self.select("SELECT * FROM knowns", conditions, "machine, name")
+
+    def execute(self, query: str) -> Tuple[List[str], List[sqlite3.Row]]:
+        """ Run a read-only SQL query. Returns the column names and rows. """
+
+        with self.lock:
+            self.db.execute("PRAGMA query_only=ON")
+            try:
+                cursor = self.db.execute(query)
+                rows = cursor.fetchall()
+                columns = [d[0] for d in cursor.description or []]
+            finally:
+                self.db.execute("PRAGMA query_only=OFF")
+
+        return columns, rows
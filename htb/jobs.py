@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+from typing import Callable, Dict, List, Optional, Tuple
+from configparser import ConfigParser
+import collections
+import threading
+import queue
+
+from htb.scanner import Tracker
+
+
+class JobTable(object):
+    """ Background jobs keyed by an ID which is never reused. A reaper thread
+    retires jobs as soon as they finish: their threads are joined, process
+    handles and scanner state are dropped and their output buffer is cut down
+    to the last few lines. Only the newest `history` finished jobs are kept, so
+    a long running shell doesn't grow without bound. Each run is archived in
+    the machine's run log by the scanner itself, so nothing is lost when a job
+    is forgotten. Configured with `job_history` in the `htb` section. """
+
+    # Output lines kept once a job has finished
+    KEEP_LINES = 20
+
+    def __init__(
+        self, history: int = 100, finished: Optional[Callable[[Tracker], None]] = None
+    ):
+        self.history: int = history
+        self.finished: Optional[Callable[[Tracker], None]] = finished
+        self.jobs: Dict[int, Tracker] = collections.OrderedDict()
+        self.next_id: int = 0
+        self.events: queue.Queue = queue.Queue()
+        self.condition = threading.Condition()
+
+        self.reaper = threading.Thread(target=self._reap, daemon=True)
+        self.reaper.start()
+
+    @classmethod
+    def from_config(
+        cls, config: ConfigParser, finished: Optional[Callable[[Tracker], None]] = None
+    ) -> "JobTable":
+        return JobTable(
+            history=config.getint("htb", "job_history", fallback=100),
+            finished=finished,
+        )
+
+    def __len__(self) -> int:
+        with self.condition:
+            return len(self.jobs)
+
+    def add(self, tracker: Tracker) -> int:
+        """ Take ownership of a background job and return its ID. The caller
+        must hold the tracker lock, as with any change of `events`. """
+
+        with self.condition:
+            ident = self.next_id
+            self.next_id += 1
+            self.jobs[ident] = tracker
+            tracker.events = self.events
+
+        return ident
+
+    def get(self, ident: int) -> Optional[Tracker]:
+        """ Look up a job which has not been forgotten yet """
+        with self.condition:
+            return self.jobs.get(ident)
+
+    def items(self) -> List[Tuple[int, Tracker]]:
+        """ Snapshot of every known job in the order they were started """
+        with self.condition:
+            return list(self.jobs.items())
+
+    def running(self) -> List[Tracker]:
+        """ Jobs which are queued or running """
+        with self.condition:
+            return [j for j in self.jobs.values() if j.thread is not None]
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """ Wait for every job to finish. Returns False on timeout. """
+
+        with self.condition:
+            return self.condition.wait_for(
+                lambda: not any([j.thread is not None for j in self.jobs.values()]),
+                timeout=timeout,
+            )
+
+    def _reap(self) -> None:
+        """ Retire jobs as they report completion """
+
+        while True:
+            tracker = self.events.get()
+
+            thread = tracker.thread
+            if thread is not None:
+                thread.join()
+
+            # Nothing reads these once the job is over
+            tracker.data.clear()
+            with tracker.output_lock:
+                tracker.output = collections.deque(
+                    tracker.output, maxlen=self.KEEP_LINES
+                )
+
+            with self.condition:
+                tracker.thread = None
+
+            if self.finished is not None:
+                try:
+                    self.finished(tracker)
+                except Exception:
+                    pass
+
+            with self.condition:
+                self._evict()
+                self.condition.notify_all()
+
+    def _evict(self) -> None:
+        """ Forget the oldest finished jobs beyond the history limit """
+
+        finished = [i for i, j in self.jobs.items() if j.thread is None]
+        for ident in finished[: max(0, len(finished) - self.history)]:
+            del self.jobs[ident]
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+from typing import Any, Generator, List, Tuple
+import contextlib
+import threading
+import fcntl
+import json
+import os
+
+
+class Journal(object):
+    """ Append-only log of small changes to a machine's saved state, stored as
+    JSON lines next to `machine.json`. Each entry is a single write, so a crash
+    can at worst leave a partial last line, which is skipped when the journal
+    is read and terminated before the next entry is appended. Appends and
+    compaction hold an exclusive lock on the journal, so the REPL and the scan
+    daemon may share it. """
+
+    # Entries appended by this process before the journal is compacted
+    COMPACT_ENTRIES = 1000
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.entries: int = 0
+        self.lock = threading.Lock()
+
+    def append(self, op: str, data: Any) -> int:
+        """ Add an entry to the end of the journal. Returns the number of
+        entries appended since the last compaction. """
+
+        line = (json.dumps({"op": op, "data": data}) + "\n").encode("utf-8")
+
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_APPEND | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                # Terminate a torn last line so it doesn't swallow this entry
+                size = os.fstat(fd).st_size
+                if size > 0 and os.pread(fd, 1, size - 1) != b"\n":
+                    line = b"\n" + line
+                os.write(fd, line)
+            finally:
+                os.close(fd)
+
+            self.entries += 1
+            return self.entries
+
+    def __iter__(self) -> Generator[Tuple[str, Any], None, None]:
+        """ Read every entry as (op, data) tuples. Lines which can't be parsed
+        (e.g. a partial write) are skipped. """
+
+        try:
+            fh = open(self.path, "r")
+        except FileNotFoundError:
+            return
+
+        with fh:
+            for line in fh:
+                try:
+                    entry = json.loads(line)
+                    yield entry["op"], entry["data"]
+                except (ValueError, TypeError, KeyError):
+                    continue
+
+    @contextlib.contextmanager
+    def compacting(self) -> Generator[List[Tuple[str, Any]], None, None]:
+        """ Lock the journal while a snapshot is written. The current entries
+        are handed to the caller to fold into the snapshot, and the journal is
+        emptied once the snapshot was written successfully. """
+
+        with self.lock:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield list(self)
+                os.ftruncate(fd, 0)
+                self.entries = 0
+            finally:
+                os.close(fd)
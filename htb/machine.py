@@ -1,19 +1,38 @@
 #!/usr/bin/env python3
-from typing import Dict, Any, List
+from typing import Dict, Any, List, Generator, Callable, Iterable, Optional, Tuple
+from concurrent.futures import Future
 from io import StringIO
+import collections
 import subprocess
+import sqlite3
 import threading
+import queue
 import json
+import time
 import os
 import re
 
 from htb.scanner import Service, Scanner, Tracker, AVAILABLE_SCANNERS
+from htb.findings import Finding, FindingStore, Known, HostScript
+from htb.nmap import NmapRunner
+from htb.scheduler import Scheduler
+from htb.runlog import RunLog
+from htb.journal import Journal
+from htb.index import AnalysisIndex
+from htb import util
+from htb import portscan
 from htb.exceptions import *
 
+# e.g. "Discovered open port 22/tcp on 10.10.10.10"
+MASSCAN_DISCOVERED = re.compile(rb"Discovered open port (\d+)/(\w+) on ")
+
 
 class Machine(object):
     """ Interact with a Hack the Box machine """
     
+    # Seconds to wait for port discovery to end once it was stopped
+    STOP_TIMEOUT = 5
+    
     def __init__(self, connection: Any, data: Dict[str, Any]):
         """ Build a machine object from API data """
         
@@ -35,10 +54,86 @@ class Machine(object):
         self.free: bool = None
         self.analysis_path: str = None
         self.services: List[Service] = []
-        self.knowns: Dict[str, Any] = {}
+        self.findings: FindingStore = FindingStore()
+        self.findings.observer = self._found
+        self._runlog: Optional[RunLog] = None
+        self._journal: Optional[Journal] = None
+        # Identity of the state files as we last wrote them
+        self._written: Dict[str, Tuple[int, int, int]] = {}
         
         self.update(data)
     
+    @property
+    def runlog(self) -> Optional[RunLog]:
+        """ Log of scanner runs against this machine (`runs.jsonl` in the
+        analysis directory) """
+        
+        if self.analysis_path is None:
+            return None
+        
+        path = os.path.join(self.analysis_path, "runs.jsonl")
+        if self._runlog is None or self._runlog.path != path:
+            self._runlog = RunLog(path)
+        
+        return self._runlog
+    
+    @property
+    def journal(self) -> Optional[Journal]:
+        """ Changes saved since `machine.json` was last written
+        (`machine.journal` in the analysis directory) """
+        
+        if self.analysis_path is None:
+            return None
+        
+        path = os.path.join(self.analysis_path, "machine.journal")
+        if self._journal is None or self._journal.path != path:
+            self._journal = Journal(path)
+        
+        return self._journal
+    
+    def _record(self, op: str, data: Any) -> None:
+        """ Save a small change to the journal, and compact the journal into
+        `machine.json` once it has grown """
+        
+        journal = self.journal
+        if journal is None:
+            return
+        
+        try:
+            entries = journal.append(op, data)
+            self._wrote("machine.journal")
+            if entries >= Journal.COMPACT_ENTRIES:
+                self.dump()
+        except OSError:
+            pass
+    
+    def _wrote(self, name: str) -> None:
+        """ Remember a state file as written by us """
+        
+        try:
+            st = os.stat(os.path.join(self.analysis_path, name))
+        except OSError:
+            return
+        
+        self._written[name] = (st.st_ino, st.st_size, st.st_mtime_ns)
+    
+    def external_change(self, name: str) -> bool:
+        """ Whether a state file in the analysis directory was changed by
+        someone else since we last wrote or read it """
+        
+        if self.analysis_path is None:
+            return True
+        
+        try:
+            st = os.stat(os.path.join(self.analysis_path, name))
+        except OSError:
+            return name in self._written
+        
+        return self._written.get(name) != (st.st_ino, st.st_size, st.st_mtime_ns)
+    
+    def _found(self, finding: Finding) -> None:
+        self._record("finding", finding.json())
+    
     def __repr__(self) -> str:
         return f"""<Machine id={self.id},name="{self.name}",ip="{self.ip}",os="{self.os}">"""
     
@@ -333,19 +428,123 @@ class Machine(object):
     def dump(self) -> bool:
         """ Dump our current findings and services to a state file in the
         anaylsis directory. If this machine has not been initialized, then don't
-        do anything. """
+        do anything. The file is replaced atomically. Findings saved or
+        journaled by other processes are re-read with the journal locked and
+        merged into ours, so they are kept when the journal is emptied. """
         
         if self.analysis_path is None:
             return False
         
-        with open(os.path.join(self.analysis_path, "machine.json"), "w") as fh:
-            json.dump(
-                {"services": [s.json() for s in self.services], "knowns": self.knowns},
-                fh,
+        with self.journal.compacting() as entries:
+            try:
+                _, saved = self._saved(self.analysis_path)
+            except (OSError, ValueError, KeyError):
+                saved = FindingStore()
+            _, saved = self._replay(entries, [], saved)
+            self.findings.merge(saved, notify=False)
+            
+            util.atomic_write(
+                os.path.join(self.analysis_path, "machine.json"),
+                json.dumps(
+                    {
+                        "services": [s.json() for s in self.services],
+                        "findings": self.findings.json(),
+                    }
+                ).encode("utf-8"),
             )
         
+        self._wrote("machine.json")
+        self._wrote("machine.journal")
+        self.index()
+        
         return True
     
+    def index(self, force: bool = False, finished: Optional[str] = None) -> bool:
+        """ Update this machine and its new scan output in the analysis index if
+        one is enabled. `finished` names scan output which is no longer being
+        written (see `AnalysisIndex.index_scans`). Returns whether the index
+        changed. """
+        
+        try:
+            index = AnalysisIndex.from_config(self.connection.config)
+            if index is None:
+                return False
+            changed = index.sync(self, force)
+            return index.index_scans(self, finished) > 0 or changed
+        except (sqlite3.Error, OSError):
+            return False
+    
+    @classmethod
+    def _replay(
+        cls,
+        entries: Iterable[Tuple[str, Any]],
+        services: List[Service],
+        findings: FindingStore,
+    ) -> Tuple[List[Service], FindingStore]:
+        """ Apply journal entries to saved services and findings """
+        
+        updated = {(s.port, s.protocol): s for s in services}
+        
+        for op, data in entries:
+            try:
+                if op == "finding":
+                    findings.add(Finding.from_json(data), notify=False)
+                elif op == "service":
+                    service = Service.from_json(data)
+                    updated[(service.port, service.protocol)] = service
+                elif op == "services":
+                    updated = {}
+                    for service in [Service.from_json(s) for s in data]:
+                        updated[(service.port, service.protocol)] = service
+            except (KeyError, TypeError):
+                # Written by a newer version, or damaged
+                continue
+        
+        services = sorted(updated.values(), key=lambda s: (s.protocol, s.port))
+        return services, findings
+    
+    def _saved(self, analysis_path: str) -> Tuple[List[Service], FindingStore]:
+        """ Read the saved state from `machine.json` alone """
+        
+        with open(os.path.join(analysis_path, "machine.json"), "r") as fh:
+            data = json.load(fh)
+        
+        services = [Service.from_json(s) for s in data["services"]]
+        findings = FindingStore.from_json(data.get("findings", []))
+        
+        # Older analysis directories kept a free-form "knowns" dict
+        for name, value in data.get("knowns", {}).items():
+            findings.add(Known(scanner="", port=0, protocol="", name=name, value=value))
+        
+        return services, findings
+    
+    def _read(self, analysis_path: str) -> Tuple[List[Service], FindingStore]:
+        """ Read the saved state from `machine.json` and replay the journal """
+        
+        services, findings = self._saved(analysis_path)
+        journal = Journal(os.path.join(analysis_path, "machine.journal"))
+        return self._replay(journal, services, findings)
+    
+    def refresh(self, services: bool = True) -> int:
+        """ Pick up state saved to `machine.json` by another process (e.g. the
+        scan daemon), so a later `dump` does not drop it. Services are always
+        saved as soon as they change, so the saved list replaces ours unless
+        `services` is False, while saved findings are merged with ours.
+        Returns the number of findings added. """
+        
+        if self.analysis_path is None:
+            return 0
+        
+        try:
+            saved, findings = self._read(self.analysis_path)
+        except (OSError, ValueError, KeyError):
+            return 0
+        
+        if services:
+            self.services = saved
+        
+        return self.findings.merge(findings, notify=False)
+    
     def load(self, base_path: str = "./") -> None:
         """ Load saved machine information from `machine.json` in the analysis
         directory. """
@@ -358,11 +557,12 @@ class Machine(object):
             raise NoAnalysisPath
         
         try:
-            with open(os.path.join(analysis_path, "machine.json"), "r") as fh:
-                data = json.load(fh)
-                self.services = [Service.from_json(s) for s in data["services"]]
-                self.knowns = data["knowns"]
+            self.services, self.findings = self._read(analysis_path)
+            self.findings.observer = self._found
             self.analysis_path = analysis_path
+            self._wrote("machine.json")
+            self._wrote("machine.journal")
+            self.index()
         except OSError as e:
             # No machine.json file
             print(f"oserror: {e}")
@@ -371,12 +571,26 @@ class Machine(object):
             print(f"keyerror: {e}")
             # Invalid machine json format
             raise NoAnalysisPath
+        except ValueError as e:
+            print(f"valueerror: {e}")
+            # Damaged machine.json file
+            raise NoAnalysisPath
     
-    def enumerate(self, force: bool = False) -> None:
+    def enumerate(
+        self,
+        force: bool = False,
+        report: Callable[[str], None] = lambda _: None,
+        incremental: bool = False,
+    ) -> None:
         """ Enumerate running services on the machine
 
         :param force: Force enumeration if it is already completed
         :type force: bool
+        :param report: Called with progress messages (e.g. nmap chunk timing)
+        :type report: Callable[[str], None]
+        :param incremental: Only fingerprint ports which were not open before and
+            mark ports which are no longer open as closed
+        :type incremental: bool
         """
         
         # The machine has to be running
@@ -388,11 +602,252 @@ class Machine(object):
             raise Terminating
         
         # We already enumerated this machine
-        if not force and len(self.services):
+        if not force and not incremental and len(self.services):
+            return
+        
+        # UDP discovery runs alongside the TCP pipeline. Discovery is stopped
+        # once fingerprinting ends, whether it completed or not.
+        stop = threading.Event()
+        sources = {"tcp": self.discover_tcp(stop)}
+        if self.connection.config.getboolean("enum", "udp", fallback=True):
+            sources["udp"] = self.discover_udp(stop)
+        
+        if incremental:
+            # Keep the full results of the last enumeration intact
+            name = time.strftime("open-tcp.%Y%m%d-%H%M%S")
+            self.fingerprint(
+                [self.changed(d, protocol) for protocol, d in sources.items()],
+                report,
+                name,
+                stop,
+            )
+        else:
+            self.services = []
+            self._record("services", [])
+            self.fingerprint(list(sources.values()), report, stop=stop)
+    
+    def changed(
+        self, discovered: Iterable[Service], protocol: str
+    ) -> Generator[Service, None, None]:
+        """ Compare a port sweep with the known services of the same protocol.
+        Ports which were not open before are yielded for fingerprinting. Once
+        the sweep completes, a closed copy of every previously open port which
+        was not found is yielded. """
+        
+        known = {
+            s.port: s
+            for s in self.services
+            if s.protocol == protocol and s.state != "closed"
+        }
+        seen = set()
+        
+        for service in discovered:
+            seen.add(service.port)
+            if service.port not in known:
+                yield service
+        
+        for port, service in known.items():
+            if port not in seen:
+                closed = Service.from_json(service.json())
+                closed.host = service.host
+                closed.state = "closed"
+                yield closed
+    
+    def fingerprint(
+        self,
+        sources: List[Iterable[Service]],
+        report: Callable[[str], None] = lambda _: None,
+        name: str = "open-tcp",
+        stop: Optional[threading.Event] = None,
+    ) -> None:
+        """ Run nmap service detection on ports as they are discovered. Each
+        source of services is consumed in its own thread. Closed and non-TCP
+        services are recorded without being scanned. Open TCP ports are
+        collected into batches of up to `nmap_chunk` ports; a batch is started
+        once it is full, `nmap_delay` seconds after its first port arrived or
+        when discovery finishes. Up to `nmap_parallel` batches run at once.
+        Discovered ports are added to `services` immediately and replaced by
+        nmap's results as each batch completes, and host script output is
+        recorded as `HostScript` findings. The merged nmap output is
+        saved as `scans/{name}.{nmap,gnmap,xml}`.
+        
+        If `report` raises (e.g. the job was cancelled), `stop` is set to end
+        discovery, running nmap chunks are terminated and their partial output
+        is removed before the exception is passed on. Sources should end once
+        `stop` is set. """
+        
+        config = self.connection.config
+        stop = stop or threading.Event()
+        chunk_size = config.getint("enum", "nmap_chunk", fallback=8)
+        delay = config.getfloat("enum", "nmap_delay", fallback=1.0)
+        events: queue.Queue = queue.Queue()
+        runner = NmapRunner(
+            self.hostname,
+            os.path.join(self.analysis_path, "scans", name),
+            parallel=config.getint("enum", "nmap_parallel", fallback=4),
+            completed=events,
+        )
+        
+        # Port discovery runs in the background and feeds the event queue
+        finished = object()
+        
+        def discover(discovered: Iterable[Service]):
+            try:
+                for service in discovered:
+                    if stop.is_set():
+                        break
+                    events.put(service)
+            except Exception as e:
+                events.put(e)
+            finally:
+                events.put(finished)
+                if hasattr(discovered, "close"):
+                    discovered.close()
+        
+        threads = [
+            threading.Thread(target=discover, args=(source,), daemon=True)
+            for source in sources
+        ]
+        for thread in threads:
+            thread.start()
+        
+        batch: List[int] = []
+        deadline = None
+        discovering = len(sources)
+        error = None
+        failed = False
+        
+        try:
+            while discovering or runner.pending:
+                timeout = None if deadline is None else max(0, deadline - time.time())
+                try:
+                    event = events.get(timeout=timeout)
+                except queue.Empty:
+                    event = None
+                
+                if isinstance(event, Service) and event.state == "closed":
+                    report(f"closed {event.port}/{event.protocol}")
+                    self.update_services([event])
+                elif isinstance(event, Service) and event.protocol != "tcp":
+                    report(f"discovered {event.port}/{event.protocol}")
+                    self.update_services([event])
+                elif isinstance(event, Service):
+                    report(f"discovered {event.port}/{event.protocol}")
+                    self.update_services([event])
+                    batch.append(event.port)
+                    # Without chunking the batch waits for discovery to finish
+                    if deadline is None and chunk_size > 0:
+                        deadline = time.time() + delay
+                elif isinstance(event, Future):
+                    chunk = runner.collect(event)
+                    if chunk.returncode != 0:
+                        failed = True
+                        report(f"nmap chunk {chunk.index} failed ({chunk.returncode})")
+                    else:
+                        # Services become available as soon as their chunk finishes
+                        self.update_services(chunk.services)
+                        for ident, output in chunk.scripts.items():
+                            self.findings.add(
+                                HostScript(
+                                    scanner="nmap",
+                                    port=0,
+                                    protocol="",
+                                    id=ident,
+                                    output=output,
+                                )
+                            )
+                        report(
+                            f"nmap chunk {chunk.index}: {len(chunk.ports)} port(s) in {chunk.elapsed:.1f}s"
+                        )
+                elif isinstance(event, Exception):
+                    error = event
+                elif event is finished:
+                    discovering -= 1
+                
+                # Start service detection for the current batch
+                if batch and (
+                    not discovering
+                    or chunk_size > 0
+                    and (len(batch) >= chunk_size or time.time() >= deadline)
+                ):
+                    runner.submit(batch)
+                    batch = []
+                    deadline = None
+            
+            runner.merge()
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join(timeout=self.STOP_TIMEOUT)
+            runner.close()
+        
+        # Check port discovery and nmap results
+        if error is not None:
+            raise error
+        if failed:
+            raise NmapFailed
+        
+        # Ensure we write the services out
+        self.dump()
+    
+    def update_services(self, services: Iterable[Service]) -> None:
+        """ Add services, replacing any existing service on the same port """
+        
+        updated = {(s.port, s.protocol): s for s in self.services}
+        for service in services:
+            updated[(service.port, service.protocol)] = service
+            self._record("service", service.json())
+        
+        self.services = sorted(updated.values(), key=lambda s: (s.protocol, s.port))
+    
+    def discover_udp(
+        self, stop: Optional[threading.Event] = None
+    ) -> Generator[Service, None, None]:
+        """ Find open UDP ports by probing the `udp_top` most common UDP ports
+        with the built-in UDP scanner. Only ports which answer are reported.
+        The scan ends early once `stop` is set. """
+        
+        config = self.connection.config
+        top = config.getint("enum", "udp_top", fallback=100)
+        
+        ports = portscan.udp_scan(
+            self.ip,
+            ports=portscan.UDP_TOP_PORTS[:top],
+            stop=stop,
+            concurrency=config.getint("enum", "udp_concurrency", fallback=100),
+            timeout=config.getfloat("enum", "udp_timeout", fallback=1.0),
+            retries=config.getint("enum", "udp_retries", fallback=2),
+            rate=config.getfloat("enum", "rate", fallback=None),
+        )
+        for port in ports:
+            yield Service.from_port(self.ip, port, "udp")
+    
+    def discover_tcp(
+        self, stop: Optional[threading.Event] = None
+    ) -> Generator[Service, None, None]:
+        """ Find open TCP ports with the port scanner selected by the `portscan`
+        option in the `enum` section. `masscan` (the default) requires root,
+        while `connect` uses the built-in unprivileged connect scanner, which
+        yields services as soon as they are found. The scan ends early once
+        `stop` is set. """
+        
+        config = self.connection.config
+        
+        if config.get("enum", "portscan", fallback="masscan") == "connect":
+            ports = portscan.tcp_scan(
+                self.ip,
+                stop=stop,
+                concurrency=config.getint("enum", "concurrency", fallback=1000),
+                timeout=config.getfloat("enum", "timeout", fallback=1.0),
+                retries=config.getint("enum", "retries", fallback=1),
+                rate=config.getfloat("enum", "rate", fallback=None),
+            )
+            for port in ports:
+                yield Service.from_port(self.ip, port)
             return
         
         masscan_path = os.path.join(self.analysis_path, "scans", "masscan.grep")
-        code = subprocess.call(
+        masscan = subprocess.Popen(
             [
                 "sudo",
                 "masscan",
@@ -400,66 +855,63 @@ class Machine(object):
                 "-p",
                 "1-65535",
                 "--max-rate",
-                "1000",
+                config.get("enum", "rate", fallback="1000"),
                 "-oG",
                 masscan_path,
+                "--interactive",
                 "-e",
-                "tun0",
-            ]
-        )
-        
-        # Ensure masscan succeeded
-        if code != 0:
-            raise MasscanFailed
-        
-        # Read all open port lines
-        with open(masscan_path, "r") as f:
-            ports = [
-                int(line.split(" ")[-1].split("/")[0])
-                for line in f.read().split("\n")
-                if line != "" and line[0] != "#" and "open" in line
-            ]
-        
-        # Run an in-depth nmap scan for the open ports
-        nmap_path = os.path.join(self.analysis_path, "scans", "open-tcp")
-        code = subprocess.call(
-            [
-                "nmap",
-                "-Pn",
-                "-T5",
-                "-sV",
-                "-A",
-                "-p",
-                ",".join([str(p) for p in ports]),
-                "-oA",
-                nmap_path,
-                self.hostname,
-            ]
+                config.get("enum", "interface", fallback="tun0"),
+            ],
+            stdout=subprocess.PIPE,
         )
         
-        # Check nmap result
-        if code != 0:
-            raise NmapFailed
-        
-        # Read greppable nmap output and extract open services
-        with open(nmap_path + ".gnmap", "r") as f:
-            services_list = [
-                line.split("Ports: ")[1]
-                for line in f.read().split("\n")
-                if line != "" and line[0] != "#" and "Ports:" in line
-            ]
+        def terminate():
+            if masscan.poll() is not None:
+                return
+            try:
+                masscan.terminate()
+            except PermissionError:
+                # sudo runs as root, so it has to be signalled through sudo
+                subprocess.call(
+                    ["sudo", "-n", "kill", str(masscan.pid)],
+                    stdout=subprocess.DEVNULL,
+                    stderr=subprocess.DEVNULL,
+                )
+        
+        # Reading blocks until masscan prints something, so it is killed from
+        # another thread when discovery is stopped
+        if stop is not None:
+            threading.Thread(
+                target=lambda: stop.wait() and terminate(), daemon=True
+            ).start()
         
-        self.services = []
-        for l in services_list:
-            for s in l.split("/, "):
-                self.services.append(Service.from_nmap((s + "/").strip()))
+        try:
+            # With --interactive, masscan also reports open ports on stdout as
+            # it finds them
+            for line in masscan.stdout:
+                match = MASSCAN_DISCOVERED.match(line)
+                if match is not None:
+                    yield Service.from_port(
+                        self.ip, int(match.group(1)), match.group(2).decode("utf-8")
+                    )
+        except GeneratorExit:
+            terminate()
+            raise
         
-        # Ensure we write the services out
-        self.dump()
+        # Ensure masscan succeeded
+        if masscan.wait() != 0 and (stop is None or not stop.is_set()):
+            raise MasscanFailed
     
-    def scan(self, scanner: Scanner, service: Service, silent=False) -> Tracker:
+    def scan(
+        self,
+        scanner: Scanner,
+        service: Service,
+        silent=False,
+        scheduler: Optional[Scheduler] = None,
+    ) -> Tracker:
         """ Start a scan for the given service. A tracker is allocated with the
-        lock held and the `job_events` field set to None. """
+        lock held and the `job_events` field set to None. If a scheduler is
+        given, the scan waits for a free slot before starting. """
         
         if not scanner.match_service(service):
             raise NotApplicable
@@ -476,6 +928,10 @@ class Machine(object):
             stop=False,
             data={},
             lock=threading.Lock(),
+            output=collections.deque(
+                maxlen=self.connection.config.getint("htb", "job_buffer", fallback=1000)
+            ),
+            scheduler=scheduler,
         )
         
         # Acquire the lock so the scanner doesn't modify the event queue before
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+from typing import Dict, List, Generator, Optional
+from concurrent.futures import ThreadPoolExecutor, Future
+import xml.etree.ElementTree as ElementTree
+import subprocess
+import threading
+import queue
+import time
+import os
+
+from htb.scanner import Service
+
+
+class NmapChunk(object):
+    """ A single nmap invocation over a subset of the open ports """
+
+    def __init__(self, index: int, ports: List[int], prefix: str):
+        self.index: int = index
+        self.ports: List[int] = ports
+        self.prefix: str = prefix
+        self.returncode: Optional[int] = None
+        self.elapsed: float = 0.0
+
+    def __repr__(self) -> str:
+        return f"<NmapChunk index={self.index},ports={len(self.ports)},elapsed={self.elapsed:.1f}>"
+
+    @property
+    def services(self) -> List[Service]:
+        """ Services reported by this chunk """
+
+        try:
+            return list(parse_xml(self.prefix + ".xml"))
+        except (ElementTree.ParseError, FileNotFoundError):
+            # Truncated or missing XML, fall back to the greppable output
+            return parse_gnmap(self.prefix + ".gnmap")
+
+    @property
+    def scripts(self) -> Dict[str, str]:
+        """ Host script output reported by this chunk """
+
+        try:
+            return parse_hostscripts(self.prefix + ".xml")
+        except (ElementTree.ParseError, FileNotFoundError):
+            # The greppable output has no script results
+            return {}
+
+
+def parse_xml(path: str) -> Generator[Service, None, None]:
+    """ Stream services out of nmap XML output. Elements are discarded once
+    they have been read so memory use does not grow with the output size. """
+
+    address = None
+    root = None
+
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        if event == "start":
+            if root is None:
+                root = elem
+            elif elem.tag == "host":
+                address = None
+            continue
+
+        if elem.tag == "address" and address is None:
+            address = elem.get("addr")
+        elif elem.tag == "port":
+            yield Service.from_nmap_xml(address, elem)
+            elem.clear()
+        elif elem.tag == "host":
+            root.clear()
+
+
+def parse_hostscripts(path: str) -> Dict[str, str]:
+    """ Read the output of host scripts (`hostscript` elements) from nmap XML
+    output by script ID """
+
+    scripts = {}
+    hostscript = False
+
+    for event, elem in ElementTree.iterparse(path, events=("start", "end")):
+        if elem.tag == "hostscript":
+            hostscript = event == "start"
+        elif event == "end" and elem.tag == "script" and hostscript:
+            scripts[elem.get("id")] = elem.get("output", "")
+        elif event == "end" and elem.tag == "port":
+            elem.clear()
+
+    return scripts
+
+
+def parse_gnmap(path: str) -> List[Service]:
+    """ Read greppable nmap output and extract open services """
+
+    with open(path, "r") as f:
+        services_list = [
+            line.split("Ports: ")[1]
+            for line in f.read().split("\n")
+            if line != "" and line[0] != "#" and "Ports:" in line
+        ]
+
+    services = []
+    for l in services_list:
+        for s in l.split("/, "):
+            services.append(Service.from_nmap((s + "/").strip()))
+
+    return services
+
+
+class NmapRunner(object):
+    """ Run nmap service detection over chunks of ports concurrently. Each
+    chunk writes its own `-oA` output next to `prefix`; `merge` combines them
+    into a single set of `prefix.{nmap,gnmap,xml}` files once all chunks are
+    complete. Chunks may be submitted while others are still running.
+
+    Completed futures are placed on the `completed` queue, which the caller
+    may share with other event sources; pass each one to `collect`. If the
+    runner is closed while chunks are outstanding, their nmap processes are
+    terminated and their output removed. """
+
+    ARGV = ["nmap", "-Pn", "-T5", "-sV", "-A"]
+
+    def __init__(
+        self,
+        host: str,
+        prefix: str,
+        parallel: int = 4,
+        completed: Optional[queue.Queue] = None,
+    ):
+        self.host: str = host
+        self.prefix: str = prefix
+        self.chunks: List[NmapChunk] = []
+        self.completed: queue.Queue = completed or queue.Queue()
+        self.executor = ThreadPoolExecutor(max_workers=max(1, parallel))
+        self.pending: int = 0
+        self.lock = threading.Lock()
+        # Running nmap processes by chunk index
+        self.processes: Dict[int, subprocess.Popen] = {}
+        self.stopped: bool = False
+
+    def _run(self, chunk: NmapChunk) -> NmapChunk:
+        start = time.time()
+
+        with self.lock:
+            # The runner was closed before this chunk got a worker
+            if self.stopped:
+                return chunk
+            popen = subprocess.Popen(
+                self.ARGV
+                + ["-p", ",".join([str(p) for p in chunk.ports])]
+                + ["-oA", chunk.prefix, self.host],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            self.processes[chunk.index] = popen
+
+        try:
+            chunk.returncode = popen.wait()
+        finally:
+            with self.lock:
+                del self.processes[chunk.index]
+
+        chunk.elapsed = time.time() - start
+        return chunk
+
+    def submit(self, ports: List[int]) -> NmapChunk:
+        """ Start service detection for the given ports """
+
+        with self.lock:
+            chunk = NmapChunk(
+                len(self.chunks), ports, f"{self.prefix}.chunk{len(self.chunks)}"
+            )
+            self.chunks.append(chunk)
+            self.pending += 1
+
+        future: Future = self.executor.submit(self._run, chunk)
+        future.add_done_callback(lambda f: self.completed.put(f))
+
+        return chunk
+
+    def wait(self) -> Generator[NmapChunk, None, None]:
+        """ Yield chunks as they complete until no chunks are pending """
+
+        while True:
+            with self.lock:
+                if self.pending == 0:
+                    return
+            yield self.collect(self.completed.get())
+
+    def collect(self, future: Future) -> NmapChunk:
+        """ Retrieve the chunk of a completed future """
+
+        with self.lock:
+            self.pending -= 1
+
+        return future.result()
+
+    def run(
+        self, ports: List[int], chunk_size: int
+    ) -> Generator[NmapChunk, None, None]:
+        """ Split the ports into chunks, run them and yield each as it completes """
+
+        if chunk_size <= 0:
+            chunk_size = max(1, len(ports))
+
+        for offset in range(0, len(ports), chunk_size):
+            self.submit(ports[offset : offset + chunk_size])
+
+        yield from self.wait()
+
+    def close(self) -> None:
+        """ Release the workers. Outstanding chunks are stopped and their
+        output is removed, since it will never be merged. Output of completed
+        chunks which were not merged yet is removed as well. """
+
+        with self.lock:
+            if self.pending == 0:
+                self.executor.shutdown(wait=False)
+                self.cleanup()
+                return
+            self.stopped = True
+            processes = list(self.processes.values())
+
+        for popen in processes:
+            popen.terminate()
+            try:
+                popen.wait(timeout=1)
+            except subprocess.TimeoutExpired:
+                popen.kill()
+
+        # Queued chunks return without starting nmap
+        self.executor.shutdown(wait=True)
+        self.cleanup()
+
+    def merge(self) -> None:
+        """ Combine the output of all successful chunks and remove the per-chunk
+        files """
+
+        chunks = [
+            c
+            for c in sorted(self.chunks, key=lambda c: c.index)
+            if c.returncode == 0 and os.path.isfile(c.prefix + ".xml")
+        ]
+
+        # Leave any previous output alone if there is nothing to merge
+        if not chunks:
+            self.cleanup()
+            return
+
+        # Normal output is simply concatenated
+        with open(self.prefix + ".nmap", "w") as output:
+            for chunk in chunks:
+                with open(chunk.prefix + ".nmap", "r") as fh:
+                    output.write(fh.read())
+
+        # Greppable output keeps one header and footer around every host line
+        with open(self.prefix + ".gnmap", "w") as output:
+            lines = []
+            for chunk in chunks:
+                with open(chunk.prefix + ".gnmap", "r") as fh:
+                    lines.append([l for l in fh.read().split("\n") if l != ""])
+            if lines:
+                output.write(lines[0][0] + "\n")
+                for chunk_lines in lines:
+                    for line in chunk_lines:
+                        if not line.startswith("#"):
+                            output.write(line + "\n")
+                output.write(lines[-1][-1] + "\n")
+
+        # XML output gets every chunk's ports under the first chunk's host
+        tree = None
+        for chunk in chunks:
+            try:
+                chunk_tree = ElementTree.parse(chunk.prefix + ".xml")
+            except ElementTree.ParseError:
+                continue
+            if tree is None:
+                tree = chunk_tree
+                continue
+            for port in chunk_tree.iterfind("host/ports/port"):
+                self._ports(tree, chunk_tree).append(port)
+            # Every chunk runs the host scripts, so keep the first result of each
+            for script in chunk_tree.iterfind("host/hostscript/script"):
+                hostscript = self._hostscript(tree, chunk_tree)
+                if not any([s.get("id") == script.get("id") for s in hostscript]):
+                    hostscript.append(script)
+        if tree is not None:
+            tree.write(self.prefix + ".xml", encoding="utf-8", xml_declaration=True)
+
+        self.cleanup()
+
+    def _host(
+        self, tree: ElementTree.ElementTree, chunk_tree: ElementTree.ElementTree
+    ) -> ElementTree.Element:
+        """ The merged `host` element, created if the first chunk reported
+        none """
+
+        root = tree.getroot()
+        host = root.find("host")
+        if host is None:
+            # Take the host details from the chunk instead
+            host = ElementTree.Element("host")
+            for elem in chunk_tree.find("host"):
+                if elem.tag != "ports":
+                    host.append(elem)
+            runstats = root.find("runstats")
+            index = len(root) if runstats is None else list(root).index(runstats)
+            root.insert(index, host)
+
+        return host
+
+    def _ports(
+        self, tree: ElementTree.ElementTree, chunk_tree: ElementTree.ElementTree
+    ) -> ElementTree.Element:
+        """ The merged `ports` element, created if the first chunk reported
+        none (e.g. every port it scanned was filtered) """
+
+        host = self._host(tree, chunk_tree)
+        ports = host.find("ports")
+        if ports is None:
+            # Ports go after the host's status, addresses and names
+            index = len(
+                [e for e in host if e.tag in ("status", "address", "hostnames")]
+            )
+            ports = ElementTree.Element("ports")
+            host.insert(index, ports)
+
+        return ports
+
+    def _hostscript(
+        self, tree: ElementTree.ElementTree, chunk_tree: ElementTree.ElementTree
+    ) -> ElementTree.Element:
+        """ The merged `hostscript` element, created if the first chunk ran no
+        host scripts """
+
+        host = self._host(tree, chunk_tree)
+        hostscript = host.find("hostscript")
+        if hostscript is None:
+            # Host scripts come before the traceroute and timing details
+            tail = [e for e in host if e.tag in ("trace", "times")]
+            index = len(host) if not tail else list(host).index(tail[0])
+            hostscript = ElementTree.Element("hostscript")
+            host.insert(index, hostscript)
+
+        return hostscript
+
+    def cleanup(self) -> None:
+        """ Remove the output files of every chunk """
+
+        for chunk in self.chunks:
+            for ext in ["nmap", "gnmap", "xml"]:
+                try:
+                    os.unlink(f"{chunk.prefix}.{ext}")
+                except FileNotFoundError:
+                    pass
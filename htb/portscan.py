@@ -0,0 +1,625 @@
+#!/usr/bin/env python3
+from typing import (
+    List,
+    Dict,
+    Iterable,
+    Generator,
+    AsyncIterator,
+    Optional,
+    Deque,
+    Tuple,
+    Callable,
+)
+import collections
+import threading
+import socket
+import resource
+import asyncio
+import struct
+import errno
+import queue
+import time
+
+
+# Local errors which mean we are opening connections faster than we can afford
+RESOURCE_ERRORS = {errno.EMFILE, errno.ENFILE, errno.ENOBUFS, errno.EADDRNOTAVAIL}
+
+# TCP ports probed to tell whether a machine we know nothing about is up
+READY_PORTS = [22, 80, 443, 445, 135, 139, 3389, 5985, 21, 25, 53, 8080]
+
+# Most commonly open UDP ports, most common first
+# fmt: off
+UDP_TOP_PORTS = [
+    631, 161, 137, 123, 138, 1434, 445, 135, 67, 53, 139, 500, 68, 520, 1900,
+    4500, 514, 49152, 162, 69, 5353, 111, 49154, 1701, 998, 996, 997, 999, 3283,
+    49153, 1812, 136, 2222, 2049, 32768, 5060, 1025, 1433, 3456, 80, 20031,
+    1026, 7, 1646, 1645, 593, 518, 2048, 626, 1027, 177, 1719, 427, 497, 4444,
+    1023, 65024, 19, 9, 49193, 1029, 49, 88, 1028, 17185, 1718, 623, 2000,
+    31337, 1813, 3703, 5000, 5355, 1030, 10000, 3389, 1001, 5351, 5632, 11211,
+    1194, 3702, 4045, 5004, 8888, 9200, 10080, 6481, 2302, 27015, 47808, 17, 13,
+    37, 113, 389, 636, 902, 1604, 3478, 5683, 6000,
+]
+# fmt: on
+
+# Payloads which elicit a reply from common UDP services. Other ports are
+# probed with an empty datagram.
+UDP_PAYLOADS: Dict[int, bytes] = {
+    # DNS: version.bind TXT CH
+    53: b"\x12\x34\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00"
+    b"\x07version\x04bind\x00\x00\x10\x00\x03",
+    # TFTP: read request for a file which should not exist
+    69: b"\x00\x01htb-probe\x00octet\x00",
+    # NTP: version 3 client request
+    123: b"\x1b" + b"\x00" * 47,
+    # NetBIOS: node status request for "*"
+    137: b"\x80\xf0\x00\x10\x00\x01\x00\x00\x00\x00\x00\x00"
+    b"\x20CKAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA\x00\x00\x21\x00\x01",
+    # SNMPv1: get sysDescr.0 with the "public" community
+    161: b"\x30\x29\x02\x01\x00\x04\x06public\xa0\x1c\x02\x04\x00\x00\x00\x01"
+    b"\x02\x01\x00\x02\x01\x00\x30\x0e\x30\x0c\x06\x08\x2b\x06\x01\x02"
+    b"\x01\x01\x01\x00\x05\x00",
+    # IPMI: RMCP get channel authentication capabilities
+    623: b"\x06\x00\xff\x07\x00\x00\x00\x00\x00\x00\x00\x00\x00\x09\x20\x18"
+    b"\xc8\x81\x00\x38\x8e\x04\xb5",
+}
+
+
+class AdaptiveWindow(object):
+    """ Concurrency limit which grows additively while probes complete and
+    shrinks multiplicatively when we run out of local resources. Only used from
+    a single event loop, so no locking is needed. """
+
+    def __init__(self, initial: int, maximum: int, minimum: int = 1):
+        self.size: float = float(initial)
+        self.minimum: int = minimum
+        self.maximum: int = maximum
+        self.active: int = 0
+        self.waiters: Deque[asyncio.Future] = collections.deque()
+
+    async def acquire(self) -> None:
+        while self.active >= int(self.size):
+            waiter = asyncio.get_event_loop().create_future()
+            self.waiters.append(waiter)
+            await waiter
+        self.active += 1
+
+    def release(self) -> None:
+        self.active -= 1
+        while self.waiters:
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                break
+
+    def grow(self) -> None:
+        self.size = min(self.maximum, self.size + 1)
+
+    def shrink(self) -> None:
+        self.size = max(self.minimum, self.size / 2)
+
+
+class ConnectScanner(object):
+    """ Asynchronous TCP connect() port scanner. Requires no privileges. The
+    probe timeout follows the measured round trip time of answered probes
+    (open or refused) using the TCP retransmission timeout estimator, and the
+    number of concurrent probes backs off when we run out of local resources
+    (file descriptors, buffers or ephemeral ports) and recovers as probes
+    complete. Probes which time out are retried `retries` times before the
+    port is considered filtered. An optional `rate` caps new connection
+    attempts per second. """
+
+    def __init__(
+        self,
+        host: str,
+        concurrency: int = 1000,
+        timeout: float = 1.0,
+        min_timeout: float = 0.2,
+        max_timeout: float = 3.0,
+        retries: int = 1,
+        rate: Optional[float] = None,
+    ):
+        self.host: str = host
+        self.concurrency: int = concurrency
+        self.timeout: float = timeout
+        self.min_timeout: float = min_timeout
+        self.max_timeout: float = max_timeout
+        self.retries: int = retries
+        self.rate: Optional[float] = rate
+
+        # Smoothed round trip time and variance (RFC 6298)
+        self.srtt: Optional[float] = None
+        self.rttvar: Optional[float] = None
+
+        self._next_slot: float = 0.0
+
+        # Resolve once rather than for every probe
+        info = socket.getaddrinfo(host, None, type=socket.SOCK_STREAM)[0]
+        self.family: int = info[0]
+        self.host = info[4][0]
+
+    def _observe(self, rtt: float) -> None:
+        """ Update the timeout from a measured round trip time """
+
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+
+        self.timeout = min(
+            self.max_timeout, max(self.min_timeout, self.srtt + 4 * self.rttvar)
+        )
+
+    async def _pace(self) -> None:
+        """ Wait for our turn if a maximum rate is configured """
+
+        if self.rate is None:
+            return
+
+        now = time.monotonic()
+        slot = max(now, self._next_slot)
+        self._next_slot = slot + 1.0 / self.rate
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def _connect(self, sock: socket.socket, port: int) -> int:
+        """ Start a non-blocking connect and wait for it to complete. Returns the
+        resulting errno (0 on success). Raises asyncio.TimeoutError if the
+        connection is neither accepted nor refused in time. """
+
+        error = sock.connect_ex((self.host, port))
+        if error != errno.EINPROGRESS:
+            return error
+
+        loop = asyncio.get_event_loop()
+        writable = loop.create_future()
+        loop.add_writer(sock, lambda: writable.done() or writable.set_result(None))
+        try:
+            await asyncio.wait_for(writable, self.timeout)
+        finally:
+            loop.remove_writer(sock)
+
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+
+    async def probe(self, port: int, window: AdaptiveWindow) -> Optional[bool]:
+        """ Probe a single port. Returns True if open, False if closed and None
+        if no answer was received. """
+
+        for _ in range(self.retries + 1):
+            await self._pace()
+            await window.acquire()
+            start = time.monotonic()
+            try:
+                sock = socket.socket(self.family, socket.SOCK_STREAM)
+            except OSError as e:
+                window.release()
+                if e.errno not in RESOURCE_ERRORS:
+                    raise
+                # Back off and try this port again
+                window.shrink()
+                await asyncio.sleep(0.05)
+                continue
+
+            try:
+                sock.setblocking(False)
+                error = await self._connect(sock, port)
+            except asyncio.TimeoutError:
+                continue
+            finally:
+                sock.close()
+                window.release()
+
+            if error in RESOURCE_ERRORS:
+                window.shrink()
+                await asyncio.sleep(0.05)
+                continue
+
+            # Open or refused, either way the host answered
+            if error in (0, errno.ECONNREFUSED):
+                self._observe(time.monotonic() - start)
+                window.grow()
+                return error == 0
+
+            # Unreachable or otherwise failed, this is not an answer
+            return None
+
+        return None
+
+    async def scan(self, ports: Iterable[int]) -> AsyncIterator[int]:
+        """ Scan the given ports, yielding open ports as they are found """
+
+        # Leave some descriptors for the rest of the process
+        limit = max(1, resource.getrlimit(resource.RLIMIT_NOFILE)[0] - 64)
+        window = AdaptiveWindow(min(self.concurrency, limit), self.concurrency)
+        pending: asyncio.Queue = asyncio.Queue()
+        found: asyncio.Queue = asyncio.Queue()
+
+        for port in ports:
+            pending.put_nowait(port)
+
+        async def worker():
+            while True:
+                try:
+                    port = pending.get_nowait()
+                except asyncio.QueueEmpty:
+                    return
+                if await self.probe(port, window):
+                    await found.put(port)
+
+        workers = [
+            asyncio.ensure_future(worker())
+            for _ in range(min(self.concurrency, pending.qsize()))
+        ]
+        done = asyncio.ensure_future(asyncio.gather(*workers))
+        done.add_done_callback(lambda _: found.put_nowait(None))
+
+        try:
+            while True:
+                port = await found.get()
+                if port is None:
+                    break
+                yield port
+
+            # Propagate worker exceptions
+            await done
+        finally:
+            # Stop the workers if the scan is abandoned early. A probe which
+            # completes as it is cancelled swallows the cancellation, so the
+            # remaining ports are dropped as well.
+            if not done.done():
+                while not pending.empty():
+                    pending.get_nowait()
+                done.cancel()
+                await asyncio.gather(done, return_exceptions=True)
+
+
+class UdpScanner(ConnectScanner):
+    """ Asynchronous UDP port scanner. Each port is sent a protocol specific
+    payload where one is known (see `UDP_PAYLOADS`). A reply means the port is
+    open and an ICMP port unreachable means it is closed. Unanswered probes
+    are retransmitted `retries` times, doubling the timeout each time. Ports
+    which never answer may be open or filtered and are not reported. """
+
+    def __init__(
+        self,
+        host: str,
+        concurrency: int = 100,
+        timeout: float = 1.0,
+        min_timeout: float = 0.2,
+        max_timeout: float = 3.0,
+        retries: int = 2,
+        rate: Optional[float] = None,
+    ):
+        super(UdpScanner, self).__init__(
+            host,
+            concurrency=concurrency,
+            timeout=timeout,
+            min_timeout=min_timeout,
+            max_timeout=max_timeout,
+            retries=retries,
+            rate=rate,
+        )
+
+    async def _exchange(self, sock: socket.socket, payload: bytes, timeout: float):
+        """ Send a datagram and wait for a reply. Raises asyncio.TimeoutError if
+        nothing is received in time and ConnectionRefusedError if the port is
+        closed. """
+
+        sock.send(payload)
+
+        loop = asyncio.get_event_loop()
+        readable = loop.create_future()
+        loop.add_reader(sock, lambda: readable.done() or readable.set_result(None))
+        try:
+            await asyncio.wait_for(readable, timeout)
+        finally:
+            loop.remove_reader(sock)
+
+        return sock.recv(65535)
+
+    async def probe(self, port: int, window: AdaptiveWindow) -> Optional[bool]:
+        """ Probe a single port. Returns True if open, False if closed and None
+        if no answer was received. """
+
+        payload = UDP_PAYLOADS.get(port, b"")
+
+        for attempt in range(self.retries + 1):
+            await self._pace()
+            await window.acquire()
+            start = time.monotonic()
+            try:
+                sock = socket.socket(self.family, socket.SOCK_DGRAM)
+            except OSError as e:
+                window.release()
+                if e.errno not in RESOURCE_ERRORS:
+                    raise
+                window.shrink()
+                await asyncio.sleep(0.05)
+                continue
+
+            try:
+                sock.setblocking(False)
+                # Connected sockets receive ICMP errors for the port
+                sock.connect((self.host, port))
+                await self._exchange(sock, payload, self.timeout * (2 ** attempt))
+            except asyncio.TimeoutError:
+                continue
+            except ConnectionRefusedError:
+                self._observe(time.monotonic() - start)
+                window.grow()
+                return False
+            except OSError as e:
+                if e.errno not in RESOURCE_ERRORS:
+                    raise
+                window.shrink()
+                await asyncio.sleep(0.05)
+                continue
+            finally:
+                sock.close()
+                window.release()
+
+            self._observe(time.monotonic() - start)
+            window.grow()
+            return True
+
+        return None
+
+
+class ReadinessProbe(object):
+    """ Waits for a freshly started host to offer services. Every round sends
+    an ICMP echo request (where unprivileged ICMP sockets are allowed) and
+    connects to each of the given TCP ports at the same time. The host is
+    ready as soon as one of the ports accepts a connection. An echo reply or a
+    refused connection only shows that the network stack is up, so probing
+    continues until a service answers or `settle` seconds have passed since
+    the host first answered. Rounds start `initial` seconds apart and back
+    off exponentially up to `maximum` seconds. """
+
+    def __init__(
+        self,
+        host: str,
+        ports: Iterable[int],
+        timeout: float = 1.0,
+        initial: float = 0.25,
+        maximum: float = 5.0,
+        settle: float = 10.0,
+    ):
+        self.ports: List[int] = list(ports)
+        self.scanner = ConnectScanner(
+            host, concurrency=max(1, len(self.ports)), timeout=timeout, retries=0
+        )
+        self.host: str = self.scanner.host
+        self.initial: float = initial
+        self.maximum: float = maximum
+        self.settle: float = settle
+        self.sequence: int = 0
+
+    def _icmp_socket(self) -> Optional[socket.socket]:
+        """ Open an unprivileged ICMP socket, or None if it isn't allowed """
+
+        if self.scanner.family != socket.AF_INET:
+            return None
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP)
+        except OSError:
+            return None
+
+        sock.setblocking(False)
+        return sock
+
+    async def _ping(self, sock: socket.socket) -> bool:
+        """ Send an echo request and wait for the reply. The kernel fills in
+        the identifier and checksum of unprivileged ICMP sockets. """
+
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        sequence = self.sequence
+        deadline = time.monotonic() + self.scanner.timeout
+        loop = asyncio.get_event_loop()
+
+        try:
+            sock.sendto(struct.pack("!BBHHH", 8, 0, 0, 0, sequence), (self.host, 0))
+        except OSError:
+            return False
+
+        while True:
+            readable = loop.create_future()
+            loop.add_reader(sock, lambda: readable.done() or readable.set_result(None))
+            try:
+                await asyncio.wait_for(readable, max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                loop.remove_reader(sock)
+
+            try:
+                reply = sock.recv(65535)
+            except OSError:
+                return False
+
+            # Echo reply to this round, rather than a late one
+            if len(reply) >= 8 and reply[0] == 0:
+                if struct.unpack("!H", reply[6:8])[0] == sequence:
+                    return True
+
+    async def round(self, icmp: Optional[socket.socket]) -> Tuple[bool, Optional[int]]:
+        """ Probe the host once. Returns whether the host answered at all and
+        the first port which accepted a connection. """
+
+        window = AdaptiveWindow(len(self.ports), len(self.ports))
+        probes = {
+            asyncio.ensure_future(self.scanner.probe(port, window)): port
+            for port in self.ports
+        }
+        if icmp is not None:
+            probes[asyncio.ensure_future(self._ping(icmp))] = None
+
+        answered = False
+        pending = set(probes)
+
+        try:
+            while pending:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    result = task.result()
+                    # A ping only counts when it was answered
+                    if result is not None and (probes[task] is not None or result):
+                        answered = True
+                    if result is True and probes[task] is not None:
+                        return True, probes[task]
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.wait(pending)
+
+        return answered, None
+
+    async def wait(
+        self, timeout: Optional[float] = None, report: Callable[[str], None] = None
+    ) -> bool:
+        """ Probe until the host is ready. Returns False if `timeout` seconds
+        pass first. Progress messages are passed to `report`. """
+
+        start = time.monotonic()
+        up: Optional[float] = None
+        interval = self.initial
+        icmp = self._icmp_socket()
+
+        try:
+            while True:
+                answered, port = await self.round(icmp)
+                now = time.monotonic()
+
+                if port is not None:
+                    if report is not None:
+                        report(f"{port}/tcp answered after {now-start:.1f}s")
+                    return True
+
+                if answered and up is None:
+                    if report is not None:
+                        report(f"host is up after {now-start:.1f}s")
+                    up = now
+                    interval = self.initial
+
+                if up is not None and now - up >= self.settle:
+                    return True
+
+                if timeout is not None and now - start >= timeout:
+                    return False
+
+                await asyncio.sleep(interval)
+                interval = min(self.maximum, interval * 2)
+        finally:
+            if icmp is not None:
+                icmp.close()
+
+
+# How often a stream waiting for results checks whether it should stop
+STOP_POLL = 0.25
+
+
+def stream(
+    scanner: ConnectScanner,
+    ports: Iterable[int],
+    stop: Optional[threading.Event] = None,
+) -> Generator[int, None, None]:
+    """ Run an asynchronous scanner on a private event loop in a background
+    thread and yield open ports as they are found. The scan is stopped if the
+    generator is closed before it completes or once `stop` is set. """
+
+    results: queue.Queue = queue.Queue()
+    done = object()
+    lock = threading.Lock()
+    running: Dict[str, object] = {}
+
+    async def run():
+        with lock:
+            if "stopped" in running:
+                return
+            running["loop"] = asyncio.get_event_loop()
+            running["task"] = asyncio.current_task()
+        try:
+            async for port in scanner.scan(ports):
+                results.put(port)
+        finally:
+            # The loop is closed once we return
+            with lock:
+                del running["task"]
+
+    def target():
+        try:
+            asyncio.run(run())
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            results.put(e)
+        finally:
+            results.put(done)
+
+    def halt():
+        with lock:
+            running["stopped"] = True
+            if "task" in running:
+                running["loop"].call_soon_threadsafe(running["task"].cancel)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+
+    try:
+        while True:
+            try:
+                result = results.get(timeout=None if stop is None else STOP_POLL)
+            except queue.Empty:
+                result = None
+            if stop is not None and stop.is_set():
+                break
+            if result is None:
+                continue
+            if result is done:
+                break
+            if isinstance(result, Exception):
+                raise result
+            yield result
+    finally:
+        halt()
+        thread.join()
+
+
+def tcp_scan(
+    host: str,
+    ports: Iterable[int] = range(1, 65536),
+    stop: Optional[threading.Event] = None,
+    **kwargs,
+) -> Generator[int, None, None]:
+    """ Scan TCP ports on a host without privileges, yielding open ports as they
+    are discovered. The scan ends early once `stop` is set. Keyword arguments
+    are passed to `ConnectScanner`. """
+    yield from stream(ConnectScanner(host, **kwargs), ports, stop)
+
+
+def udp_scan(
+    host: str,
+    ports: Iterable[int] = UDP_TOP_PORTS,
+    stop: Optional[threading.Event] = None,
+    **kwargs,
+) -> Generator[int, None, None]:
+    """ Scan UDP ports on a host without privileges, yielding ports which
+    answered as they are discovered. The scan ends early once `stop` is set.
+    Keyword arguments are passed to `UdpScanner`. """
+    yield from stream(UdpScanner(host, **kwargs), ports, stop)
+
+
+def wait_ready(
+    host: str,
+    ports: Iterable[int] = READY_PORTS,
+    timeout: Optional[float] = None,
+    report: Callable[[str], None] = None,
+    **kwargs,
+) -> bool:
+    """ Wait until a host offers services. Keyword arguments are passed to
+    `ReadinessProbe`. """
+    return asyncio.run(ReadinessProbe(host, ports, **kwargs).wait(timeout, report))
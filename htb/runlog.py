@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+from typing import List, Dict, Any, Generator
+from dataclasses import dataclass, field, asdict
+import threading
+import json
+
+
+@dataclass
+class RunRecord(object):
+    """ Timing, resource usage and outcome of a single scanner run """
+
+    scanner: str
+    machine: str
+    port: int
+    protocol: str
+    start: float
+    end: float = 0.0
+    # User and system time of the scanner's processes (and their children)
+    cpu: float = 0.0
+    # Largest resident set size of any of the scanner's processes in bytes
+    max_rss: int = 0
+    lines: int = 0
+    bytes: int = 0
+    returncodes: List[int] = field(default_factory=list)
+    cancelled: bool = False
+    # Last status reported by the scanner
+    status: str = ""
+
+    @property
+    def wall(self) -> float:
+        return max(0.0, self.end - self.start)
+
+    @property
+    def failed(self) -> bool:
+        return any([code != 0 for code in self.returncodes])
+
+    def json(self) -> Dict[str, Any]:
+        return asdict(self)
+
+    @classmethod
+    def from_json(cls, data: Dict[str, Any]) -> "RunRecord":
+        return RunRecord(**data)
+
+
+class RunLog(object):
+    """ Append-only log of scanner runs stored as JSON lines """
+
+    def __init__(self, path: str):
+        self.path: str = path
+        self.lock = threading.Lock()
+
+    def append(self, record: RunRecord) -> None:
+        """ Add a record to the end of the log """
+
+        line = json.dumps(record.json()) + "\n"
+        with self.lock:
+            with open(self.path, "a") as fh:
+                fh.write(line)
+
+    def __iter__(self) -> Generator[RunRecord, None, None]:
+        """ Read every record in the log. Lines which can't be parsed (e.g. a
+        partial write) are skipped. """
+
+        try:
+            fh = open(self.path, "r")
+        except FileNotFoundError:
+            return
+
+        with fh:
+            for line in fh:
+                try:
+                    yield RunRecord.from_json(json.loads(line))
+                except (ValueError, TypeError):
+                    continue
+
+
+def summarize(records: List[RunRecord]) -> Dict[str, Dict[str, Any]]:
+    """ Aggregate run records by scanner """
+
+    summary: Dict[str, Dict[str, Any]] = {}
+
+    for record in records:
+        s = summary.setdefault(
+            record.scanner,
+            {
+                "runs": 0,
+                "cancelled": 0,
+                "failed": 0,
+                "wall": 0.0,
+                "cpu": 0.0,
+                "max_rss": 0,
+                "lines": 0,
+                "bytes": 0,
+            },
+        )
+        s["runs"] += 1
+        s["cancelled"] += int(record.cancelled)
+        s["failed"] += int(record.failed and not record.cancelled)
+        s["wall"] += record.wall
+        s["cpu"] += record.cpu
+        s["max_rss"] = max(s["max_rss"], record.max_rss)
+        s["lines"] += record.lines
+        s["bytes"] += record.bytes
+
+    return summary
@@ -1,7 +1,23 @@
 #!/usr/bin/env python3
 from htb.scanner.scanner import Service, Scanner, Tracker
-from htb.scanner.nikto import NiktoScanner
-from htb.scanner.enum4linux import Enum4LinuxScanner
-from htb.scanner.gobuster import GobusterScanner
+from htb.scanner.index import ScannerIndex
+from htb.scanner.registry import ScannerRegistry, LazyScanner, load_object
 
-AVAILABLE_SCANNERS = [NiktoScanner(), Enum4LinuxScanner(), GobusterScanner()]
+# Built-in scanners are only imported once they are used
+BUILTIN_SCANNERS = {
+    "nikto": "htb.scanner.nikto:NiktoScanner",
+    "enum4linux": "htb.scanner.enum4linux:Enum4LinuxScanner",
+    "gobuster": "htb.scanner.gobuster:GobusterScanner",
+}
+
+AVAILABLE_SCANNERS = ScannerRegistry(BUILTIN_SCANNERS)
+
+
+def __getattr__(name: str):
+    """ Import built-in scanner classes on first access """
+
+    for target in BUILTIN_SCANNERS.values():
+        if target.endswith(f":{name}"):
+            return load_object(target)
+
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+from typing import List, Dict, Tuple, Optional
+from concurrent.futures import ThreadPoolExecutor
+from configparser import ConfigParser
+import statistics
+import threading
+import socket
+import uuid
+import time
+import ssl
+
+
+class Calibration(object):
+    """ Response times and error rate of a web service, and the scanner
+    settings derived from them. `idle` holds the times of requests sent one
+    at a time, `loaded` the times of requests sent concurrently and `errors`
+    the fraction of all requests which failed. """
+
+    def __init__(self, idle: List[float], loaded: List[float], errors: float):
+        self.idle: List[float] = idle
+        self.loaded: List[float] = loaded
+        self.errors: float = errors
+
+    def __repr__(self) -> str:
+        rtt = "none" if self.rtt is None else f"{self.rtt*1000:.0f}ms"
+        return f"<Calibration rtt={rtt},slowdown={self.slowdown:.1f},errors={self.errors:.0%}>"
+
+    @property
+    def rtt(self) -> Optional[float]:
+        """ Median response time of a single request, or None if nothing
+        answered """
+        return statistics.median(self.idle) if len(self.idle) else None
+
+    @property
+    def slowdown(self) -> float:
+        """ How much slower requests get when sent concurrently """
+
+        if self.rtt is None or len(self.loaded) == 0:
+            return 1.0
+
+        return max(1.0, statistics.median(self.loaded) / max(self.rtt, 1e-6))
+
+    def threads(self, minimum: int, maximum: int) -> int:
+        """ Concurrent requests to use. A service which keeps up with
+        concurrent requests gets `maximum`, one which slows down or fails under
+        load gets proportionally fewer. """
+
+        if self.rtt is None:
+            return minimum
+
+        threads = maximum * min(1.0, 2 / self.slowdown) * max(0.0, 1 - 2 * self.errors)
+        return max(minimum, min(maximum, int(threads)))
+
+    def timeout(self, minimum: float, maximum: float) -> float:
+        """ Request timeout with plenty of room over the slowest response """
+
+        rtts = self.idle + self.loaded
+        if len(rtts) == 0:
+            return maximum
+
+        return max(minimum, min(maximum, 4 * max(rtts)))
+
+    def delay(self, threshold: float) -> float:
+        """ Pause between requests once the error rate passes `threshold` """
+
+        if self.errors <= threshold or self.rtt is None:
+            return 0.0
+
+        return self.rtt * self.slowdown
+
+
+class Calibrator(object):
+    """ Measures web services before they are scanned. Scanners report the
+    error rate they saw afterwards, and the next calibration of the same
+    service never assumes it is healthier than that. """
+
+    def __init__(self):
+        self.observed: Dict[Tuple[str, int], float] = {}
+        self.lock = threading.Lock()
+
+    def _request(self, host: str, port: int, tls: bool, timeout: float):
+        """ Time a request for a path which does not exist. Returns None if it
+        failed, timed out or the server reported an error. """
+
+        request = (
+            f"GET /{uuid.uuid4().hex} HTTP/1.1\r\n"
+            f"Host: {host}\r\n"
+            f"User-Agent: python-htb\r\n"
+            f"Connection: close\r\n\r\n"
+        ).encode("utf-8")
+
+        start = time.monotonic()
+
+        try:
+            sock = socket.create_connection((host, port), timeout=timeout)
+            try:
+                if tls:
+                    context = ssl.create_default_context()
+                    context.check_hostname = False
+                    context.verify_mode = ssl.CERT_NONE
+                    sock = context.wrap_socket(sock, server_hostname=host)
+                sock.sendall(request)
+                status = sock.recv(12)
+            finally:
+                sock.close()
+        except OSError:
+            return None
+
+        if not status.startswith(b"HTTP/") or len(status) < 12:
+            return None
+
+        try:
+            code = int(status[9:12])
+        except ValueError:
+            return None
+
+        # Overloaded or rate limiting
+        if code >= 500 or code == 429:
+            return None
+
+        return time.monotonic() - start
+
+    def measure(
+        self,
+        host: str,
+        port: int,
+        tls: bool = False,
+        samples: int = 10,
+        concurrency: int = 10,
+        timeout: float = 5.0,
+    ) -> Calibration:
+        """ Send half of `samples` requests one at a time to measure the
+        response time, then `samples` requests `concurrency` at a time to see
+        how the service copes with load """
+
+        def request(_):
+            return self._request(host, port, tls, timeout)
+
+        idle = [request(n) for n in range(max(1, samples // 2))]
+
+        # Nothing answered, don't bother loading it
+        if not any([r is not None for r in idle]):
+            loaded = []
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as pool:
+                loaded = list(pool.map(request, range(samples)))
+
+        results = idle + loaded
+        errors = len([r for r in results if r is None]) / len(results)
+
+        with self.lock:
+            errors = max(errors, self.observed.get((host, port), 0.0))
+
+        return Calibration(
+            [r for r in idle if r is not None],
+            [r for r in loaded if r is not None],
+            errors,
+        )
+
+    def observe(self, host: str, port: int, requests: int, errors: int) -> None:
+        """ Record the error rate seen by a finished scan """
+
+        if requests <= 0:
+            return
+
+        with self.lock:
+            self.observed[(host, port)] = min(1.0, errors / requests)
+
+
+# Shared by every scanner so they learn from each other's runs
+CALIBRATOR = Calibrator()
+
+
+def calibrate(
+    config: ConfigParser, name: str, host: str, port: int, tls: bool
+) -> Optional[Calibration]:
+    """ Measure a service for the named scanner unless `calibrate` is turned off
+    in its section of the configuration """
+
+    if not config.getboolean(name, "calibrate", fallback=True):
+        return None
+
+    return CALIBRATOR.measure(
+        host,
+        port,
+        tls,
+        samples=config.getint(name, "calibration_samples", fallback=10),
+        timeout=config.getfloat(name, "max_timeout", fallback=10.0),
+    )
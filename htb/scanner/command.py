@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+from typing import List, Union
+from configparser import SectionProxy
+import shlex
+import os
+
+from htb.scanner.scanner import ExternalScanner, Service, Tracker
+
+
+class CommandScanner(ExternalScanner):
+    """ Run a command line template from the configuration file:
+
+        [scanner:whatweb]
+        command = whatweb -a 3 {url}
+        ports = 80, 443, 8080
+        regex = .*http.*
+        protocol = tcp
+        recommended = no
+
+    The template may reference {hostname}, {ip}, {port}, {protocol}, {url},
+    {path} (the analysis directory) and {output} (the scan output file). If
+    {output} is not used, the command's output is saved there instead. """
+
+    def __init__(
+        self,
+        name: str,
+        command: str,
+        ports: List[int],
+        regex: List[str],
+        protocol: List[str],
+        recommended: bool = False,
+    ):
+        super(CommandScanner, self).__init__(
+            name=name,
+            ports=ports,
+            regex=regex,
+            protocol=protocol,
+            recommended=recommended,
+        )
+
+        self.command: str = command
+
+    @classmethod
+    def from_config(cls, name: str, section: SectionProxy) -> "CommandScanner":
+        """ Build the scanner from its configuration section """
+
+        def split(key: str, fallback: str = "") -> List[str]:
+            return [
+                v.strip() for v in section.get(key, fallback).split(",") if v.strip()
+            ]
+
+        return CommandScanner(
+            name=name,
+            command=section["command"],
+            ports=[int(p) for p in split("ports")],
+            regex=split("regex"),
+            protocol=split("protocol", "tcp"),
+            recommended=section.getboolean("recommended", fallback=False),
+        )
+
+    def scan(
+        self,
+        tracker: Tracker,
+        path: str,
+        hostname: str,
+        machine: "htb.machine.Machine",
+        service: Service,
+    ) -> None:
+        """ Fill in the template and run the command """
+
+        output_path = os.path.join(path, "scans", f"{self.ident(service)}.txt")
+        scheme = "https" if service.port in [443, 8443] else "http"
+
+        values = {
+            "hostname": hostname,
+            "ip": machine.ip,
+            "port": service.port,
+            "protocol": service.protocol,
+            "url": f"{scheme}://{hostname}:{service.port}",
+            "path": path,
+            "output": output_path,
+        }
+        argv = [arg.format(**values) for arg in shlex.split(self.command)]
+
+        if "{output}" in self.command:
+            yield from super(CommandScanner, self).scan(
+                tracker, path, hostname, machine, service, argv=argv
+            )
+            return
+
+        # Silent commands write straight to the output file
+        if tracker.silent:
+            yield from super(CommandScanner, self).scan(
+                tracker, path, hostname, machine, service, argv, output_path=output_path
+            )
+            return
+
+        with open(output_path, "wb") as output:
+            tracker.data["output"] = output
+            yield from super(CommandScanner, self).scan(
+                tracker, path, hostname, machine, service, argv=argv
+            )
+
+    def do_line(
+        self, tracker: Tracker, service: Service, line: bytes
+    ) -> Union[None, str]:
+        """ Save the output if the command does not write its own """
+
+        if "output" in tracker.data:
+            tracker.data["output"].write(line + b"\n")
+
+        return None
@@ -1,16 +1,23 @@
 #!/usr/bin/env python3
+from typing import Iterable, Union
 import subprocess
-import shlex
-import time
-import sys
 import os
+import re
 
 # from htb.machine import Machine
-from htb.scanner.scanner import Scanner, Service, Tracker
+from htb.scanner.scanner import ExternalScanner, Service, Tracker
+from htb.findings import Finding, SmbUser, SmbGroup, SmbShare
 
 
-class Enum4LinuxScanner(Scanner):
-    """ Scan a web server with nikto """
+class Enum4LinuxScanner(ExternalScanner):
+    """ Enumerate users, groups and shares over SMB with enum4linux """
+
+    # Section headers look like "|    Users on 10.10.10.10    |"
+    HEADER = re.compile(rb"^\|\s*(.+?)\s*\|\s*$")
+
+    USER = re.compile(rb"user:\[(.+?)\] rid:\[(0x[0-9a-fA-F]+)\]")
+    GROUP = re.compile(rb"group:\[(.+?)\] rid:\[(0x[0-9a-fA-F]+)\]")
+    SHARE = re.compile(rb"^\s+(\S+)\s+(Disk|IPC|Printer)\s*(.*)$")
 
     def __init__(self):
         super(Enum4LinuxScanner, self).__init__(
@@ -28,45 +35,89 @@ class Enum4LinuxScanner(Scanner):
         machine: "htb.machine.Machine",
         service: Service,
     ) -> None:
-        """ Scan the host with nikto """
+        """ Scan the host with enum4linux """
 
         output_path = os.path.join(path, "scans", f"{self.ident(service)}.txt")
-
-        # If we are backgrounded, ignore stdout and stderr
-        output = open(output_path, "w")
-
-        # Call enum4linux
-        tracker.data["popen"] = subprocess.Popen(
-            ["enum4linux", "-a", hostname],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.DEVNULL,
-        )
-
-        while tracker.data["popen"].poll() is None:
-            line = tracker.data["popen"].stdout.readline()
-
-            # Output if not silent
-            if not tracker.silent:
-                sys.stdout.write(line.decode("utf-8"))
-
-            output.write(line.decode("utf-8"))
-
-            # Set status
-            if line.startswith(b"|"):
-                yield line.split(b"|")[1].decode("utf-8").strip()
-
-            time.sleep(0.1)
-
-        output.close()
-
-        yield "completed"
-
-    def cancel(self, tracker: Tracker) -> None:
-        """ Ensure the running process dies """
-
-        tracker.data["popen"].terminate()
-        try:
-            tracker.data["popen"].wait(timeout=1)
-        except subprocess.TimeoutExpired:
-            tracker.data["popen"].kill()
-            tracker.data["popen"].wait()
+        argv = ["enum4linux", "-a", hostname]
+
+        # Silent scans write enum4linux's output straight to the file
+        if tracker.silent:
+            yield from super(Enum4LinuxScanner, self).scan(
+                tracker,
+                path,
+                hostname,
+                machine,
+                service,
+                argv,
+                output_path=output_path,
+                stderr=subprocess.DEVNULL,
+            )
+            return
+
+        with open(output_path, "wb") as output:
+            tracker.data["output"] = output
+            yield from super(Enum4LinuxScanner, self).scan(
+                tracker,
+                path,
+                hostname,
+                machine,
+                service,
+                argv,
+                stderr=subprocess.DEVNULL,
+            )
+
+    def do_line(
+        self, tracker: Tracker, service: Service, line: bytes
+    ) -> Union[None, str]:
+        """ Save the output and report the section being enumerated """
+
+        if "output" in tracker.data:
+            tracker.data["output"].write(line + b"\n")
+
+        match = self.HEADER.match(line)
+        if match is not None:
+            return match.group(1).decode("utf-8", errors="replace")
+
+        return None
+
+    def parse(self, service: Service, line: bytes) -> Iterable[Finding]:
+        """ Extract enumerated users, groups and shares """
+
+        common = {
+            "scanner": self.name,
+            "port": service.port,
+            "protocol": service.protocol,
+        }
+
+        match = self.USER.search(line)
+        if match is not None:
+            return [
+                SmbUser(
+                    **common,
+                    name=match.group(1).decode("utf-8", errors="replace"),
+                    rid=match.group(2).decode("utf-8", errors="replace"),
+                )
+            ]
+
+        match = self.GROUP.search(line)
+        if match is not None:
+            return [
+                SmbGroup(
+                    **common,
+                    name=match.group(1).decode("utf-8", errors="replace"),
+                    rid=match.group(2).decode("utf-8", errors="replace"),
+                )
+            ]
+
+        match = self.SHARE.match(line)
+        if match is not None:
+            return [
+                SmbShare(
+                    **common,
+                    name=match.group(1).decode("utf-8", errors="replace"),
+                    type=match.group(2).decode("utf-8", errors="replace"),
+                    comment=match.group(3).decode("utf-8", errors="replace").strip(),
+                )
+            ]
+
+        return []
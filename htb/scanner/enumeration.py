@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+from typing import Generator
+
+from htb.scanner.scanner import Scanner, Service, Tracker
+from htb.exceptions import *
+
+
+class EnumerationScanner(Scanner):
+    """ Runs `Machine.enumerate` as a job, so machine enumeration can be
+    scheduled and monitored alongside scanner jobs. It matches no services
+    and is not part of the scanner registry. """
+
+    def __init__(self, force: bool = False, incremental: bool = False):
+        super(EnumerationScanner, self).__init__(
+            name="enum", ports=[], regex=[], protocol=[]
+        )
+
+        self.force: bool = force
+        self.incremental: bool = incremental
+
+    @classmethod
+    def service(cls, machine: "htb.machine.Machine") -> Service:
+        """ Placeholder service standing for the whole machine """
+
+        service = Service()
+        service.host = machine.ip
+        service.protocol = "all"
+        service.name = "discovery"
+        service.state = "open"
+        return service
+
+    def match_service(self, service: Service) -> bool:
+        return service.protocol == "all"
+
+    def scan(
+        self,
+        tracker: Tracker,
+        path: str,
+        hostname: str,
+        machine: "htb.machine.Machine",
+        service: Service,
+    ) -> Generator[str, None, None]:
+        """ Enumerate the machine, reporting progress as the job status """
+
+        def report(message: str) -> None:
+            tracker.status = message
+            tracker.emit(message)
+            if tracker.stop:
+                raise Cancelled
+
+        try:
+            machine.enumerate(
+                force=self.force, report=report, incremental=self.incremental
+            )
+        except Cancelled:
+            yield "cancelled"
+            return
+        except (NotRunning, Terminating):
+            yield "machine not running"
+            return
+        except MasscanFailed:
+            yield "masscan failed"
+            return
+        except NmapFailed:
+            yield "nmap failed"
+            return
+
+        yield f"completed ({len(machine.services)} service(s))"
@@ -1,14 +1,22 @@
 #!/usr/bin/env python3
-from typing import Union
+from typing import Any, Dict, Union, List, Tuple, IO, Iterable, Optional
 import subprocess
+import threading
+import datetime
+import shutil
 import signal
 import shlex
+import mmap
+import math
 import time
 import sys
 import os
+import re
 
 # from htb.machine import Machine
 from htb.scanner.scanner import ExternalScanner, Scanner, Service, Tracker
+from htb.scanner.calibration import Calibration, CALIBRATOR, calibrate
+from htb.findings import Finding, WebPath
 from htb import util
 
 
@@ -17,6 +25,13 @@ class GobusterScanner(ExternalScanner):
 
     LINE_DELIM = [b"\n", b"\r"]
 
+    # Gobuster's default number of concurrent requests per process
+    THREADS = 10
+
+    ERROR = b"[ERROR]"
+    PROGRESS = re.compile(rb"Progress:\s*(\d+)")
+    RESULT = re.compile(rb"(/\S*)\s+\(Status:\s*(\d+)\)(?:\s*\[Size:\s*(\d+)\])?")
+
     def __init__(self):
         super(GobusterScanner, self).__init__(
             name="gobuster",
@@ -42,41 +57,313 @@ class GobusterScanner(ExternalScanner):
             "wordlist",
             fallback="/usr/share/wordlists/dirbuster/directory-list-2.3-small.txt",
         )
-        url = f"{hostname}:{service.port}"
-
-        yield from super(GobusterScanner, self).scan(
-            tracker,
-            path,
-            hostname,
-            machine,
-            service,
-            [
-                "gobuster",
-                "dir",
-                "-w",
-                wordlist,
-                "-f",
-                "-k",
-                "-o",
-                output_path,
-                "-u",
-                url,
-            ],
+        # Calibration and the scan have to talk to the same endpoint
+        tls = service.port in [443, 8443] or "https" in service.name
+        url = f"{'https' if tls else 'http'}://{hostname}:{service.port}"
+
+        yield "calibrating"
+        calibration = calibrate(
+            machine.connection.config, self.name, hostname, service.port, tls
         )
+        tuning, threads = self.tuning(machine, calibration)
+
+        argv = ["gobuster", "dir", "-f", "-k", "-u", url] + tuning
+
+        with open(wordlist, "rb") as fh:
+            size = os.fstat(fh.fileno()).st_size
+            shards = self.shards(machine, hostname, service, size, threads, calibration)
+
+            if shards <= 1:
+                yield from super(GobusterScanner, self).scan(
+                    tracker,
+                    path,
+                    hostname,
+                    machine,
+                    service,
+                    argv + ["-w", wordlist, "-o", output_path],
+                    output_path=f"{output_path}.log",
+                    results_path=output_path,
+                )
+            else:
+                yield from self.sharded_scan(
+                    tracker, machine, service, fh, shards, argv, output_path
+                )
+
+        # Later calibrations of this service start from the error rate we saw
+        if not tracker.stop:
+            CALIBRATOR.observe(
+                hostname,
+                service.port,
+                tracker.data.get("requests", 0),
+                tracker.data.get("errors", 0),
+            )
+
+    def tuning(
+        self, machine: "htb.machine.Machine", calibration: Optional[Calibration]
+    ) -> Tuple[List[str], int]:
+        """ Thread count, timeout and delay arguments for a calibrated service
+        within the bounds set in the `gobuster` section. Returns the arguments
+        and the number of threads per process. """
+
+        if calibration is None:
+            return [], self.THREADS
+
+        config = machine.connection.config
+        threads = calibration.threads(
+            config.getint("gobuster", "min_threads", fallback=4),
+            config.getint("gobuster", "max_threads", fallback=50),
+        )
+        timeout = calibration.timeout(
+            config.getfloat("gobuster", "min_timeout", fallback=2.0),
+            config.getfloat("gobuster", "max_timeout", fallback=10.0),
+        )
+        argv = ["-t", str(threads), "--timeout", f"{timeout:.1f}s"]
+
+        delay = calibration.delay(
+            config.getfloat("gobuster", "max_error_rate", fallback=0.05)
+        )
+        if delay > 0:
+            argv += ["--delay", f"{delay*1000:.0f}ms"]
+
+        return argv, threads
+
+    def shards(
+        self,
+        machine: "htb.machine.Machine",
+        hostname: str,
+        service: Service,
+        size: int,
+        threads: int = THREADS,
+        calibration: Optional[Calibration] = None,
+    ) -> int:
+        """ Decide how many gobuster workers to run for a wordlist of the given
+        size. The `shards` option is either a fixed count or "auto", in which
+        case enough workers of `threads` threads are started to keep
+        `target_rate` requests per second in flight given the measured round
+        trip time to the service. """
+
+        config = machine.connection.config
+        shards = config.get("gobuster", "shards", fallback="1")
+        max_shards = config.getint("gobuster", "max_shards", fallback=8)
+        min_size = config.getint("gobuster", "min_shard_size", fallback=65536)
+
+        if shards == "auto":
+            rate = config.getint("gobuster", "target_rate", fallback=200)
+            if calibration is not None:
+                rtt = calibration.rtt
+            else:
+                rtt = util.tcp_rtt(hostname, service.port)
+            if rtt is None:
+                shards = 1
+            else:
+                shards = math.ceil(rate * rtt / threads)
+        else:
+            shards = int(shards)
+
+        return max(1, min(shards, max_shards, size // min_size))
+
+    def sharded_scan(
+        self,
+        tracker: Tracker,
+        machine: "htb.machine.Machine",
+        service: Service,
+        wordlist: IO[bytes],
+        count: int,
+        argv: List[str],
+        output_path: str,
+    ):
+        """ Split the wordlist into `count` byte ranges and run one gobuster
+        worker per range. The wordlist is mapped into memory and each range is
+        written directly to a worker's stdin. Worker results are merged into
+        `output_path` once all workers exit. Silent workers write their console
+        output to a log file which is sampled for progress, while their results
+        files are followed for findings. """
+
+        start_time = time.time()
+        shard_paths = []
+        feeders = []
+        progress = {}
+        logs = {}
+        offsets: Dict[str, int] = {}
+
+        # Removed by cancel() if the scan doesn't get to merge them
+        tracker.data["shards"] = (output_path, shard_paths, logs)
+
+        with mmap.mmap(wordlist.fileno(), 0, access=mmap.ACCESS_READ) as words:
+            shards = self._split(words, count)
+            total = sum([self._count_lines(words, start, end) for start, end in shards])
+
+            for index, (start, end) in enumerate(shards):
+                shard_path = f"{output_path}.shard{index}"
+                if tracker.silent:
+                    with open(f"{shard_path}.log", "wb") as log:
+                        popen = self.spawn(
+                            tracker,
+                            machine,
+                            argv + ["-w", "-", "-o", shard_path],
+                            stdin=subprocess.PIPE,
+                            stdout=log,
+                        )
+                    logs[popen] = log.name
+                else:
+                    popen = self.spawn(
+                        tracker,
+                        machine,
+                        argv + ["-w", "-", "-o", shard_path],
+                        stdin=subprocess.PIPE,
+                    )
+
+                feeder = threading.Thread(
+                    target=self._feed, args=(popen.stdin, words, start, end)
+                )
+                feeder.start()
+
+                shard_paths.append(shard_path)
+                feeders.append(feeder)
+                progress[popen] = 0
+
+            if logs:
+                lines = self.sample(
+                    tracker,
+                    logs,
+                    lambda: [
+                        self.follow(machine, service, p, offsets) for p in shard_paths
+                    ],
+                )
+            else:
+                lines = self.readlines(tracker, list(progress))
+
+            try:
+                for popen, line in lines:
+                    if not logs:
+                        self.count_error(tracker, line)
+                        for finding in self.parse(service, line):
+                            machine.findings.add(finding)
+
+                    match = self.PROGRESS.match(line)
+                    if match is None:
+                        continue
+
+                    progress[popen] = int(match.group(1))
+                    done = sum(progress.values())
+                    tracker.data["requests"] = done
+                    yield f"{done} / {total} ({done*100/max(total, 1):.2f}%) [{len(shards)} shards]"
+
+                if tracker.stop:
+                    yield "cancelled"
+                    return
+
+                for popen in progress:
+                    self.reap(tracker, popen)
+            finally:
+                # Feeders must release the mapping before it is closed
+                for feeder in feeders:
+                    feeder.join()
+
+        if logs:
+            for shard_path in shard_paths:
+                self.follow(machine, service, shard_path, offsets, final=True)
+
+        tracker.data.pop("shards")
+        self.merge(output_path, shard_paths, logs)
+
+        yield f"completed in {datetime.timedelta(seconds=time.time()-start_time)}"
+
+    def merge(
+        self, output_path: str, shard_paths: List[str], logs: Dict[Any, str]
+    ) -> None:
+        """ Merge worker results into `output_path` in wordlist order and remove
+        the per-worker files """
+
+        with open(output_path, "wb") as output:
+            for shard_path in shard_paths:
+                try:
+                    with open(shard_path, "rb") as shard:
+                        shutil.copyfileobj(shard, output)
+                    os.unlink(shard_path)
+                except FileNotFoundError:
+                    pass
+
+        for log in logs.values():
+            try:
+                os.unlink(log)
+            except FileNotFoundError:
+                pass
+
+    def cancel(self, tracker: Tracker) -> None:
+        """ Stop the workers and keep the results they found so far """
+
+        super(GobusterScanner, self).cancel(tracker)
+
+        if "shards" in tracker.data:
+            self.merge(*tracker.data.pop("shards"))
+
+    def _split(self, words: mmap.mmap, count: int) -> List[Tuple[int, int]]:
+        """ Split the wordlist into at most `count` ranges on line boundaries """
+
+        bounds = [0]
+        for index in range(1, count):
+            position = words.find(b"\n", max(len(words) * index // count, bounds[-1]))
+            if position == -1:
+                break
+            bounds.append(position + 1)
+        bounds.append(len(words))
+
+        return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+    def _count_lines(self, words: mmap.mmap, start: int, end: int) -> int:
+        """ Count the words in a range without copying the whole range at once """
+
+        lines = 0
+        for offset in range(start, end, self.READ_SIZE):
+            lines += words[offset : min(offset + self.READ_SIZE, end)].count(b"\n")
+
+        # The last word may not have a trailing newline
+        if end > start and words[end - 1 : end] != b"\n":
+            lines += 1
+
+        return lines
+
+    def _feed(self, stdin: IO[bytes], words: mmap.mmap, start: int, end: int):
+        """ Write a range of the wordlist to a worker """
+
+        try:
+            with memoryview(words) as view:
+                for offset in range(start, end, self.READ_SIZE):
+                    stdin.write(view[offset : min(offset + self.READ_SIZE, end)])
+        except (BrokenPipeError, ValueError):
+            # The worker exited or was cancelled
+            pass
+        finally:
+            try:
+                stdin.close()
+            except BrokenPipeError:
+                pass
+
+    def parse(self, service: Service, line: bytes) -> Iterable[Finding]:
+        """ Extract discovered paths with their status codes and sizes """
+
+        match = self.RESULT.search(line)
+        if match is None:
+            return []
+
+        size = match.group(3)
+        return [
+            WebPath(
+                scanner=self.name,
+                port=service.port,
+                protocol=service.protocol,
+                path=match.group(1).decode("utf-8", errors="replace"),
+                status=int(match.group(2)),
+                size=None if size is None else int(size),
+            )
+        ]
 
     def do_line(
         self, tracker: Tracker, scanner: Scanner, line: bytes
     ) -> Union[None, str]:
-        if line.startswith(b"Progress:"):
+        match = self.PROGRESS.match(line)
+        if match is not None:
+            tracker.data["requests"] = int(match.group(1))
             return line.split(b"Progress:")[1].decode("utf-8").strip()
         return None
-
-    def cancel(self, tracker: Tracker) -> None:
-        """ Ensure the running process dies """
-
-        tracker.data["popen"].terminate()
-        try:
-            tracker.data["popen"].wait(timeout=1)
-        except subprocess.TimeoutExpired:
-            tracker.data["popen"].kill()
-            tracker.data["popen"].wait()
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+from typing import List, Dict, Tuple, Iterable, Set
+import collections
+import re
+
+from htb.scanner.scanner import Scanner, Service
+
+
+class ScannerIndex(object):
+    """ Precompiled lookup of the scanners applicable to a service. Port
+    matches are a dictionary lookup by (protocol, port). Service name
+    patterns of every scanner for a protocol are combined into one regular
+    expression made of optional lookaheads, so a single match reports every
+    scanner whose pattern matches the name. Patterns which can't be combined
+    (e.g. they contain their own groups) are checked individually. """
+
+    def __init__(self, scanners: Iterable[Scanner]):
+        self.scanners: List[Scanner] = list(scanners)
+        self.by_port: Dict[Tuple[str, int], Set[int]] = collections.defaultdict(set)
+        self.names: Dict[str, re.Pattern] = {}
+        self.groups: Dict[str, Dict[str, int]] = {}
+        self.standalone: Dict[str, List[Tuple[re.Pattern, int]]] = (
+            collections.defaultdict(list)
+        )
+
+        patterns: Dict[str, List[Tuple[str, int]]] = collections.defaultdict(list)
+
+        for n, scanner in enumerate(self.scanners):
+            for protocol in scanner.protocol:
+                for port in scanner.ports:
+                    self.by_port[(protocol, port)].add(n)
+                for regex in scanner.regex:
+                    if regex.groups or regex.flags & ~(re.IGNORECASE | re.UNICODE):
+                        self.standalone[protocol].append((regex, n))
+                    else:
+                        patterns[protocol].append((regex.pattern, n))
+
+        for protocol, entries in patterns.items():
+            groups = {f"s{i}": n for i, (_, n) in enumerate(entries)}
+            combined = "".join(
+                [f"(?=(?P<s{i}>{pattern}))?" for i, (pattern, _) in enumerate(entries)]
+            )
+            try:
+                self.names[protocol] = re.compile(f"(?:{combined})", re.IGNORECASE)
+                self.groups[protocol] = groups
+            except re.error:
+                # Fall back to checking each pattern on its own
+                for pattern, n in entries:
+                    self.standalone[protocol].append(
+                        (re.compile(pattern, re.IGNORECASE), n)
+                    )
+
+    def match(self, service: Service) -> List[Scanner]:
+        """ Find the scanners applicable to a service in registry order """
+
+        if service.state == "closed":
+            return []
+
+        matched = set(self.by_port.get((service.protocol, service.port), ()))
+
+        names = self.names.get(service.protocol, None)
+        if names is not None:
+            result = names.match(service.name)
+            groups = self.groups[service.protocol]
+            matched.update(
+                [groups[g] for g, v in result.groupdict().items() if v is not None]
+            )
+
+        for regex, n in self.standalone.get(service.protocol, []):
+            if n not in matched and regex.match(service.name):
+                matched.add(n)
+
+        return [self.scanners[n] for n in sorted(matched)]
+
+    def pairs(self, services: Iterable[Service]) -> List[Tuple[Scanner, Service]]:
+        """ Every applicable (scanner, service) pair, ordered by service """
+
+        return [
+            (scanner, service)
+            for service in services
+            for scanner in self.match(service)
+        ]
@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
-from typing import Union
+from typing import Union, Iterable
 import subprocess
 import shlex
+import math
 import time
 import sys
 import os
+import re
 
 # from htb.machine import Machine
 from htb.scanner.scanner import ExternalScanner, Service, Tracker, Scanner
+from htb.scanner.calibration import CALIBRATOR, calibrate
+from htb.findings import Finding, NiktoFinding
 
 
 class NiktoScanner(ExternalScanner):
     """ Scan a web server with nikto """
 
+    # Findings either carry an OSVDB identifier, a path or both
+    FINDING = re.compile(rb"^\+ (?:OSVDB-(\d+): )?(?:(/\S*): )?(.+)$")
+    # e.g. "+ 7915 requests: 0 error(s) and 6 item(s) reported on remote host"
+    SUMMARY = re.compile(rb"^\+ (\d+) requests: (\d+) error")
+
     def __init__(self):
         super(NiktoScanner, self).__init__(
             name="nikto",
@@ -33,22 +42,70 @@ class NiktoScanner(ExternalScanner):
 
         output_path = os.path.join(path, "scans", f"{self.ident(service)}.txt")
 
-        # If we are backgrounded, ignore stdout and stderr
-        output = open(output_path, "w")
-
         url = f"http://{hostname}:{service.port}"
+        argv = ["nikto", "-ask", "no", "-host", url]
+
+        # Pick timeouts to suit the service
+        yield "calibrating"
+        config = machine.connection.config
+        calibration = calibrate(config, self.name, hostname, service.port, False)
+        if calibration is not None:
+            timeout = calibration.timeout(
+                config.getfloat("nikto", "min_timeout", fallback=2.0),
+                config.getfloat("nikto", "max_timeout", fallback=10.0),
+            )
+            argv += ["-timeout", str(math.ceil(timeout))]
+            pause = calibration.delay(
+                config.getfloat("nikto", "max_error_rate", fallback=0.05)
+            )
+            if pause > 0:
+                argv += ["-Pause", f"{pause:.2f}"]
 
-        return super(NiktoScanner, self).scan(
-            tracker,
-            path,
-            hostname,
-            machine,
-            service,
-            argv=["nikto", "-ask", "no", "-output", output_path, "-host", url],
+        # Silent scans write nikto's output straight to the file
+        if not tracker.silent:
+            argv += ["-output", output_path]
+
+        yield from super(NiktoScanner, self).scan(
+            tracker, path, hostname, machine, service, argv, output_path=output_path
         )
 
+        # Later calibrations of this service start from the error rate we saw
+        if not tracker.stop:
+            CALIBRATOR.observe(
+                hostname,
+                service.port,
+                tracker.data.get("requests", 0),
+                tracker.data.get("errors", 0),
+            )
+
+    def parse(self, service: Service, line: bytes) -> Iterable[Finding]:
+        """ Extract reported issues with their OSVDB identifiers """
+
+        match = self.FINDING.match(line.strip())
+        if match is None or (match.group(1) is None and match.group(2) is None):
+            return []
+
+        osvdb = match.group(1)
+        path = match.group(2)
+        return [
+            NiktoFinding(
+                scanner=self.name,
+                port=service.port,
+                protocol=service.protocol,
+                osvdb=None if osvdb is None else int(osvdb),
+                path=None if path is None else path.decode("utf-8", errors="replace"),
+                message=match.group(3).decode("utf-8", errors="replace").strip(),
+            )
+        ]
+
     def do_line(
         self, tracker: Tracker, scanner: Scanner, line: bytes
     ) -> Union[None, str]:
-        """ I have no useful progress info for Nikto :( """
+        """ Nikto reports no progress, only a summary of requests and errors """
+
+        match = self.SUMMARY.match(line)
+        if match is not None:
+            tracker.data["requests"] = int(match.group(1))
+            tracker.data["errors"] = int(match.group(2))
+
         return None
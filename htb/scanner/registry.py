@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+from typing import Dict, List, Callable, Iterator, Optional
+from configparser import ConfigParser
+import collections
+import importlib
+import threading
+
+from htb.scanner.scanner import Scanner
+from htb.scanner.index import ScannerIndex
+
+# Installed packages may provide scanners under this entry point group
+ENTRY_POINT_GROUP = "htb.scanners"
+
+# Sections of the form [scanner:NAME] declare command template scanners
+COMMAND_SECTION = "scanner:"
+
+
+def load_object(target: str):
+    """ Import an object given as "package.module:attribute" """
+
+    module, _, attribute = target.partition(":")
+    obj = importlib.import_module(module)
+    for part in attribute.split("."):
+        obj = getattr(obj, part)
+
+    return obj
+
+
+def instantiate(obj) -> Scanner:
+    """ Scanners may be registered as instances, classes or factories """
+
+    if isinstance(obj, Scanner):
+        return obj
+    return obj()
+
+
+def entry_points(group: str) -> List:
+    """ Find the entry points in the given group of every installed package """
+
+    try:
+        from importlib import metadata
+    except ImportError:
+        # Python < 3.8 has no importlib.metadata
+        return []
+
+    eps = metadata.entry_points()
+    if hasattr(eps, "select"):
+        return list(eps.select(group=group))
+
+    return list(eps.get(group, []))
+
+
+class LazyScanner(object):
+    """ Stand-in for a scanner which is imported and constructed the first time
+    it is matched or run. Attribute access is forwarded to the real scanner. """
+
+    def __init__(self, name: str, load: Callable[[], Scanner]):
+        self.name: str = name
+        self._load: Callable[[], Scanner] = load
+        self._scanner: Optional[Scanner] = None
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        state = "loaded" if self._scanner is not None else "lazy"
+        return f"<LazyScanner name={self.name},{state}>"
+
+    @property
+    def loaded(self) -> bool:
+        return self._scanner is not None
+
+    def resolve(self) -> Scanner:
+        """ Import and construct the scanner if needed """
+
+        with self._lock:
+            if self._scanner is None:
+                self._scanner = self._load()
+
+        return self._scanner
+
+    def __getattr__(self, name: str):
+        # Only called for attributes not defined on the proxy itself
+        return getattr(self.resolve(), name)
+
+
+class ScannerRegistry(object):
+    """ Collection of available scanners. Built-in scanners are registered by
+    import path, packages may add scanners through the `htb.scanners` entry
+    point group and the configuration file may declare command template
+    scanners in `[scanner:NAME]` sections. Nothing is imported until a scanner
+    is first used, and entry points are only looked up on first iteration. """
+
+    def __init__(self, builtins: Dict[str, str]):
+        self.scanners: Dict[str, LazyScanner] = collections.OrderedDict()
+        self.discovered: bool = False
+        self.lock = threading.Lock()
+        self._index: Optional[ScannerIndex] = None
+
+        for name, target in builtins.items():
+            self.register(name, target)
+
+    def register(self, name: str, target) -> LazyScanner:
+        """ Register a scanner by import path ("module:Class"), class, factory
+        or instance. An existing scanner with the same name is replaced. """
+
+        if isinstance(target, str):
+            scanner = LazyScanner(name, lambda: instantiate(load_object(target)))
+        else:
+            scanner = LazyScanner(name, lambda: instantiate(target))
+
+        self.scanners[name] = scanner
+        self._index = None
+        return scanner
+
+    def discover(self) -> None:
+        """ Register scanners provided by installed packages. Built-in and
+        configured scanners take precedence over entry points of the same
+        name. """
+
+        with self.lock:
+            if self.discovered:
+                return
+            self.discovered = True
+
+        for ep in entry_points(ENTRY_POINT_GROUP):
+            if ep.name not in self.scanners:
+                self.scanners[ep.name] = LazyScanner(
+                    ep.name, lambda ep=ep: instantiate(ep.load())
+                )
+        self._index = None
+
+    def configure(self, config: ConfigParser) -> None:
+        """ Register command template scanners declared in the configuration """
+
+        from htb.scanner.command import CommandScanner
+
+        for section in config.sections():
+            if not section.startswith(COMMAND_SECTION):
+                continue
+            name = section[len(COMMAND_SECTION) :]
+            self.register(
+                name,
+                lambda name=name, section=config[section]: CommandScanner.from_config(
+                    name, section
+                ),
+            )
+
+    def index(self) -> ScannerIndex:
+        """ Matching index over every registered scanner. This loads all
+        scanners, and is rebuilt after the registry changes. """
+
+        self.discover()
+        if self._index is None:
+            self._index = ScannerIndex(self.scanners.values())
+        return self._index
+
+    def get(self, name: str) -> Optional[LazyScanner]:
+        self.discover()
+        return self.scanners.get(name, None)
+
+    def __getitem__(self, name: str) -> LazyScanner:
+        self.discover()
+        return self.scanners[name]
+
+    def __contains__(self, name: str) -> bool:
+        self.discover()
+        return name in self.scanners
+
+    def __iter__(self) -> Iterator[LazyScanner]:
+        self.discover()
+        return iter(list(self.scanners.values()))
+
+    def __len__(self) -> int:
+        self.discover()
+        return len(self.scanners)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+from typing import List, Set, Optional
+from configparser import ConfigParser
+import resource
+import signal
+import os
+
+# Defaults for every scanner may be given in this section
+DEFAULT_SECTION = "scanners"
+
+# Classes understood by `ionice -c`
+IONICE_CLASSES = {"realtime": "1", "best-effort": "2", "idle": "3"}
+
+# Cgroups we have already tried to create, so it is only done once each
+CGROUPS: Set[str] = set()
+
+
+def parse_size(value: str) -> int:
+    """ Parse a size like "512M" or "2G" into bytes """
+
+    units = {"k": 1 << 10, "m": 1 << 20, "g": 1 << 30, "t": 1 << 40}
+    value = value.strip().lower().rstrip("b")
+    if value and value[-1] in units:
+        return int(float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def parse_cpus(value: str) -> Set[int]:
+    """ Parse a CPU list like "0-3,6" into a set of CPU numbers """
+
+    cpus = set()
+    for part in value.split(","):
+        part = part.strip()
+        if "-" in part:
+            first, last = part.split("-")
+            cpus.update(range(int(first), int(last) + 1))
+        elif part:
+            cpus.add(int(part))
+    return cpus
+
+
+class ResourcePolicy(object):
+    """ Resource limits applied to the processes started by a scanner. Policies
+    are read from the scanner's section of the configuration file, falling back
+    to the `scanners` section:
+
+        [gobuster]
+        nice = 10
+        ionice = idle
+        affinity = 0-3
+        rlimit_as = 2G
+        rlimit_nofile = 4096
+        cgroup = htb.slice/gobuster
+    """
+
+    def __init__(
+        self,
+        nice: int = 0,
+        ionice: Optional[str] = None,
+        affinity: Optional[Set[int]] = None,
+        rlimit_as: Optional[int] = None,
+        rlimit_nofile: Optional[int] = None,
+        cgroup: Optional[str] = None,
+    ):
+        self.nice: int = nice
+        self.ionice: Optional[str] = ionice
+        self.affinity: Optional[Set[int]] = affinity
+        self.rlimit_as: Optional[int] = rlimit_as
+        self.rlimit_nofile: Optional[int] = rlimit_nofile
+        self.cgroup: Optional[str] = cgroup
+
+    @classmethod
+    def from_config(cls, config: ConfigParser, name: str) -> "ResourcePolicy":
+        """ Build the policy for the named scanner """
+
+        def option(key: str) -> Optional[str]:
+            return config.get(
+                name, key, fallback=config.get(DEFAULT_SECTION, key, fallback=None)
+            )
+
+        self = ResourcePolicy()
+
+        if option("nice") is not None:
+            self.nice = int(option("nice"))
+        if option("ionice") is not None:
+            self.ionice = option("ionice")
+        if option("affinity") is not None:
+            self.affinity = parse_cpus(option("affinity"))
+        if option("rlimit_as") is not None:
+            self.rlimit_as = parse_size(option("rlimit_as"))
+        if option("rlimit_nofile") is not None:
+            self.rlimit_nofile = int(option("rlimit_nofile"))
+        if option("cgroup") is not None:
+            self.cgroup = os.path.join("/sys/fs/cgroup", option("cgroup"))
+            # Create the group if we are allowed to. Otherwise, it must already
+            # exist and be delegated to us.
+            if self.cgroup not in CGROUPS:
+                CGROUPS.add(self.cgroup)
+                try:
+                    os.makedirs(self.cgroup, exist_ok=True)
+                except OSError:
+                    pass
+
+        return self
+
+    def wrap(self, argv: List[str]) -> List[str]:
+        """ Prefix the command line with any required wrappers. `ionice`
+        execs the target, so the process ID is unchanged. """
+
+        if self.ionice is None:
+            return argv
+
+        klass, _, level = self.ionice.partition(":")
+        wrapper = ["ionice", "-c", IONICE_CLASSES.get(klass, klass)]
+        if level:
+            wrapper.extend(["-n", level])
+
+        return wrapper + argv
+
+    def preexec(self) -> None:
+        """ Apply the policy in the child process before exec """
+
+        # Background jobs are managed through the jobs command, not C-z
+        signal.signal(signal.SIGTSTP, signal.SIG_IGN)
+
+        if self.nice:
+            os.nice(self.nice)
+        if self.affinity:
+            os.sched_setaffinity(0, self.affinity)
+        if self.rlimit_as is not None:
+            resource.setrlimit(resource.RLIMIT_AS, (self.rlimit_as, self.rlimit_as))
+        if self.rlimit_nofile is not None:
+            resource.setrlimit(
+                resource.RLIMIT_NOFILE, (self.rlimit_nofile, self.rlimit_nofile)
+            )
+        if self.cgroup is not None:
+            try:
+                with open(os.path.join(self.cgroup, "cgroup.procs"), "w") as fh:
+                    fh.write(str(os.getpid()))
+            except OSError:
+                # Not fatal; the scan simply runs in our own cgroup
+                pass
@@ -1,15 +1,26 @@
 #!/usr/bin/env python3
-from typing import List, Dict, Any, Generator
-from dataclasses import dataclass
+from typing import List, Dict, Any, Callable, Generator, Tuple, Iterable, Optional
+from dataclasses import dataclass, field
+import xml.etree.ElementTree as ElementTree
+import collections
 import subprocess
 import threading
+import selectors
 import datetime
+import codecs
 import signal
+import socket
 import queue
 import time
 import sys
+import os
 import re
 
+from htb.findings import Finding
+from htb.scanner.resources import ResourcePolicy
+from htb.scheduler import Scheduler
+from htb.runlog import RunRecord
+
 # from htb.machine import Machine
 
 
@@ -23,6 +34,11 @@ class Service(object):
         self.name: str = "blank"
         self.state: str = "closed"
         self.protocol: str = "none"
+        self.product: str = ""
+        self.version: str = ""
+        self.extrainfo: str = ""
+        self.cpe: List[str] = []
+        self.scripts: Dict[str, str] = {}
 
     @classmethod
     def from_masscan(cls, data: str):
@@ -40,6 +56,24 @@ class Service(object):
 
         return self
 
+    @classmethod
+    def from_port(cls, host: str, port: int, protocol: str = "tcp"):
+        """ Build an open service discovered by a port scan """
+
+        self = Service()
+        self.port = port
+        self.state = "open"
+        self.protocol = protocol
+        self.host = host
+
+        # Best guess until the service is fingerprinted
+        try:
+            self.name = socket.getservbyport(port, protocol)
+        except OSError:
+            self.name = "unknown"
+
+        return self
+
     @classmethod
     def from_nmap(cls, data: str):
         """ Build service from a line of greppable masscan results """
@@ -56,6 +90,45 @@ class Service(object):
 
         return self
 
+    @classmethod
+    def from_nmap_xml(cls, host: str, port: ElementTree.Element):
+        """ Build service from a `port` element of nmap XML output """
+
+        self = Service()
+        self.host = host
+        self.port = int(port.get("portid"))
+        self.protocol = port.get("protocol")
+
+        state = port.find("state")
+        if state is not None:
+            self.state = state.get("state")
+
+        service = port.find("service")
+        if service is not None:
+            self.name = service.get("name", "unknown")
+            self.product = service.get("product", "")
+            self.version = service.get("version", "")
+            self.extrainfo = service.get("extrainfo", "")
+            self.cpe = [cpe.text for cpe in service.iterfind("cpe") if cpe.text]
+        else:
+            self.name = "unknown"
+
+        self.scripts = {
+            script.get("id"): script.get("output", "")
+            for script in port.iterfind("script")
+        }
+
+        return self
+
+    def describe(self) -> str:
+        """ Product and version string, e.g. "OpenSSH 7.6p1 (Ubuntu)" """
+
+        description = " ".join([p for p in [self.product, self.version] if p])
+        if self.extrainfo:
+            description += f" ({self.extrainfo})"
+
+        return description.strip()
+
     def json(self) -> Dict[str, Any]:
         """ Converts this object to a dictionary appropriate for JSON output """
         return {
@@ -63,6 +136,11 @@ class Service(object):
             "protocol": self.protocol,
             "state": self.state,
             "name": self.name,
+            "product": self.product,
+            "version": self.version,
+            "extrainfo": self.extrainfo,
+            "cpe": self.cpe,
+            "scripts": self.scripts,
         }
 
     @classmethod
@@ -72,6 +150,11 @@ class Service(object):
         self.protocol = data["protocol"]
         self.state = data["state"]
         self.name = data["name"]
+        self.product = data.get("product", "")
+        self.version = data.get("version", "")
+        self.extrainfo = data.get("extrainfo", "")
+        self.cpe = data.get("cpe", [])
+        self.scripts = data.get("scripts", {})
         self.host = None
         return self
 
@@ -88,6 +171,51 @@ class Tracker(object):
     stop: bool
     data: Dict[str, Any]
     lock: threading.Lock = None
+    output: collections.deque = field(
+        default_factory=lambda: collections.deque(maxlen=1000)
+    )
+    subscribers: List[queue.Queue] = field(default_factory=list)
+    output_lock: threading.Lock = field(default_factory=threading.Lock)
+    scheduler: Optional[Scheduler] = None
+    # Output counters for the run log
+    lines: int = 0
+    bytes: int = 0
+
+    # Longest line kept in the output buffer
+    MAX_LINE = 1024
+
+    def emit(self, line: str, count: bool = True) -> None:
+        """ Record a line of output in the bounded output buffer and forward it
+        to any subscribers. Subscribers which fall behind lose lines rather than
+        growing without bound. Sampled lines which are counted separately pass
+        `count=False`. """
+
+        line = line[: self.MAX_LINE]
+
+        with self.output_lock:
+            if count:
+                self.lines += 1
+            self.output.append(line)
+            for subscriber in self.subscribers:
+                try:
+                    subscriber.put_nowait(line)
+                except queue.Full:
+                    pass
+
+    def subscribe(self, size: int = 1000) -> Tuple[List[str], queue.Queue]:
+        """ Subscribe to job output. Returns the currently buffered lines and a
+        queue which receives every line emitted afterwards. """
+
+        subscriber = queue.Queue(maxsize=size)
+        with self.output_lock:
+            self.subscribers.append(subscriber)
+            return list(self.output), subscriber
+
+    def unsubscribe(self, subscriber: queue.Queue) -> None:
+        """ Stop receiving job output """
+        with self.output_lock:
+            if subscriber in self.subscribers:
+                self.subscribers.remove(subscriber)
 
 
 class Scanner(object):
@@ -120,11 +248,81 @@ class Scanner(object):
         return [service for service in machine.services if self.match_service(service)]
 
     def match_service(self, service: Service) -> bool:
+        if service.state == "closed":
+            return False
         return service.protocol in self.protocol and (
-            service.port in self.ports
-            or any([r.match(service.name) for r in self.regex])
+            service.port in self.ports or any(r.match(service.name) for r in self.regex)
         )
 
+    def policy(self, machine: "htb.machine.Machine") -> ResourcePolicy:
+        """ Get the resource policy for processes started by this scanner """
+        return ResourcePolicy.from_config(machine.connection.config, self.name)
+
+    def spawn(
+        self,
+        tracker: Tracker,
+        machine: "htb.machine.Machine",
+        argv: List[str],
+        **kwargs,
+    ) -> subprocess.Popen:
+        """ Start a child process for this scan under the scanner's resource
+        policy and register it with the tracker. Output is captured on a pipe
+        with stderr merged unless overridden. """
+
+        policy = self.policy(machine)
+
+        kwargs.setdefault("stdout", subprocess.PIPE)
+        kwargs.setdefault("stderr", subprocess.STDOUT)
+
+        popen = subprocess.Popen(policy.wrap(argv), preexec_fn=policy.preexec, **kwargs)
+
+        tracker.data.setdefault("popens", []).append(popen)
+        tracker.data["popen"] = popen
+
+        return popen
+
+    def reap(
+        self, tracker: Tracker, popen: subprocess.Popen, timeout: Optional[float] = None
+    ) -> Optional[int]:
+        """ Wait for a child process to exit and record its resource usage with
+        the tracker. Returns the exit status, or None if the process is still
+        running after `timeout` seconds. """
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        while popen.returncode is None:
+            try:
+                pid, status, rusage = os.wait4(
+                    popen.pid, 0 if deadline is None else os.WNOHANG
+                )
+            except ChildProcessError:
+                # Somebody else already reaped it through the Popen object
+                return popen.wait()
+
+            if pid == 0:
+                if time.time() >= deadline:
+                    return None
+                time.sleep(0.05)
+                continue
+
+            if os.WIFSIGNALED(status):
+                popen.returncode = -os.WTERMSIG(status)
+            else:
+                popen.returncode = os.WEXITSTATUS(status)
+            tracker.data.setdefault("rusage", []).append(rusage)
+
+        return popen.returncode
+
+    def parse(self, service: Service, line: bytes) -> Iterable[Finding]:
+        """ Parse a line of scanner output into structured findings """
+        return []
+
+    def parse_file(self, service: Service, path: str) -> Generator[Finding, None, None]:
+        """ Parse a complete scanner output file into structured findings """
+        with open(path, "rb") as fh:
+            for line in fh:
+                yield from self.parse(service, line.rstrip(b"\r\n"))
+
     def background(
         self, tracker: Tracker, path: str, hostname: str, machine, service: Service,
     ) -> threading.Thread:
@@ -144,31 +342,55 @@ class Scanner(object):
         return thread
 
     def continue_background(
-        self, tracker: Tracker, generator: Generator[str, None, None]
+        self,
+        tracker: Tracker,
+        generator: Generator[str, None, None],
+        start: Optional[float] = None,
     ):
-        """ Transfer control of a running scan to a background task """
+        """ Transfer control of a running scan to a background task. `start`
+        is when the scan began, for the run log. If the tracker has a
+        scheduler, the caller's slot is handed over and released when the
+        scan ends. """
 
         tracker.silent = True
 
         thread = threading.Thread(
-            target=self._do_continue_background, args=(tracker, generator)
+            target=self._do_continue_background, args=(tracker, generator, start)
         )
         thread.start()
 
         return thread
 
     def _do_continue_background(
-        self, tracker: Tracker, generator: Generator[str, None, None]
+        self,
+        tracker: Tracker,
+        generator: Generator[str, None, None],
+        start: Optional[float] = None,
     ):
         """ Continue the scan in the background """
 
         # This ensures the main thread doesn't trample us
         tracker.lock.acquire()
 
-        for status in generator:
-            tracker.status = status
-            if tracker.stop:
-                self.cancel(tracker)
+        machine, service = tracker.machine, tracker.service
+        record = RunRecord(
+            scanner=self.name,
+            machine=machine.name,
+            port=service.port,
+            protocol=service.protocol,
+            start=start if start is not None else time.time(),
+        )
+
+        try:
+            for status in generator:
+                tracker.status = status
+                if tracker.stop:
+                    self.cancel(tracker)
+                    break
+        finally:
+            if tracker.scheduler is not None:
+                tracker.scheduler.release(machine.hostname)
+            self.record(tracker, machine, record)
 
         tracker.events.put(tracker)
 
@@ -176,19 +398,74 @@ class Scanner(object):
         self, tracker: Tracker, path: str, hostname: str, machine, service: Service,
     ) -> None:
         """ Start the scan in the background and notify the queue when it is complete """
-        for status in self.scan(tracker, path, hostname, machine, service):
-            # Set status
-            tracker.status = status
 
-            # The job was killed
-            if tracker.stop:
-                # Perform shutdown needed
-                self.cancel(tracker)
-                break
+        record = RunRecord(
+            scanner=self.name,
+            machine=machine.name,
+            port=service.port,
+            protocol=service.protocol,
+            start=time.time(),
+        )
+
+        # Wait for our turn if the job is scheduled
+        if tracker.scheduler is not None:
+            tracker.status = "queued"
+            if not tracker.scheduler.acquire(hostname, lambda: tracker.stop):
+                tracker.status = "cancelled"
+                with tracker.lock:
+                    tracker.events.put(tracker)
+                return
+
+        record.start = time.time()
+
+        try:
+            for status in self.scan(tracker, path, hostname, machine, service):
+                # Set status
+                tracker.status = status
+
+                # The job was killed
+                if tracker.stop:
+                    # Perform shutdown needed
+                    self.cancel(tracker)
+                    break
+        finally:
+            if tracker.scheduler is not None:
+                tracker.scheduler.release(hostname)
+            self.record(tracker, machine, record)
 
         with tracker.lock:
             tracker.events.put(tracker)
 
+    def record(self, tracker: Tracker, machine, record: RunRecord) -> None:
+        """ Complete the run record from the tracker and save it to the
+        machine's run log """
+
+        record.end = time.time()
+        record.lines = tracker.lines
+        record.bytes = tracker.bytes
+        record.cancelled = tracker.stop
+        record.status = tracker.status
+        record.returncodes = [
+            p.returncode
+            for p in tracker.data.get("popens", [])
+            if p.returncode is not None
+        ]
+
+        for rusage in tracker.data.get("rusage", []):
+            record.cpu += rusage.ru_utime + rusage.ru_stime
+            # ru_maxrss is reported in kilobytes
+            record.max_rss = max(record.max_rss, rusage.ru_maxrss * 1024)
+
+        if machine.runlog is not None:
+            try:
+                machine.runlog.append(record)
+            except OSError:
+                pass
+
+        # Make the new output searchable. The scan is over, so its output is
+        # complete even if it does not end in a newline.
+        machine.index(finished=f"{record.scanner}-{record.port}-{record.protocol}")
+
     def cancel(self, tracker: Tracker) -> None:
         """ Shutdown any recurring things (like killing processes) """
         return
@@ -203,10 +480,197 @@ class Scanner(object):
 class ExternalScanner(Scanner):
 
     LINE_DELIM = [b"\n"]
+    READ_SIZE = 65536
+    # How often a quiet scan checks whether it was cancelled
+    POLL_INTERVAL = 0.25
+    # Most output read from a file per sample when it is written directly
+    TAIL_SIZE = 4096
+    # Marks output reporting a failed request (counted in data["errors"])
+    ERROR: Optional[bytes] = None
 
     def __init__(self, *args, **kwargs):
         super(ExternalScanner, self).__init__(*args, **kwargs)
 
+    def readlines(
+        self, tracker: Tracker, popens: List[subprocess.Popen]
+    ) -> Generator[Tuple[subprocess.Popen, bytes], None, None]:
+        """ Multiplex the output of the given processes and yield complete lines
+        as (popen, line) tuples. Output is read in large chunks rather than byte
+        by byte, and echoed to stdout when the tracker is not silent. Any
+        trailing partial line is yielded once the process closes its output.
+        Reading stops early when the tracker is asked to stop. """
+
+        delim = re.compile(b"|".join([re.escape(d) for d in self.LINE_DELIM]))
+        selector = selectors.DefaultSelector()
+        pending: Dict[subprocess.Popen, bytes] = {}
+        decoders = {}
+
+        for popen in popens:
+            selector.register(popen.stdout, selectors.EVENT_READ, popen)
+            pending[popen] = b""
+            decoders[popen] = codecs.getincrementaldecoder("utf-8")(errors="replace")
+
+        try:
+            while selector.get_map() and not tracker.stop:
+                for key, _ in selector.select(timeout=self.POLL_INTERVAL):
+                    popen = key.data
+                    data = os.read(key.fd, self.READ_SIZE)
+                    tracker.bytes += len(data)
+
+                    # End of output for this process
+                    if not data:
+                        selector.unregister(key.fileobj)
+                        if pending[popen]:
+                            tracker.emit(
+                                pending[popen].decode("utf-8", errors="replace")
+                            )
+                            yield popen, pending[popen]
+                        pending[popen] = b""
+                        continue
+
+                    # Not silent, output
+                    if not tracker.silent:
+                        sys.stdout.write(decoders[popen].decode(data))
+                        sys.stdout.flush()
+
+                    lines = delim.split(pending[popen] + data)
+                    pending[popen] = lines.pop()
+
+                    for line in lines:
+                        tracker.emit(line.decode("utf-8", errors="replace"))
+                        yield popen, line
+        finally:
+            selector.close()
+
+    def sample(
+        self,
+        tracker: Tracker,
+        outputs: Dict[subprocess.Popen, str],
+        poll: Optional[Callable[[], None]] = None,
+    ) -> Generator[Tuple[subprocess.Popen, bytes], None, None]:
+        """ Wait for processes whose output is written directly to a file and
+        yield (popen, line) tuples sampled from the end of each file. At most
+        TAIL_SIZE new bytes per file are read every POLL_INTERVAL, so the cost
+        does not depend on how much the process writes. `poll` is called once
+        per interval (e.g. to `follow` a results file). Processes are reaped
+        as they exit, and the line and byte counters of the tracker are set
+        from the files afterwards. Sampling stops early when the tracker is
+        asked to stop. """
+
+        delim = re.compile(b"|".join([re.escape(d) for d in self.LINE_DELIM]))
+        offsets = {popen: 0 for popen in outputs}
+        running = list(outputs)
+
+        while running and not tracker.stop:
+            # Wait on one process, then check the others without blocking
+            timeout = self.POLL_INTERVAL
+            for popen in list(running):
+                if self.reap(tracker, popen, timeout=timeout) is not None:
+                    running.remove(popen)
+                timeout = 0
+
+            if poll is not None:
+                poll()
+
+            for popen, path in outputs.items():
+                try:
+                    with open(path, "rb") as fh:
+                        size = os.fstat(fh.fileno()).st_size
+                        start = max(offsets[popen], size - self.TAIL_SIZE)
+                        fh.seek(start)
+                        data = fh.read(size - start)
+                except OSError:
+                    continue
+
+                lines = delim.split(data)
+                partial = lines.pop()
+                # Skipping ahead may have cut the first line in half
+                if start > offsets[popen] and lines:
+                    lines.pop(0)
+                # The partial last line is read again by the next sample
+                offsets[popen] = size - len(partial)
+
+                for line in lines:
+                    if line:
+                        tracker.emit(line.decode("utf-8", errors="replace"), False)
+                        yield popen, line
+
+        for path in outputs.values():
+            lines, size, errors = self.count_lines(path)
+            tracker.lines += lines
+            tracker.bytes += size
+            tracker.data["errors"] = tracker.data.get("errors", 0) + errors
+
+    def count_lines(self, path: str) -> Tuple[int, int, int]:
+        """ Count the lines, bytes and error reports of an output file """
+
+        lines = 0
+        size = 0
+        errors = 0
+
+        try:
+            with open(path, "rb") as fh:
+                for data in iter(lambda: fh.read(self.READ_SIZE), b""):
+                    lines += sum([data.count(d) for d in self.LINE_DELIM])
+                    size += len(data)
+                    if self.ERROR is not None:
+                        errors += data.count(self.ERROR)
+        except OSError:
+            pass
+
+        return lines, size, errors
+
+    def count_error(self, tracker: Tracker, line: bytes) -> None:
+        """ Count a line of output which reports a failed request """
+
+        if self.ERROR is not None and self.ERROR in line:
+            tracker.data["errors"] = tracker.data.get("errors", 0) + 1
+
+    def follow(
+        self,
+        machine: "htb.machine.Machine",
+        service: Service,
+        path: str,
+        offsets: Dict[str, int],
+        final: bool = False,
+    ) -> None:
+        """ Record the findings of the lines added to an output file since the
+        last call. `offsets` holds how far each file was parsed. Only complete
+        lines are parsed until the `final` call, so every line is parsed once
+        and each file is read once however often it is followed. """
+
+        delim = re.compile(b"|".join([re.escape(d) for d in self.LINE_DELIM]))
+
+        try:
+            with open(path, "rb") as fh:
+                fh.seek(offsets.get(path, 0))
+                partial = b""
+                for data in iter(lambda: fh.read(self.READ_SIZE), b""):
+                    lines = delim.split(partial + data)
+                    partial = lines.pop()
+                    offsets[path] = fh.tell() - len(partial)
+                    for line in lines:
+                        for finding in self.parse(service, line):
+                            machine.findings.add(finding)
+        except OSError:
+            return
+
+        if final and partial:
+            offsets[path] += len(partial)
+            for finding in self.parse(service, partial):
+                machine.findings.add(finding)
+
+    def collect(
+        self, machine: "htb.machine.Machine", service: Service, path: str
+    ) -> None:
+        """ Record the findings of a finished output file """
+
+        try:
+            for finding in self.parse_file(service, path):
+                machine.findings.add(finding)
+        except OSError:
+            pass
+
     def scan(
         self,
         tracker: Tracker,
@@ -215,45 +679,73 @@ class ExternalScanner(Scanner):
         machine: "htb.machine.Machine",
         service: Service,
         argv: List[str],
+        output_path: Optional[str] = None,
+        results_path: Optional[str] = None,
+        **kwargs,
     ):
-        """ Start the external application (specified by argv) and monitor output """
-
-        # Call gobuster
-        tracker.data["popen"] = subprocess.Popen(
-            argv,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            preexec_fn=lambda: signal.signal(signal.SIGTSTP, signal.SIG_IGN),
-        )
+        """ Start the external application (specified by argv) and monitor output.
 
-        line = b""
+        If the tracker is silent and `output_path` is given, the output of the
+        process is written straight to that file instead of passing through a
+        pipe. Progress is sampled from the end of the file, and findings are
+        parsed from `results_path` (default: `output_path`) as it grows. A
+        separate `results_path` means the output file is only a
+        progress side channel, and it is removed afterwards. Other keyword
+        arguments are passed to `spawn`. """
 
         # Track start time
         start_time = time.time()
 
-        while tracker.data["popen"].poll() is None:
-
-            # Grab next byte
-            data = tracker.data["popen"].stdout.read(1)
+        direct = tracker.silent and output_path is not None
+
+        if direct:
+            with open(output_path, "wb") as output:
+                popen = self.spawn(tracker, machine, argv, stdout=output, **kwargs)
+            offsets: Dict[str, int] = {}
+            lines = self.sample(
+                tracker,
+                {popen: output_path},
+                lambda: self.follow(
+                    machine, service, results_path or output_path, offsets
+                ),
+            )
+        else:
+            popen = self.spawn(tracker, machine, argv, **kwargs)
+            lines = self.readlines(tracker, [popen])
+
+        # The output file is only a progress side channel
+        scratch = direct and results_path not in (None, output_path)
 
-            # Not silent, output
-            if not tracker.silent:
-                sys.stdout.write(data.decode("utf-8"))
-
-            if data in self.LINE_DELIM:
+        try:
+            for _, line in lines:
+                # Record structured results as they arrive
+                if not direct:
+                    self.count_error(tracker, line)
+                    for finding in self.parse(service, line):
+                        machine.findings.add(finding)
 
                 # Set status
                 status = self.do_line(tracker, service, line)
                 if status is not None:
                     yield status
+        finally:
+            # The caller may close us as soon as the job is cancelled
+            if scratch and tracker.stop:
+                os.unlink(output_path)
 
-                line = b""
+        # Let the caller cancel the processes rather than wait for them
+        if tracker.stop:
+            yield "cancelled"
+            return
 
-                # We don't want a busy loop. Sleep after every line
-                if tracker.silent:
-                    time.sleep(0.1)
-            else:
-                line += data
+        self.reap(tracker, popen)
+
+        if direct:
+            self.follow(
+                machine, service, results_path or output_path, offsets, final=True
+            )
+        if scratch:
+            os.unlink(output_path)
 
         yield f"completed in {datetime.timedelta(seconds=time.time()-start_time)}"
 
@@ -263,11 +755,12 @@ class ExternalScanner(Scanner):
         pass
 
     def cancel(self, tracker: Tracker) -> None:
-        """ Ensure the running process dies """
-
-        tracker.data["popen"].terminate()
-        try:
-            tracker.data["popen"].wait(timeout=1)
-        except subprocess.TimeoutExpired:
-            tracker.data["popen"].kill()
-            tracker.data["popen"].wait()
+        """ Ensure the running processes die """
+
+        for popen in tracker.data.get("popens", []):
+            if popen.returncode is not None:
+                continue
+            popen.terminate()
+            if self.reap(tracker, popen, timeout=1) is None:
+                popen.kill()
+                self.reap(tracker, popen)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+from typing import Dict, Callable
+from configparser import ConfigParser
+import collections
+import threading
+
+
+class Scheduler(object):
+    """ Limits the number of jobs running at once, both overall and for each
+    host. Jobs wait in `acquire` until a slot is available. A limit of zero or
+    less means no limit. Configured in the `scheduler` section:
+
+        [scheduler]
+        jobs = 8
+        jobs_per_host = 2
+    """
+
+    def __init__(self, limit: int = 8, per_host: int = 2):
+        self.limit: int = limit
+        self.per_host: int = per_host
+        self.running: Dict[str, int] = collections.Counter()
+        self.total: int = 0
+        self.waiting: int = 0
+        self.condition = threading.Condition()
+
+    @classmethod
+    def from_config(cls, config: ConfigParser) -> "Scheduler":
+        return Scheduler(
+            limit=config.getint("scheduler", "jobs", fallback=8),
+            per_host=config.getint("scheduler", "jobs_per_host", fallback=2),
+        )
+
+    def _full(self, host: str) -> bool:
+        return (self.limit > 0 and self.total >= self.limit) or (
+            self.per_host > 0 and self.running[host] >= self.per_host
+        )
+
+    def acquire(self, host: str, cancelled: Callable[[], bool] = lambda: False) -> bool:
+        """ Wait for a slot for the given host. Returns False if `cancelled`
+        returned True before a slot became available. """
+
+        with self.condition:
+            self.waiting += 1
+            try:
+                while self._full(host):
+                    if cancelled():
+                        return False
+                    # Wake up periodically to notice cancellation
+                    self.condition.wait(timeout=0.5)
+            finally:
+                self.waiting -= 1
+
+            self.total += 1
+            self.running[host] += 1
+
+        return True
+
+    def release(self, host: str) -> None:
+        """ Give back a slot taken by `acquire` """
+
+        with self.condition:
+            self.total -= 1
+            self.running[host] -= 1
+            if self.running[host] <= 0:
+                del self.running[host]
+            self.condition.notify_all()
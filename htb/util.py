@@ -1,7 +1,13 @@
 #!/usr/bin/env python3
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple, Iterable
 from colorama import Style, Fore, Back
 from cmd2.ansi import strip_style
+import statistics
+import secrets
+import stat
+import socket
+import time
+import os
 
 
 def readuntil(f, delim: List[bytes]):
@@ -15,6 +21,119 @@ def readuntil(f, delim: List[bytes]):
     return b"".join(result)
 
 
+def tcp_rtt(
+    host: str, port: int, samples: int = 3, timeout: float = 2.0
+) -> Optional[float]:
+    """ Measure the round trip time to a TCP service by timing connection
+    establishment. Returns the median of the successful samples in seconds, or
+    None if the service never answered. """
+
+    results = []
+    for _ in range(samples):
+        start = time.monotonic()
+        try:
+            with socket.create_connection((host, port), timeout=timeout):
+                results.append(time.monotonic() - start)
+        except OSError:
+            continue
+
+    if len(results) == 0:
+        return None
+
+    return statistics.median(results)
+
+
+def process_tree(pid: int) -> List[int]:
+    """ Find a process and all of its live descendants """
+
+    result = []
+    pending = [pid]
+    while pending:
+        current = pending.pop()
+        result.append(current)
+        try:
+            with open(f"/proc/{current}/task/{current}/children", "r") as fh:
+                pending.extend([int(child) for child in fh.read().split()])
+        except OSError:
+            continue
+
+    return result
+
+
+def process_usage(pids: Iterable[int]) -> Tuple[float, int]:
+    """ Sum the CPU time (seconds) and resident set size (bytes) of the given
+    processes and their descendants as reported by /proc. Processes which have
+    already exited are ignored. """
+
+    ticks = os.sysconf("SC_CLK_TCK")
+    page = os.sysconf("SC_PAGE_SIZE")
+    cpu = 0.0
+    rss = 0
+
+    for pid in pids:
+        for child in process_tree(pid):
+            try:
+                with open(f"/proc/{child}/stat", "r") as fh:
+                    # The command name may contain spaces, so skip past it
+                    stat = fh.read().rsplit(")", 1)[1].split()
+            except (OSError, IndexError):
+                continue
+            cpu += (int(stat[11]) + int(stat[12])) / ticks
+            rss += int(stat[21]) * page
+
+    return cpu, rss
+
+
+def human_size(size: float) -> str:
+    """ Format a byte count for display """
+
+    for unit in ["B", "K", "M", "G"]:
+        if size < 1024:
+            return f"{size:.1f}{unit}"
+        size /= 1024
+    return f"{size:.1f}T"
+
+
+def atomic_write(path: str, data: bytes) -> None:
+    """ Replace the contents of a file so that readers and crashes only ever
+    see the old or the new contents. The data is written to a temporary file in
+    the same directory, synced to disk and renamed over the original. The
+    file keeps its permissions, and a new file gets the usual ones for the
+    umask. """
+
+    directory = os.path.dirname(os.path.abspath(path))
+    temp = os.path.join(
+        directory, f".{os.path.basename(path)}.{secrets.token_hex(4)}.tmp"
+    )
+
+    # Unlike mkstemp (0600), this applies the umask like any new file
+    fd = os.open(temp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+
+    try:
+        with os.fdopen(fd, "wb") as fh:
+            try:
+                os.fchmod(fh.fileno(), stat.S_IMODE(os.stat(path).st_mode))
+            except FileNotFoundError:
+                pass
+            fh.write(data)
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(temp, path)
+    except BaseException:
+        try:
+            os.unlink(temp)
+        except FileNotFoundError:
+            pass
+        raise
+
+    # Make the rename itself durable
+    dirfd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dirfd)
+    finally:
+        os.close(dirfd)
+
+
 def build_table(data: List[List[str]], highlight=True) -> List[str]:
     """ Build an ASCII table for the terminal. Each item in headers and data can
     can start with "<", ">", or "^" to control justification. Column justification
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import ctypes.util
+import threading
+import selectors
+import ctypes
+import struct
+import errno
+import time
+import os
+
+from htb.index import SCAN_FILE
+from htb.scanner import Service, AVAILABLE_SCANNERS
+from htb.exceptions import *
+
+# inotify(7) event masks
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+# inotify_init1(2) flags
+IN_NONBLOCK = 0o0004000
+IN_CLOEXEC = 0o2000000
+
+# struct inotify_event without the trailing name
+EVENT = struct.Struct("iIII")
+
+# Files in a machine's analysis directory which hold its saved state
+STATE_FILES = ["machine.json", "machine.journal"]
+
+
+class Inotify(object):
+    """ Minimal inotify(7) binding using ctypes """
+
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd: int = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code))
+
+    def add(self, path: str, mask: int) -> int:
+        """ Watch a path and return the watch descriptor """
+
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            code = ctypes.get_errno()
+            raise OSError(code, os.strerror(code), path)
+        return wd
+
+    def read(self) -> List[Tuple[int, int, str]]:
+        """ Read the pending events as (wd, mask, name) tuples """
+
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT.unpack_from(data, offset)
+            offset += EVENT.size
+            name = data[offset : offset + length].rstrip(b"\0")
+            offset += length
+            events.append((wd, mask, os.fsdecode(name)))
+
+        return events
+
+    def close(self) -> None:
+        os.close(self.fd)
+
+
+class AnalysisWatcher(object):
+    """ Watches the analysis directory for changes made outside this process.
+    Machines whose `machine.json` or journal is changed by someone else (an
+    editor, another shell or the scan daemon) are reloaded, and scan output
+    dropped into a `scans` directory is parsed for findings and indexed.
+    Writes made by this process are recognized and ignored. The watcher sleeps
+    in the kernel until something changes, so it costs nothing while idle.
+
+    `busy` is asked whether a scan output file is still being written by one of
+    our own scans, in which case it is left to the scanner. """
+
+    # Time from the first event of a batch until the batch is handled
+    SETTLE = 0.2
+
+    def __init__(
+        self,
+        connection: "htb.connection.Connection",
+        report: Callable[[str], None] = lambda _: None,
+        busy: Callable[["htb.machine.Machine", str], bool] = lambda m, p: False,
+    ):
+        self.cnxn = connection
+        self.report: Callable[[str], None] = report
+        self.busy: Callable[["htb.machine.Machine", str], bool] = busy
+        self.path: str = os.path.abspath(os.path.expanduser(connection.analysis_path))
+        self.inotify: Optional[Inotify] = None
+        # Watch descriptor -> (machine directory or None for the root, is scans)
+        self.watches: Dict[int, Tuple[Optional[str], bool]] = {}
+        self.thread: Optional[threading.Thread] = None
+        self.wakeup: Optional[Tuple[int, int]] = None
+
+    def start(self) -> None:
+        """ Start watching in a background thread. Raises OSError if inotify is
+        not available. """
+
+        self.inotify = Inotify()
+        self.wakeup = os.pipe()
+
+        self._watch(self.path, None, False)
+        for entry in os.scandir(self.path):
+            if entry.is_dir() and not entry.name.startswith("."):
+                self._watch_machine(entry.path)
+
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        """ Stop watching and wait for the thread to exit """
+
+        if self.thread is None:
+            return
+
+        os.write(self.wakeup[1], b"\0")
+        self.thread.join()
+        self.thread = None
+
+        self.inotify.close()
+        for fd in self.wakeup:
+            os.close(fd)
+
+    def _watch(self, path: str, machine: Optional[str], scans: bool) -> None:
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_ONLYDIR
+        try:
+            wd = self.inotify.add(path, mask)
+        except OSError as e:
+            # The directory may be gone again already
+            if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                raise
+            return
+        self.watches[wd] = (machine, scans)
+
+    def _watch_machine(self, path: str) -> None:
+        """ Watch a machine directory and its scans directory """
+
+        self._watch(path, path, False)
+        scans = os.path.join(path, "scans")
+        if os.path.isdir(scans):
+            self._watch(scans, path, True)
+
+    def _run(self) -> None:
+        selector = selectors.DefaultSelector()
+        selector.register(self.inotify.fd, selectors.EVENT_READ, "inotify")
+        selector.register(self.wakeup[0], selectors.EVENT_READ, "stop")
+
+        states: Set[str] = set()
+        outputs: Set[Tuple[str, str]] = set()
+        deadline: Optional[float] = None
+
+        try:
+            while True:
+                # Sleep until something happens, then collect a batch
+                if deadline is None:
+                    ready = selector.select()
+                else:
+                    ready = selector.select(max(0, deadline - time.monotonic()))
+
+                if any([key.data == "stop" for key, _ in ready]):
+                    return
+
+                for wd, mask, name in self.inotify.read():
+                    self._event(wd, mask, name, states, outputs)
+
+                if deadline is None and (states or outputs):
+                    deadline = time.monotonic() + self.SETTLE
+                elif deadline is not None and time.monotonic() >= deadline:
+                    try:
+                        self._handle(states, outputs)
+                    except Exception as e:
+                        self.report(f"analysis watcher: {e}")
+                    states, outputs, deadline = set(), set(), None
+        finally:
+            selector.close()
+
+    def _event(
+        self,
+        wd: int,
+        mask: int,
+        name: str,
+        states: Set[str],
+        outputs: Set[Tuple[str, str]],
+    ) -> None:
+        """ Collect an event into the pending changes """
+
+        if mask & IN_Q_OVERFLOW:
+            # Events were lost, reload everything we know about
+            for machine, scans in list(self.watches.values()):
+                if machine is not None and not scans:
+                    states.add(machine)
+            return
+
+        if mask & IN_IGNORED:
+            self.watches.pop(wd, None)
+            return
+
+        if wd not in self.watches or name.startswith("."):
+            return
+
+        machine, scans = self.watches[wd]
+        path = os.path.join(machine or self.path, "scans" if scans else "", name)
+
+        if mask & IN_ISDIR:
+            if machine is None:
+                self._watch_machine(path)
+            elif not scans and name == "scans":
+                self._watch(path, machine, True)
+        elif scans and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+            outputs.add((machine, path))
+        elif not scans and machine is not None and name in STATE_FILES:
+            if mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                states.add(machine)
+
+    def _machine(self, path: str) -> Optional["htb.machine.Machine"]:
+        """ The machine whose analysis directory is `path` """
+
+        name = os.path.basename(path)
+        for m in self.cnxn.machines:
+            if m.name.lower() == name:
+                return m
+        return None
+
+    def _handle(self, states: Set[str], outputs: Set[Tuple[str, str]]) -> None:
+        """ Act on a settled batch of changes """
+
+        for path in states:
+            m = self._machine(path)
+            if m is None:
+                continue
+
+            if not any([m.external_change(name) for name in STATE_FILES]):
+                continue
+
+            try:
+                m.load(self.cnxn.analysis_path)
+            except NoAnalysisPath:
+                self.report(
+                    f"{m.name}: machine.json is not valid; keeping current state"
+                )
+                continue
+
+            self.report(f"{m.name}: reloaded changed machine state")
+
+        for path, output in outputs:
+            m = self._machine(path)
+            if m is None or m.analysis_path is None or self.busy(m, output):
+                continue
+
+            added = self.parse(m, output)
+            m.index(finished=os.path.basename(output))
+
+            if added:
+                self.report(
+                    f"{m.name}: {added} new finding(s) in {os.path.basename(output)}"
+                )
+
+    def parse(self, machine: "htb.machine.Machine", path: str) -> int:
+        """ Parse a scan output file with the scanner it is named after (e.g.
+        `gobuster-80-tcp.txt`). Returns the number of findings added. """
+
+        match = SCAN_FILE.match(os.path.basename(path))
+        if match is None:
+            return 0
+
+        scanner = AVAILABLE_SCANNERS.get(match["scanner"])
+        if scanner is None:
+            return 0
+
+        port, protocol = int(match["port"]), match["protocol"]
+        services = [
+            s for s in machine.services if s.port == port and s.protocol == protocol
+        ]
+        service = (
+            services[0] if services else Service.from_port(machine.ip, port, protocol)
+        )
+
+        added = 0
+        try:
+            for finding in scanner.parse_file(service, path):
+                added += int(machine.findings.add(finding))
+        except OSError:
+            pass
+
+        return added
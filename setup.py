@@ -26,7 +26,9 @@ setup(
     url="https://github.com/calebstewart/python-htb",
     packages=find_packages(),
     package_data={"htb": []},
-    entry_points={"console_scripts": ["htb=htb.__main__:main"]},
+    entry_points={
+        "console_scripts": ["htb=htb.__main__:main", "htbd=htb.daemon:main"]
+    },
     install_requires=dependencies,
     dependency_links=dependency_links,
 )